@@ -0,0 +1,4 @@
+from cloud_sheep.asgi import app
+
+if __name__ == '__main__':
+    app.run()
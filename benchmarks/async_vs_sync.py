@@ -0,0 +1,96 @@
+"""Compares the sync (WSGI) and async (ASGI) deployments under concurrent load.
+
+Start both servers against the same database, for example:
+
+    gunicorn -b 127.0.0.1:8000 wsgi:app
+    hypercorn -b 127.0.0.1:8001 asgi:app
+
+and point the benchmark at the same route on each of them:
+
+    python benchmarks/async_vs_sync.py \\
+        --target sync=http://127.0.0.1:8000/api/messages?created_at=gt:2020 \\
+        --target async=http://127.0.0.1:8001/api/messages?created_at=gt:2020
+
+Results are printed as JSON so runs can be compared between commits.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(host, port, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        request = f"GET {target} HTTP/1.0\r\nHost: {host}\r\n\r\n"
+        writer.write(request.encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run(url, requests, concurrency):
+    parts = urlsplit(url)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def timed_fetch():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await fetch(parts.hostname, parts.port or 80, target)
+                if status >= 400:
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed_fetch() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "url": url,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "latency_ms": {
+            "p50": quantiles[49] * 1000,
+            "p90": quantiles[89] * 1000,
+            "p99": quantiles[98] * 1000,
+            "max": max(latencies) * 1000,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--target",
+        action="append",
+        required=True,
+        help="name=url of a deployment to benchmark, can be repeated",
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    results = {}
+    for target in args.target:
+        name, url = target.split("=", 1)
+        results[name] = asyncio.run(run(url, args.requests, args.concurrency))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Micro-benchmarks for the request hot path.
+
+Runs offline against the embedded memory backend:
+
+    python benchmarks/hot_path.py --output before.json
+    # ...change something...
+    python benchmarks/hot_path.py --compare before.json
+
+Results are printed as JSON. With --compare, each benchmark also gets its
+ratio to the baseline, and the exit status is 1 when one got slower than
+--threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+os.environ.setdefault("MONGODB_BACKEND", "memory")
+# the benchmarks send requests faster than any client is allowed to
+os.environ["ADMISSION_CONTROL"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Response, jsonify  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+
+from cloud_sheep import app, db  # noqa: E402
+from cloud_sheep.entities.message import (  # noqa: E402
+    create_message,
+    create_message_update,
+)
+from cloud_sheep.entities.param import parse_param_expr  # noqa: E402
+from cloud_sheep.mongodb import convert_to_date  # noqa: E402
+from cloud_sheep.serialization import JSON_BACKENDS, JSON_MIMETYPE  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    # a benchmark is a setup function returning the callable to time
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def seed_messages(count):
+    messages = [
+        create_message(title=f"title {i}", text=f"message number {i} " * 20)
+        for i in range(count)
+    ]
+    db.message.insert_many(messages)
+    return messages
+
+
+@benchmark("parse_param_expr")
+def bench_parse_param_expr(messages):
+    return lambda: parse_param_expr("created_at", "gt:20200101")
+
+
+@benchmark("convert_to_date")
+def bench_convert_to_date(messages):
+    return lambda: convert_to_date("20200101")
+
+
+@benchmark("create_query_from_dict")
+def bench_create_query_from_dict(messages):
+    url_query = MultiDict(
+        [
+            ("created_at", "gt:2020"),
+            ("created_at", "lt:2021"),
+            ("title", "rg:^title"),
+            ("q", "message"),
+        ]
+    )
+    # the query dict is consumed, so each run gets a copy
+    return lambda: db.create_query_from_dict(url_query.copy())
+
+
+@benchmark("create_message")
+def bench_create_message(messages):
+    return lambda: create_message(title="title", text="text " * 200)
+
+
+@benchmark("create_message_update")
+def bench_create_message_update(messages):
+    return lambda: create_message_update(title="title", text="text " * 200)
+
+
+@benchmark("serialize_page_flask_jsonify")
+def bench_serialize_page_flask_jsonify(messages):
+    # the previous path: _id rewritten in a copy of each document, then jsonify
+    page = messages[:100]
+
+    def run():
+        with app.app_context():
+            result = {"messages": [{**m, "_id": str(m["_id"])} for m in page]}
+            return jsonify(result)
+
+    return run
+
+
+def bench_serialize_page(backend):
+    def setup(messages):
+        dumps = JSON_BACKENDS[backend]
+        page = messages[:100]
+        return lambda: Response(dumps({"messages": page}), mimetype=JSON_MIMETYPE)
+
+    return setup
+
+
+for backend in JSON_BACKENDS:
+    try:
+        JSON_BACKENDS[backend]({})
+    except AttributeError:
+        continue  # orjson isn't installed
+    benchmark(f"serialize_page_{backend}")(bench_serialize_page(backend))
+
+
+@benchmark("dispatch_get_one")
+def bench_dispatch_get_one(messages):
+    client = app.test_client()
+    url = f"/api/messages/{messages[0]['_id']}"
+    return lambda: client.get(url)
+
+
+@benchmark("dispatch_get_many")
+def bench_dispatch_get_many(messages):
+    client = app.test_client()
+    return lambda: client.get("/api/messages?created_at=gt:2000&limit=20")
+
+
+@benchmark("dispatch_get_many_text_search")
+def bench_dispatch_get_many_text_search(messages):
+    client = app.test_client()
+    return lambda: client.get("/api/messages?q=number&limit=20")
+
+
+@benchmark("dispatch_post")
+def bench_dispatch_post(messages):
+    client = app.test_client()
+    body = {"title": "title", "text": "text " * 200}
+    return lambda: client.post("/api/messages", json=body)
+
+
+def time_benchmark(run, repeat, min_time):
+    # finds a loop count that takes at least min_time, like timeit's CLI
+    timer = timeit.Timer(run)
+    loops, elapsed = timer.autorange()
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+    times = [t / loops for t in timer.repeat(repeat=repeat, number=loops)]
+    return {
+        "loops": loops,
+        "best_us": min(times) * 1e6,
+        "median_us": statistics.median(times) * 1e6,
+        "stdev_us": statistics.stdev(times) * 1e6 if len(times) > 1 else 0.0,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        result["ratio"] = result["median_us"] / before["median_us"]
+        if result["ratio"] > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", help="only run benchmarks containing this")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--compare", help="a previous output to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="slowdown ratio reported as a regression, 0.1 by default",
+    )
+    args = parser.parse_args()
+
+    messages = seed_messages(args.messages)
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = time_benchmark(setup(messages), args.repeat, args.min_time)
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "messages": args.messages,
+        "benchmarks": results,
+    }
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
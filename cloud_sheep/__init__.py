@@ -1,6 +1,17 @@
+import os
+
 from flask import Flask
 
-from . import api, exceptions, views
+from . import (
+    admission,
+    api,
+    compression,
+    exceptions,
+    indexes,
+    metrics,
+    slow_queries,
+    views,
+)
 from .mongodb import DatabaseClient
 
 LATEST_VERSION = "v1"
@@ -8,8 +19,19 @@ LATEST_VERSION = "v1"
 app = Flask(__name__)
 
 exceptions.setup_error_handlers(app)
+metrics.setup_metrics(app)
+
+db = DatabaseClient()
+# requests are admitted before their body is decompressed
+admission.setup_admission_control(app, db=db)
+compression.setup_compression(app)
+slow_queries.setup_slow_query_log(app)
+indexes.setup_commands(app, db=db)
+# like `flask ensure-indexes`, which also backfills the normalized fields
+if os.environ.get("ENSURE_INDEXES"):
+    indexes.ensure_indexes_in_background(db.message)
 
-views.setup_views(db=DatabaseClient())
+views.setup_views(db=db)
 views = views.get_views()
 api.setup_url_rules(**views)
 
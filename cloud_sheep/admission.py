@@ -0,0 +1,269 @@
+import collections
+import json
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+import flask
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import TooManyRequests
+
+from .metrics import Counter
+from .mongodb import has_regex, is_indexed, normalize_query_dict
+
+# cost units each client gets per second, and how many it can spend at once
+RATE_LIMITS = {
+    "read": (50, 100),
+    "scan": (5, 20),
+    "write": (50, 100),
+    "bulk_write": (2, 10),
+}
+RATE_LIMITS.update(json.loads(os.environ.get("ADMISSION_RATE_LIMITS", "{}")))
+CLIENT_HEADER = os.environ.get("ADMISSION_CLIENT_HEADER")
+# behind proxies, like the Heroku router, clients are told apart by the address
+# the outermost trusted one put in X-Forwarded-For
+TRUSTED_PROXIES = int(os.environ.get("ADMISSION_TRUSTED_PROXIES", 0))
+MAX_CLIENTS = 10_000
+MAX_BULK_WRITES = int(os.environ.get("ADMISSION_MAX_BULK_WRITES", 4))
+# a cost unit is about a hundred returned documents or 64KB of written body
+DOCUMENTS_PER_UNIT = 100
+BYTES_PER_UNIT = 64 * 1024
+# how much larger a compressed body is assumed to be once decompressed
+COMPRESSION_RATIO = 5
+# about the size of an id in a JSON list
+ID_BYTES = 28
+# how many documents a listing without a limit is assumed to return
+UNBOUNDED_LIMIT = 1000
+SCAN_FACTOR = 10
+REGEX_SCAN_FACTOR = 2
+NON_FILTER_PARAMS = [
+    "limit",
+    "after",
+    "sort",
+    "fields",
+    "-fields",
+    "facets",
+    "stream",
+    "count",
+    "max_count",
+    "lang",
+]
+
+REJECTED_REQUESTS = Counter(
+    "admission_rejected_total",
+    "Requests refused with a 429 to keep the database responsive.",
+    ["cost_class"],
+)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = now
+
+    def take(self, cost, now):
+        # returns how many seconds until the cost fits, 0 when it was taken
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        # a request costing more than the burst waits for a full bucket
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits, max_clients=MAX_CLIENTS):
+        self.limits = limits
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_wait(self, client, cost_class, cost):
+        if cost_class not in self.limits:
+            return 0
+        rate, burst = self.limits[cost_class]
+        key = (client, cost_class)
+        now = time.monotonic()
+        with self._lock:
+            # the least recently seen clients are forgotten first
+            bucket = self.buckets.pop(key, None) or TokenBucket(rate, burst, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return bucket.take(cost, now)
+
+    def admit(self, client, cost_class, cost):
+        wait = self.get_wait(client, cost_class, cost)
+        if wait:
+            REJECTED_REQUESTS.inc(cost_class=cost_class)
+            raise TooManyRequests(
+                f"Too many {cost_class} requests.", retry_after=math.ceil(wait)
+            )
+
+
+class ConcurrencyLimit:
+    def __init__(self, size, cost_class, retry_after=1):
+        self.cost_class = cost_class
+        self.retry_after = retry_after
+        self._semaphore = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        if not self._semaphore.acquire(blocking=False):
+            REJECTED_REQUESTS.inc(cost_class=self.cost_class)
+            raise TooManyRequests(
+                f"Too many {self.cost_class} requests are running.",
+                retry_after=self.retry_after,
+            )
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+BULK_WRITES = ConcurrencyLimit(MAX_BULK_WRITES, "bulk_write")
+
+
+def limit_bulk_writes(view):
+    # update_many and delete_many run a few at a time, whoever sends them
+    @wraps(view)
+    def wrapper(self, id=None):
+        if id is not None:
+            return view(self, id)
+        if not is_enabled():
+            return view(self)
+        with BULK_WRITES:
+            return view(self)
+
+    return wrapper
+
+
+def limit_bulk_writes_async(view):
+    @wraps(view)
+    async def wrapper(self, id=None):
+        if id is not None:
+            return await view(self, id)
+        if not is_enabled():
+            return await view(self)
+        with BULK_WRITES:
+            return await view(self)
+
+    return wrapper
+
+
+def is_indexed_query(db, args):
+    query_dict = MultiDict(args)
+    for name in NON_FILTER_PARAMS:
+        query_dict.poplist(name)
+    if "q" in query_dict:
+        return True, False
+    try:
+        subqueries = db.create_param_queries(*normalize_query_dict(query_dict))
+    except Exception:
+        return True, False  # the view reports invalid queries
+    # without a filter, the last_modified index bounds the listing
+    indexed = not subqueries or any(map(is_indexed, subqueries))
+    return indexed, any(map(has_regex, subqueries))
+
+
+def estimate_cost(db, endpoint, method, view_args, args, content_length):
+    # returns the cost class of a request and how many units it costs
+    if endpoint == "get_messages_by_id":
+        ids = (content_length or 0) // ID_BYTES
+        return "read", max(1, math.ceil(ids / DOCUMENTS_PER_UNIT))
+    if method == "POST":
+        cost = max(1, math.ceil((content_length or 0) / BYTES_PER_UNIT))
+        bulk = endpoint in ["import_messages", "bulk_messages"]
+        return ("bulk_write" if bulk else "write"), cost
+    if endpoint != "get_message" or view_args.get("id") is not None:
+        return ("read" if method in ["GET", "HEAD"] else "write"), 1
+
+    if "ids" in args:
+        ids = sum(len(param.split(",")) for param in args.getlist("ids"))
+        return "read", max(1, math.ceil(ids / DOCUMENTS_PER_UNIT))
+    indexed, regex = is_indexed_query(db, args)
+    if method in ["PUT", "DELETE"]:
+        cost_class, cost = "bulk_write", 1
+    elif method == "HEAD" or args.get("count", "").lower() in ["true", "1"]:
+        cost_class, cost = "read", 1
+    else:
+        try:
+            limit = int(args.get("limit") or 0)
+        except ValueError:
+            limit = 0
+        cost_class = "read"
+        cost = math.ceil((limit or UNBOUNDED_LIMIT) / DOCUMENTS_PER_UNIT)
+
+    if not indexed:
+        cost *= SCAN_FACTOR * (REGEX_SCAN_FACTOR if regex else 1)
+        cost_class = "scan" if cost_class == "read" else cost_class
+    return cost_class, cost
+
+
+def get_forwarded_address(headers, trusted_proxies):
+    # each proxy appends the address it got the request from, so the entries
+    # before the trusted proxies' ones could come from the client itself
+    addresses = [
+        address.strip()
+        for address in headers.get("X-Forwarded-For", "").split(",")
+        if address.strip()
+    ]
+    if len(addresses) >= trusted_proxies:
+        return addresses[-trusted_proxies]
+    return None
+
+
+def get_client_id(request):
+    if CLIENT_HEADER and CLIENT_HEADER in request.headers:
+        return request.headers[CLIENT_HEADER]
+    if TRUSTED_PROXIES:
+        address = get_forwarded_address(request.headers, TRUSTED_PROXIES)
+        if address is not None:
+            return address
+    return request.remote_addr
+
+
+def get_body_length(request):
+    # admission runs before decompression, so the length is the compressed one
+    length = request.content_length
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if length and encoding != "identity":
+        return length * COMPRESSION_RATIO
+    return length
+
+
+def is_enabled():
+    # read when requests come in, like the database config. Limits are per
+    # client, so it's off unless clients can be told apart
+    return os.environ.get("ADMISSION_CONTROL", "false").lower() in ["true", "1"]
+
+
+def admit_request(db, request):
+    if request.blueprint != "api" or not is_enabled():
+        return
+    cost_class, cost = estimate_cost(
+        db,
+        request.endpoint.rpartition(".")[2],
+        request.method,
+        request.view_args or {},
+        request.args,
+        get_body_length(request),
+    )
+    RATE_LIMITER.admit(get_client_id(request), cost_class, cost)
+
+
+def setup_admission_control(app, *, db, request=flask.request):
+    @app.before_request
+    def admit():
+        admit_request(db, request)
+
+
+def setup_async_admission_control(app, *, db, request):
+    @app.before_request
+    async def admit():
+        admit_request(db, request)
@@ -3,13 +3,44 @@ from flask import Blueprint
 bp = Blueprint("api", __name__)
 
 
-def setup_url_rules(*, message_view):
-    bp.add_url_rule("", view_func=lambda: ("", 204))
-    bp.add_url_rule(
+def setup_url_rules(
+    *,
+    message_view,
+    message_import_view=None,
+    message_text_view=None,
+    message_stream_view=None,
+    message_mget_view=None,
+    message_bulk_view=None,
+    blueprint=bp,
+):
+    blueprint.add_url_rule("", view_func=lambda: ("", 204))
+    blueprint.add_url_rule(
         "/messages", view_func=message_view, methods=["GET", "POST", "PUT", "DELETE"]
     )
-    bp.add_url_rule(
+    blueprint.add_url_rule(
         "/messages/<string:id>",
         view_func=message_view,
         methods=["GET", "PUT", "DELETE"],
     )
+    if message_import_view is not None:
+        blueprint.add_url_rule(
+            "/messages/_import", view_func=message_import_view, methods=["POST"]
+        )
+    if message_mget_view is not None:
+        blueprint.add_url_rule(
+            "/messages/_mget", view_func=message_mget_view, methods=["POST"]
+        )
+    if message_bulk_view is not None:
+        blueprint.add_url_rule(
+            "/messages/_bulk", view_func=message_bulk_view, methods=["POST"]
+        )
+    if message_text_view is not None:
+        blueprint.add_url_rule(
+            "/messages/<string:id>/text",
+            view_func=message_text_view,
+            methods=["GET"],
+        )
+    if message_stream_view is not None:
+        blueprint.add_url_rule(
+            "/messages/stream", view_func=message_stream_view, methods=["GET"]
+        )
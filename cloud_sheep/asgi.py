@@ -0,0 +1,39 @@
+from quart import Blueprint, Quart, request
+
+from . import (
+    LATEST_VERSION,
+    admission,
+    api,
+    compression,
+    exceptions,
+    metrics,
+    slow_queries,
+)
+from .mongodb import AsyncDatabaseClient
+from .views.async_message import (
+    AsyncMessageMultiGetView,
+    AsyncMessageStreamView,
+    AsyncMessageTextView,
+    AsyncMessageView,
+)
+
+app = Quart(__name__)
+
+exceptions.setup_error_handlers(app)
+metrics.setup_metrics(app, request=request)
+
+bp = Blueprint("api", __name__)
+db = AsyncDatabaseClient()
+admission.setup_async_admission_control(app, db=db, request=request)
+compression.setup_async_compression(app, request=request)
+slow_queries.setup_slow_query_log(app, request=request)
+api.setup_url_rules(
+    message_view=AsyncMessageView.as_view("get_message", db),
+    message_text_view=AsyncMessageTextView.as_view("get_message_text", db),
+    message_stream_view=AsyncMessageStreamView.as_view("stream_messages", db),
+    message_mget_view=AsyncMessageMultiGetView.as_view("get_messages_by_id", db),
+    blueprint=bp,
+)
+
+app.register_blueprint(bp, url_prefix="/api")
+app.register_blueprint(bp, url_prefix=f"/api/{LATEST_VERSION}")
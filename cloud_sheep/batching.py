@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Future
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+
+from .metrics import DOCUMENT_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+# single inserts arriving within this window are written together, 0 disables it.
+# A WSGI worker needs threads (e.g. gunicorn --threads) to get several inserts at
+# once, so the default sync workers never batch, only the ASGI app and threaded
+# workers do
+WINDOW_MS = float(os.environ.get("INSERT_BATCH_WINDOW_MS", 0))
+MAX_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", 100))
+
+INSERT_BATCH_SIZES = Histogram(
+    "insert_batch_size",
+    "Number of single message inserts written by one insert_many.",
+    buckets=DOCUMENT_BUCKETS,
+)
+
+
+def get_write_errors(error):
+    # the error each failed document would have had with insert_one
+    errors = {}
+    for details in error.details["writeErrors"]:
+        error_class = DuplicateKeyError if details["code"] == 11000 else WriteError
+        errors[details["index"]] = error_class(
+            details["errmsg"], details["code"], details
+        )
+    return errors
+
+
+def get_inserted_ids(documents, errors):
+    # insert_many sets the _id of every document, written or not
+    return [errors.get(i) or document["_id"] for i, document in enumerate(documents)]
+
+
+def set_results(futures, results):
+    for future, result in zip(futures, results):
+        if future.done():
+            continue  # the caller went away
+        elif isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+class Batch:
+    def __init__(self, collection, full):
+        self.collection = collection
+        self.documents = []
+        self.futures = []
+        self.full = full
+
+
+class InsertBatcher:
+    # batches the inserts of a single collection
+    def __init__(self, window_ms=WINDOW_MS, max_size=MAX_BATCH_SIZE):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._batch = None
+        self._lock = threading.Lock()
+        self._warned = False
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    def is_enabled_for(self, environ):
+        # a worker handling one request at a time would only wait out the window
+        if not self.enabled:
+            return False
+        elif not environ.get("wsgi.multithread"):
+            if not self._warned:
+                self._warned = True
+                logger.warning(
+                    "Inserts aren't batched, the worker handles one request "
+                    "at a time."
+                )
+            return False
+        return True
+
+    def create_batch(self, collection):
+        return Batch(collection, threading.Event())
+
+    def create_future(self):
+        return Future()
+
+    def add(self, collection, document):
+        # returns the document's batch and future, and whether the caller
+        # is the one writing the batch
+        batch = self._batch
+        leader = batch is None
+        if leader:
+            batch = self._batch = self.create_batch(collection)
+        future = self.create_future()
+        batch.documents.append(document)
+        batch.futures.append(future)
+        if len(batch.documents) >= self.max_size:
+            # the next inserts start another batch right away
+            self._batch = None
+            batch.full.set()
+        return batch, future, leader
+
+    def close(self, batch):
+        if self._batch is batch:
+            self._batch = None
+
+    def insert(self, collection, document):
+        with self._lock:
+            batch, future, leader = self.add(collection, document)
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                self.close(batch)
+            self.flush(batch)
+        return future.result()
+
+    def flush(self, batch):
+        INSERT_BATCH_SIZES.observe(len(batch.documents))
+        try:
+            batch.collection.insert_many(batch.documents, ordered=False)
+            errors = {}
+        except BulkWriteError as error:
+            errors = get_write_errors(error)
+        except Exception as error:
+            set_results(batch.futures, [error] * len(batch.futures))
+            return
+        set_results(batch.futures, get_inserted_ids(batch.documents, errors))
+
+
+class AsyncInsertBatcher(InsertBatcher):
+    # runs on the event loop, so the batch needs no lock
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._flushes = set()
+
+    def create_batch(self, collection):
+        return Batch(collection, asyncio.Event())
+
+    def create_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def insert(self, collection, document):
+        batch, future, leader = self.add(collection, document)
+        if leader:
+            # a task, so the batch is written even if this client goes away
+            task = asyncio.ensure_future(self.flush_later(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        return await future
+
+    async def flush_later(self, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        self.close(batch)
+        await self.flush(batch)
+
+    async def flush(self, batch):
+        INSERT_BATCH_SIZES.observe(len(batch.documents))
+        try:
+            await batch.collection.insert_many(batch.documents, ordered=False)
+            errors = {}
+        except BulkWriteError as error:
+            errors = get_write_errors(error)
+        except Exception as error:
+            set_results(batch.futures, [error] * len(batch.futures))
+            return
+        set_results(batch.futures, get_inserted_ids(batch.documents, errors))
+
+
+MESSAGE_INSERTS = InsertBatcher()
+ASYNC_MESSAGE_INSERTS = AsyncInsertBatcher()
@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import bson
+from bson import json_util
+from bson.errors import InvalidBSON
+
+from .metrics import Counter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# a directory shared by the workers of a host, ideally in memory like /dev/shm
+SHARED_DIR = os.environ.get("COALESCE_DIR")
+SHARED_TIMEOUT = float(os.environ.get("COALESCE_TIMEOUT", 5))
+POLL_INTERVAL = 0.005
+
+COALESCED_QUERIES = Counter(
+    "coalesced_queries_total",
+    "Queries answered with the result of an identical one already running.",
+    ["scope"],
+)
+
+
+def get_query_key(find_query):
+    # the values are part of the key, so only the very same query is shared
+    return json_util.dumps(find_query)
+
+
+def is_linked(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        # the first caller runs fn, the ones arriving before it's done get its
+        # result, and nothing is kept afterwards
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            COALESCED_QUERIES.inc(scope="worker")
+            return flight.wait()
+
+        try:
+            flight.result = self.run(key, fn)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def run(self, key, fn):
+        return fn()
+
+
+class SharedSingleFlight(SingleFlight):
+    # the leaders of each worker take a file lock, and the result of the one
+    # that got it is left in the file for the others
+    def __init__(self, directory, timeout=SHARED_TIMEOUT):
+        super().__init__()
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key):
+        # one file per key, so only the very same query is waited for
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.flight")
+
+    def run(self, key, fn):
+        path = self.get_path(key)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with open(fd, "r+b") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return self.follow(f, key, fn)
+            try:
+                # the file of a flight that's over was removed, and isn't led
+                if not is_linked(f, path):
+                    return fn()
+                result = fn()
+                flight = {"key": key, "time": time.time_ns(), "result": result}
+                f.truncate(0)
+                f.write(bson.encode(flight))
+                f.flush()
+            finally:
+                # the followers that opened it still read it, the next
+                # queries start a new one
+                if is_linked(f, path):
+                    os.unlink(path)
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def follow(self, f, key, fn):
+        started = time.time_ns()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    return fn()
+                time.sleep(POLL_INTERVAL)
+        try:
+            f.seek(0)
+            data = f.read()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        try:
+            flight = bson.decode(data)
+        except (InvalidBSON, IndexError):
+            flight = None
+        # a result finished before this request came is never used
+        if flight and flight["key"] == key and flight["time"] >= started:
+            COALESCED_QUERIES.inc(scope="shared")
+            return flight["result"]
+        return fn()
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._tasks = {}
+
+    def forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def do(self, key, fn):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda task: self.forget(key, task))
+        else:
+            COALESCED_QUERIES.inc(scope="worker")
+        # a client going away doesn't cancel the query the others wait for
+        return await asyncio.shield(task)
+
+
+def create_single_flight():
+    if SHARED_DIR and fcntl is not None:
+        return SharedSingleFlight(SHARED_DIR)
+    return SingleFlight()
+
+
+QUERY_FLIGHTS = create_single_flight()
+ASYNC_QUERY_FLIGHTS = AsyncSingleFlight()
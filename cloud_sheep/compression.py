@@ -0,0 +1,254 @@
+import io
+import os
+import zlib
+
+import flask
+from werkzeug.exceptions import (
+    BadRequest,
+    RequestEntityTooLarge,
+    UnsupportedMediaType,
+)
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+MAX_DECOMPRESSED_SIZE = int(os.environ.get("MAX_DECOMPRESSED_SIZE", 64 << 20))
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson"}
+# fast levels, since every response is compressed on the fly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+READ_SIZE = 16 * 1024
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class BrotliDecompressor:
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.process(data)
+
+
+def create_gzip_compressor():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def create_zstd_compressor():
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def create_zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# in order of preference when the client accepts several equally
+COMPRESSORS = {"gzip": create_gzip_compressor}
+DECOMPRESSORS = {
+    "gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "x-gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "deflate": zlib.decompressobj,
+}
+if brotli is not None:
+    COMPRESSORS = {"br": BrotliCompressor, **COMPRESSORS}
+    DECOMPRESSORS["br"] = BrotliDecompressor
+if zstandard is not None:
+    COMPRESSORS = {"zstd": create_zstd_compressor, **COMPRESSORS}
+    DECOMPRESSORS["zstd"] = create_zstd_decompressor
+
+
+def negotiate_encoding(accept_encoding):
+    accept = parse_accept_header(accept_encoding)
+    return accept.best_match(list(COMPRESSORS))
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code in [204, 304]:
+        return False
+    # byte ranges are offsets into the uncompressed body
+    if "Content-Encoding" in response.headers or "Accept-Ranges" in response.headers:
+        return False
+    mimetype = response.mimetype or ""
+    # a compressor holds events back until it has enough data
+    if mimetype == "text/event-stream":
+        return False
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress(data, encoding):
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_chunks(chunks, encoding):
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def compress_body(body, encoding):
+    compressor = COMPRESSORS[encoding]()
+    async with body as chunks:
+        async for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def prepare_response(response, accept_encoding):
+    # returns the encoding the response should be compressed with, if any
+    if not is_compressible(response):
+        return None
+    length = response.content_length
+    if length is not None and length < MIN_SIZE:
+        return None
+
+    vary = [v.strip() for v in response.headers.get("Vary", "").split(",")]
+    vary = [v for v in vary if v]
+    if "accept-encoding" not in [v.lower() for v in vary]:
+        response.headers["Vary"] = ", ".join([*vary, "Accept-Encoding"])
+
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return None
+
+    response.headers["Content-Encoding"] = encoding
+    # the compressed bytes are a different representation of the same version
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return encoding
+
+
+class DecompressingStream(io.RawIOBase):
+    def __init__(self, stream, encoding, max_size=None):
+        self.stream = stream
+        self.decompressor = DECOMPRESSORS[encoding]()
+        self.max_size = MAX_DECOMPRESSED_SIZE if max_size is None else max_size
+        self.size = 0
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            data = self.stream.read(READ_SIZE)
+            if not data:
+                self._eof = True
+                break
+            self._buffer = self._decompress(data)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def _decompress(self, data):
+        try:
+            data = self.decompressor.decompress(data)
+        except Exception:
+            raise BadRequest("The request body couldn't be decompressed.")
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        return data
+
+
+def get_request_encoding(headers):
+    encoding = headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding != "identity" and encoding not in DECOMPRESSORS:
+        raise UnsupportedMediaType(f"Unsupported content encoding: {encoding}.")
+    return None if encoding == "identity" else encoding
+
+
+def decompress(data, encoding):
+    stream = DecompressingStream(io.BytesIO(data), encoding)
+    return stream.readall()
+
+
+def setup_compression(app, *, request=flask.request):
+    @app.before_request
+    def decompress_request():
+        encoding = get_request_encoding(request.headers)
+        if encoding is None:
+            return
+        # the body is decompressed as it's read, so imports keep streaming
+        environ = request.environ
+        environ["wsgi.input"] = io.BufferedReader(
+            DecompressingStream(request.stream, encoding)
+        )
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        environ.pop("HTTP_CONTENT_ENCODING", None)
+        request.__dict__.pop("stream", None)
+
+    @app.after_request
+    def compress_response(response):
+        if response.direct_passthrough:
+            return response
+        accept_encoding = request.headers.get("Accept-Encoding")
+        encoding = prepare_response(response, accept_encoding)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            chunks = response.response
+            response.response = compress_chunks(chunks, encoding)
+            # closing the response has to close the original iterable too
+            if hasattr(chunks, "close"):
+                response.call_on_close(chunks.close)
+        else:
+            response.set_data(compress(response.get_data(), encoding))
+        return response
+
+
+def setup_async_compression(app, *, request):
+    @app.before_request
+    async def decompress_request():
+        encoding = get_request_encoding(request.headers)
+        if encoding is None:
+            return
+        body = request.body_class(None, None)
+        body.set_result(decompress(await request.get_data(), encoding))
+        request.body = body
+        del request.headers["Content-Encoding"]
+
+    @app.after_request
+    async def compress_response(response):
+        accept_encoding = request.headers.get("Accept-Encoding")
+        encoding = prepare_response(response, accept_encoding)
+        if encoding is None:
+            return response
+
+        if response.content_length is None:
+            response.response = response.iterable_body_class(
+                compress_body(response.response, encoding)
+            )
+        else:
+            response.set_data(compress(await response.get_data(), encoding))
+        return response
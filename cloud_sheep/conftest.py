@@ -0,0 +1,6 @@
+import os
+
+# the suite runs offline against the embedded engine unless told otherwise
+os.environ.setdefault("MONGODB_BACKEND", "memory")
+# the suite sends requests faster than any client is allowed to
+os.environ.setdefault("ADMISSION_CONTROL", "false")
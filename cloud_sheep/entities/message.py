@@ -12,6 +12,11 @@ def now():
     return datetime.now(timezone.utc)
 
 
+def normalize_title(title):
+    # case insensitive title filters use an index on this form
+    return title.lower()
+
+
 def create_message(*, text=None, title=None, **kwargs):
     try:
         assert text is not None and not kwargs
@@ -19,6 +24,7 @@ def create_message(*, text=None, title=None, **kwargs):
         if title is not None:
             validate_title(title)
             message["title"] = title
+            message["title_lower"] = normalize_title(title)
 
         validate_text(text)
         message["text"] = text
@@ -37,6 +43,7 @@ def create_message_update(*, text=None, title=None, **kwargs):
         if title is not None:
             validate_title(title)
             update["title"] = title
+            update["title_lower"] = normalize_title(title)
         if text is not None:
             validate_text(text)
             update["text"] = text
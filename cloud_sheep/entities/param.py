@@ -47,6 +47,16 @@ PARAM_DICT = {
 }
 
 
+FIELDS = [
+    "_id",
+    *[
+        name
+        for name, param in PARAM_DICT.items()
+        if not isinstance(param, TextSearchParam)
+    ],
+]
+
+
 def get_param(name):
     try:
         return PARAM_DICT[name]
@@ -68,3 +78,8 @@ def parse_param_expr(param, expr):
         return op, value
     except ValueError:
         raise InvalidExpression(f"'{expr}' is not a valid expression.")
+
+
+def validate_field(name):
+    if name not in FIELDS:
+        raise InvalidParam(f"'{name}' is not a valid field.")
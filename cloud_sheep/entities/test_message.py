@@ -25,7 +25,7 @@ class TooLongTitle(str):
     "message",
     [
         {"text": "text"},
-        {"text": "text", "title": "title"},
+        {"text": "text", "title": "Title"},
     ],
 )
 def test_create_message_with_valid_input(message):
@@ -34,10 +34,11 @@ def test_create_message_with_valid_input(message):
     assert created_message["text"] == message["text"]
     if "title" in message:
         assert created_message["title"] == message["title"]
+        assert created_message["title_lower"] == message["title"].lower()
     assert type(created_message["created_at"]) == datetime
     assert created_message["created_at"] == created_message["last_modified"]
 
-    for key in ["text", "title", "created_at", "last_modified"]:
+    for key in ["text", "title", "title_lower", "created_at", "last_modified"]:
         if key in created_message:
             created_message.pop(key)
     assert len(created_message) == 0
@@ -97,9 +98,10 @@ def test_create_message_update_with_valid_input(message):
         assert created_message["text"] == message["text"]
     if "title" in message:
         assert created_message["title"] == message["title"]
+        assert created_message["title_lower"] == message["title"].lower()
     assert type(created_message["last_modified"]) == datetime
 
-    for key in ["text", "title", "last_modified"]:
+    for key in ["text", "title", "title_lower", "last_modified"]:
         if key in created_message:
             created_message.pop(key)
     assert len(created_message) == 0
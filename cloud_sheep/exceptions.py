@@ -1,4 +1,5 @@
 from bson.errors import InvalidId
+from werkzeug.exceptions import Gone, TooManyRequests
 
 from .entities.message import InvalidMessage
 from .entities.param import InvalidExpression, InvalidParam
@@ -15,3 +16,16 @@ def setup_error_handlers(app):
     @app.errorhandler(InvalidId)
     def invalid_value(error):
         return {"message": error.args[0], "error": type(error).__name__}, 400
+
+    @app.errorhandler(TooManyRequests)
+    def too_many_requests(error):
+        headers = {"Retry-After": str(error.retry_after)}
+        return (
+            {"message": error.description, "error": type(error).__name__},
+            429,
+            headers,
+        )
+
+    @app.errorhandler(Gone)
+    def gone(error):
+        return {"message": error.description, "error": type(error).__name__}, 410
@@ -0,0 +1,156 @@
+import logging
+import threading
+
+import click
+from pymongo import ASCENDING, TEXT, IndexModel, UpdateOne
+
+from .entities.message import normalize_title
+from .entities.param import PARAM_DICT, TextSearchParam
+
+logger = logging.getLogger(__name__)
+
+SORTABLE_FIELDS = ["created_at", "last_modified", "title"]
+TEXT_SEARCH_FIELDS = ["title", "text"]
+# fields also stored normalized, so case insensitive filters can use an index.
+# Messages stored before a field existed get it from `flask ensure-indexes`, or
+# at startup with ENSURE_INDEXES set, and are only matched by the regex till then
+NORMALIZED_FIELDS = {"title": ("title_lower", normalize_title)}
+INDEXED_FIELDS = [*SORTABLE_FIELDS, *[n for n, _ in NORMALIZED_FIELDS.values()]]
+BACKFILL_BATCH_SIZE = 1000
+
+
+def get_index_models():
+    models = []
+    for name, param in PARAM_DICT.items():
+        if isinstance(param, TextSearchParam):
+            models.append(
+                IndexModel(
+                    [(field, TEXT) for field in TEXT_SEARCH_FIELDS],
+                    name="text_search",
+                    default_language="none",
+                    background=True,
+                )
+            )
+        elif name in SORTABLE_FIELDS:
+            # _id is the keyset pagination tie breaker
+            models.append(
+                IndexModel(
+                    [(name, ASCENDING), ("_id", ASCENDING)],
+                    name=f"{name}_keyset",
+                    background=True,
+                )
+            )
+    for name, _ in NORMALIZED_FIELDS.values():
+        models.append(IndexModel([(name, ASCENDING)], name=name, background=True))
+    # finds the messages still referencing an offloaded text
+    models.append(
+        IndexModel(
+            [("text_file._id", ASCENDING)],
+            name="text_file",
+            sparse=True,
+            background=True,
+        )
+    )
+    return models
+
+
+def get_index_key(index):
+    # the server stores text indexes as _fts/_ftsx, with the fields in "weights"
+    if "weights" in index:
+        return (TEXT, tuple(sorted(index["weights"])))
+    key = list(dict(index["key"]).items())
+    text_fields = [name for name, direction in key if direction == TEXT]
+    if text_fields:
+        return (TEXT, tuple(sorted(text_fields)))
+    return tuple(key)
+
+
+def diff_indexes(index_information, models):
+    existing_keys = {
+        get_index_key(index): name for name, index in index_information.items()
+    }
+    wanted_keys = {get_index_key(model.document) for model in models}
+    # a collection has one text index at most, creating another one fails
+    existing_text = [name for key, name in existing_keys.items() if key[0] == TEXT]
+
+    missing, drifted = [], []
+    for model in models:
+        name = model.document["name"]
+        key = get_index_key(model.document)
+        if key in existing_keys:
+            continue
+        elif key[0] == TEXT and existing_text:
+            drifted.append(existing_text[0])
+        elif name in index_information:
+            drifted.append(name)
+        else:
+            missing.append(model)
+
+    unmanaged = [
+        name
+        for key, name in existing_keys.items()
+        if key not in wanted_keys and name != "_id_" and name not in drifted
+    ]
+    return missing, drifted, unmanaged
+
+
+def ensure_indexes(collection, dry_run=False):
+    missing, drifted, unmanaged = diff_indexes(
+        collection.index_information(), get_index_models()
+    )
+    if missing and not dry_run:
+        collection.create_indexes(missing)
+
+    return {
+        "created": [model.document["name"] for model in missing],
+        "drifted": drifted,
+        "unmanaged": unmanaged,
+        "backfilled": 0 if dry_run else backfill_normalized_fields(collection),
+    }
+
+
+def backfill_normalized_fields(collection):
+    # messages written before a normalized field existed don't have it, and
+    # only the strings can be normalized
+    count = 0
+    for field, (name, normalize) in NORMALIZED_FIELDS.items():
+        query = {field: {"$type": "string"}, name: {"$exists": False}}
+        while True:
+            cursor = collection.find(query, [field]).limit(BACKFILL_BATCH_SIZE)
+            requests = [
+                UpdateOne(
+                    {"_id": message["_id"]},
+                    {"$set": {name: normalize(message[field])}},
+                )
+                for message in cursor
+            ]
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+            count += len(requests)
+            if len(requests) < BACKFILL_BATCH_SIZE:
+                break
+    return count
+
+
+def ensure_indexes_in_background(collection):
+    def run():
+        try:
+            report = ensure_indexes(collection)
+            logger.info("Index sync finished: %s", report)
+        except Exception:
+            logger.exception("Index sync failed.")
+
+    thread = threading.Thread(target=run, name="ensure-indexes", daemon=True)
+    thread.start()
+    return thread
+
+
+def setup_commands(app, *, db):
+    @app.cli.command("ensure-indexes")
+    @click.option("--dry-run", is_flag=True, help="Only report what would change.")
+    def ensure_indexes_command(dry_run):
+        report = ensure_indexes(db.message, dry_run=dry_run)
+        click.echo(f"{'missing' if dry_run else 'created'}: {report['created']}")
+        click.echo(f"drifted: {report['drifted']}")
+        click.echo(f"unmanaged: {report['unmanaged']}")
+        click.echo(f"backfilled: {report['backfilled']}")
@@ -0,0 +1,1309 @@
+import asyncio
+import atexit
+import bisect
+import collections
+import datetime
+import functools
+import io
+import itertools
+import os
+import re
+import threading
+import unicodedata
+
+import bson
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    TEXT,
+    DeleteMany,
+    DeleteOne,
+    InsertOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+WORD_PATTERN = re.compile(r"\w+")
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+REGEX_FLAGS = {"i": re.I, "m": re.M, "s": re.S, "x": re.X}
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$eq"}
+TYPE_ORDER = {
+    type(None): 1,
+    int: 2,
+    float: 2,
+    str: 3,
+    dict: 4,
+    list: 5,
+    tuple: 5,
+    bytes: 6,
+    ObjectId: 7,
+    bool: 8,
+    datetime.datetime: 9,
+}
+# the $type aliases of the types documents are stored with
+TYPE_ALIASES = {
+    "null": [type(None)],
+    "int": [int],
+    "double": [float],
+    "string": [str],
+    "object": [dict],
+    "array": [list],
+    "binData": [bytes],
+    "objectId": [ObjectId],
+    "bool": [bool],
+    "date": [datetime.datetime],
+}
+STORES = {}
+STORES_LOCK = threading.Lock()
+GRIDFS_CHUNK_SIZE = 255 * 1024
+# like the oplog, only the latest changes can be resumed from
+CHANGE_LOG_SIZE = 10_000
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def sort_key(value):
+    # values of different types are ordered like the server orders BSON types
+    order = TYPE_ORDER.get(type(value))
+    if order is None:
+        order = next((o for t, o in TYPE_ORDER.items() if isinstance(value, t)), 10)
+    if order == 7:
+        # compares the same as the ObjectId, without its Python level methods
+        return (order, value.binary)
+    elif order in (4, 5, 10):
+        return (order, repr(value))
+    return (order, value)
+
+
+def is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and next(iter(value))[0] == "$"
+
+
+def has_path(doc, path):
+    for name in path.split("."):
+        if not isinstance(doc, dict) or name not in doc:
+            return False
+        doc = doc[name]
+    return True
+
+
+def get_path(doc, path):
+    for name in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(name)
+    return doc
+
+
+def get_values(doc, path):
+    # arrays match a condition when any of their elements does
+    value = get_path(doc, path)
+    return [value, *value] if isinstance(value, list) else [value]
+
+
+def equals(value, target):
+    return sort_key(value) == sort_key(target)
+
+
+def compare(op, value, target):
+    value, target = sort_key(value), sort_key(target)
+    if value[0] != target[0]:
+        return False
+    elif op == "$gt":
+        return value > target
+    elif op == "$gte":
+        return value >= target
+    elif op == "$lt":
+        return value < target
+    else:
+        return value <= target
+
+
+def compile_regex(pattern, options=""):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option in options:
+        flags |= REGEX_FLAGS.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def has_type(value, aliases):
+    aliases = aliases if isinstance(aliases, list) else [aliases]
+    try:
+        types = [t for alias in aliases for t in TYPE_ALIASES[alias]]
+    except KeyError as error:
+        raise OperationFailure(f"unknown type name alias: {error.args[0]}")
+    return type(value) in types
+
+
+def match_operators(doc, path, operators):
+    values = get_values(doc, path)
+    for op, target in operators.items():
+        if op == "$options":
+            continue
+        elif op == "$regex":
+            pattern = compile_regex(target, operators.get("$options", ""))
+            matched = any(isinstance(v, str) and pattern.search(v) for v in values)
+        elif op == "$eq":
+            matched = any(equals(v, target) for v in values)
+        elif op == "$ne":
+            matched = not any(equals(v, target) for v in values)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            matched = any(compare(op, v, target) for v in values)
+        elif op == "$in":
+            matched = any(equals(v, t) for v in values for t in target)
+        elif op == "$nin":
+            matched = not any(equals(v, t) for v in values for t in target)
+        elif op == "$exists":
+            matched = has_path(doc, path) == bool(target)
+        elif op == "$type":
+            # a missing field has no type, unlike a null one
+            matched = has_path(doc, path) and any(
+                has_type(value, target) for value in values
+            )
+        else:
+            raise OperationFailure(f"unknown operator: {op}")
+        if not matched:
+            return False
+    return True
+
+
+def matches(doc, query, match_text=None):
+    for key, condition in query.items():
+        if key == "$and":
+            matched = all(matches(doc, q, match_text) for q in condition)
+        elif key == "$or":
+            matched = any(matches(doc, q, match_text) for q in condition)
+        elif key == "$nor":
+            matched = not any(matches(doc, q, match_text) for q in condition)
+        elif key == "$text":
+            if match_text is None:
+                raise OperationFailure("text index required for $text query")
+            matched = match_text(doc, condition)
+        elif key[0] == "$":
+            raise OperationFailure(f"unknown top level operator: {key}")
+        elif is_operator_dict(condition):
+            matched = match_operators(doc, key, condition)
+        elif isinstance(condition, re.Pattern):
+            matched = match_operators(doc, key, {"$regex": condition})
+        else:
+            matched = any(equals(v, condition) for v in get_values(doc, key))
+        if not matched:
+            return False
+    return True
+
+
+def get_conjuncts(query):
+    # conditions every match must satisfy, which are the ones indexes can serve
+    for key, condition in query.items():
+        if key == "$and":
+            for subquery in condition:
+                yield from get_conjuncts(subquery)
+        else:
+            yield key, condition
+
+
+def normalize_sort(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    elif isinstance(key_or_list, str):
+        return [(key_or_list, direction or ASCENDING)]
+    elif isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(key, direction) for key, direction in key_or_list]
+
+
+def sort_documents(docs, sorting):
+    docs = list(docs)
+    if len({direction for _, direction in sorting}) == 1:
+        keys = [key for key, _ in sorting]
+        docs.sort(
+            key=lambda doc: [sort_key(get_path(doc, key)) for key in keys],
+            reverse=sorting[0][1] == DESCENDING,
+        )
+        return docs
+
+    for key, direction in reversed(sorting):
+        docs.sort(
+            key=lambda doc: sort_key(get_path(doc, key)),
+            reverse=direction == DESCENDING,
+        )
+    return docs
+
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {name: True for name in projection}
+
+    keep_id = bool(projection.get("_id", True))
+    included = {name for name, value in projection.items() if value} - {"_id"}
+    excluded = {name for name, value in projection.items() if not value}
+    if included and excluded - {"_id"}:
+        raise OperationFailure("Cannot mix inclusion and exclusion in a projection")
+
+    if included:
+        return {
+            name: value
+            for name, value in doc.items()
+            if name in included or (name == "_id" and keep_id)
+        }
+    return {name: value for name, value in doc.items() if name not in excluded}
+
+
+def fold_text(text, case_sensitive=False, diacritic_sensitive=False):
+    if not case_sensitive:
+        text = text.casefold()
+    if not diacritic_sensitive:
+        text = "".join(
+            char
+            for char in unicodedata.normalize("NFKD", text)
+            if not unicodedata.combining(char)
+        )
+    return text
+
+
+@functools.lru_cache(maxsize=256)
+def parse_text_search(search):
+    phrases = PHRASE_PATTERN.findall(search)
+    terms, negated_terms = [], []
+    for word in PHRASE_PATTERN.sub(" ", search).split():
+        if word[0] == "-":
+            negated_terms.extend(WORD_PATTERN.findall(word[1:]))
+        else:
+            terms.extend(WORD_PATTERN.findall(word))
+    return tuple(terms), tuple(phrases), tuple(negated_terms)
+
+
+def evaluate(expr, doc):
+    if isinstance(expr, str) and expr[:1] == "$":
+        return get_path(doc, expr[1:])
+    elif not is_operator_dict(expr):
+        return expr
+
+    [(op, args)] = expr.items()
+    if op == "$dateToString":
+        date = evaluate(args["date"], doc)
+        return date.strftime(args["format"]) if date is not None else None
+    elif op == "$substrCP":
+        text, start, length = [evaluate(arg, doc) for arg in args]
+        end = start + length
+        return (text or "")[start:end]
+    elif op == "$toLower":
+        return (evaluate(args, doc) or "").lower()
+    elif op == "$toUpper":
+        return (evaluate(args, doc) or "").upper()
+    raise OperationFailure(f"Unrecognized expression '{op}'")
+
+
+def accumulate(op, expr, docs):
+    values = [evaluate(expr, doc) for doc in docs]
+    if op == "$sum":
+        return sum(v for v in values if isinstance(v, (int, float)))
+    elif op == "$first":
+        return values[0]
+    elif op == "$last":
+        return values[-1]
+    elif op in ("$min", "$max"):
+        values = [v for v in values if v is not None]
+        pick = min if op == "$min" else max
+        return pick(values, key=sort_key) if values else None
+    elif op == "$push":
+        return values
+    raise OperationFailure(f"unknown group operator '{op}'")
+
+
+def apply_update(doc, update):
+    doc = dict(doc)
+    for op, fields in update.items():
+        if op == "$set":
+            doc.update(fields)
+        elif op == "$unset":
+            for name in fields:
+                doc.pop(name, None)
+        else:
+            raise OperationFailure(f"Unknown modifier: {op}")
+    return doc
+
+
+def group(docs, spec):
+    groups = {}
+    for doc in docs:
+        key = evaluate(spec["_id"], doc)
+        groups.setdefault(sort_key(key), (key, []))[1].append(doc)
+
+    results = []
+    for key, group_docs in groups.values():
+        result = {"_id": key}
+        for name, accumulator in spec.items():
+            if name != "_id":
+                [(op, expr)] = accumulator.items()
+                result[name] = accumulate(op, expr, group_docs)
+        results.append(result)
+    return results
+
+
+class SortedIndex:
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+        # entries are (key, _id) so equal keys are ordered by _id, like in
+        # the (field, _id) indexes the keyset pagination relies on
+        self.entries = []
+        self.keys = []
+        self.ids = []
+
+    def _get_entry(self, doc):
+        return (sort_key(get_path(doc, self.field)), sort_key(doc["_id"]))
+
+    def add(self, doc):
+        entry = self._get_entry(doc)
+        position = bisect.bisect_left(self.entries, entry)
+        self.entries.insert(position, entry)
+        self.keys.insert(position, entry[0])
+        self.ids.insert(position, doc["_id"])
+
+    def remove(self, doc):
+        position = bisect.bisect_left(self.entries, self._get_entry(doc))
+        del self.entries[position]
+        del self.keys[position]
+        del self.ids[position]
+
+    def get_bounds(self, condition):
+        if not is_operator_dict(condition):
+            condition = {"$eq": condition}
+        elif not set(condition) <= RANGE_OPERATORS:
+            return None
+
+        lower, upper = 0, len(self.keys)
+        for op, value in condition.items():
+            key = sort_key(value)
+            # comparisons never cross types, so ranges stop at the type's bounds
+            type_lower = bisect.bisect_left(self.keys, (key[0],))
+            type_upper = bisect.bisect_left(self.keys, (key[0] + 1,))
+            if op == "$gt":
+                bounds = (bisect.bisect_right(self.keys, key), type_upper)
+            elif op == "$gte":
+                bounds = (bisect.bisect_left(self.keys, key), type_upper)
+            elif op == "$lt":
+                bounds = (type_lower, bisect.bisect_left(self.keys, key))
+            elif op == "$lte":
+                bounds = (type_lower, bisect.bisect_right(self.keys, key))
+            else:
+                bounds = (
+                    bisect.bisect_left(self.keys, key),
+                    bisect.bisect_right(self.keys, key),
+                )
+            lower, upper = max(lower, bounds[0]), min(upper, bounds[1])
+        return lower, max(lower, upper)
+
+
+class TextIndex:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.postings = {}
+        self.tokens = {}
+
+    def get_text(self, doc):
+        return " ".join(
+            value
+            for value in (doc.get(field) for field in self.fields)
+            if isinstance(value, str)
+        )
+
+    def get_tokens(self, doc):
+        return set(WORD_PATTERN.findall(fold_text(self.get_text(doc))))
+
+    def add(self, doc):
+        tokens = self.tokens[doc["_id"]] = self.get_tokens(doc)
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(doc["_id"])
+
+    def remove(self, doc):
+        for token in self.tokens.pop(doc["_id"]):
+            ids = self.postings[token]
+            ids.discard(doc["_id"])
+            if not ids:
+                del self.postings[token]
+
+    def search(self, condition):
+        terms, phrases, _ = parse_text_search(condition.get("$search", ""))
+        if terms:
+            words = [fold_text(term) for term in terms]
+            return set().union(*[self.postings.get(word, ()) for word in words])
+        words = [
+            fold_text(word)
+            for phrase in phrases
+            for word in WORD_PATTERN.findall(phrase)
+        ]
+        if not words:
+            return set()
+        return set.intersection(*[self.postings.get(word, set()) for word in words])
+
+    def matches(self, doc, condition):
+        case_sensitive = condition.get("$caseSensitive", False)
+        diacritic_sensitive = condition.get("$diacriticSensitive", False)
+        search = condition.get("$search", "")
+        terms, phrases, negated_terms = parse_text_search(search)
+        if case_sensitive or diacritic_sensitive or phrases:
+            text = fold_text(self.get_text(doc), case_sensitive, diacritic_sensitive)
+            words = set(WORD_PATTERN.findall(text))
+        else:
+            # the usual search only needs the tokens kept for the postings
+            words = self.tokens.get(doc.get("_id")) or self.get_tokens(doc)
+
+        def fold(text):
+            return fold_text(text, case_sensitive, diacritic_sensitive)
+
+        if terms and not any(fold(term) in words for term in terms):
+            return False
+        if not all(fold(phrase) in text for phrase in phrases):
+            return False
+        return not any(fold(term) in words for term in negated_terms)
+
+
+def format_resume_token(sequence):
+    return {"_data": f"{sequence:016X}"}
+
+
+def parse_resume_token(token):
+    try:
+        return int(token["_data"], 16)
+    except (KeyError, TypeError, ValueError):
+        raise OperationFailure("Invalid resume token", CHANGE_STREAM_HISTORY_LOST)
+
+
+def get_update_description(doc, new_doc):
+    return {
+        "updatedFields": {
+            key: value
+            for key, value in new_doc.items()
+            if key not in doc or not equals(doc[key], value)
+        },
+        "removedFields": [key for key in doc if key not in new_doc],
+    }
+
+
+class ChangeLog:
+    def __init__(self, collection_name, size=CHANGE_LOG_SIZE):
+        self.collection_name = collection_name
+        self.events = collections.deque(maxlen=size)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        # the events of the async streams waiting, with their loops
+        self.async_waiters = set()
+
+    def append(self, operation, doc, **fields):
+        with self.condition:
+            self.sequence += 1
+            event = {
+                "_id": format_resume_token(self.sequence),
+                "operationType": operation,
+                "wallTime": datetime.datetime.now(datetime.timezone.utc),
+                "ns": {"coll": self.collection_name},
+                "documentKey": {"_id": doc["_id"]},
+                **fields,
+            }
+            self.events.append((self.sequence, event))
+            self.condition.notify_all()
+            async_waiters = list(self.async_waiters)
+        for loop, waiter in async_waiters:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                pass  # the loop is closed
+
+    def get_position(self, resume_after):
+        with self.condition:
+            if resume_after is None:
+                return self.sequence
+            position = parse_resume_token(resume_after)
+            if position > self.sequence:
+                raise OperationFailure(
+                    "Invalid resume token", CHANGE_STREAM_HISTORY_LOST
+                )
+            self.check_position(position)
+            return position
+
+    def check_position(self, position):
+        oldest = self.events[0][0] if self.events else self.sequence + 1
+        if position < oldest - 1:
+            raise OperationFailure(
+                "Resume of change stream was not possible, as the resume point "
+                "may no longer be in the oplog.",
+                CHANGE_STREAM_HISTORY_LOST,
+            )
+
+    def get_events(self, position, timeout):
+        # waits for events after position, up to timeout
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > position, timeout)
+            self.check_position(position)
+            return [e for e in self.events if e[0] > position]
+
+    async def get_events_async(self, position, timeout):
+        # waits on the event loop, so idle streams don't hold a thread each
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            self.async_waiters.add(waiter)
+            ready = self.sequence > position
+        try:
+            if not ready:
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+        with self.condition:
+            self.check_position(position)
+            return [e for e in self.events if e[0] > position]
+
+
+class MemoryChangeStream:
+    # the subset of pymongo's ChangeStream the app uses, for $match pipelines
+    def __init__(
+        self,
+        collection,
+        pipeline=None,
+        full_document=None,
+        resume_after=None,
+        max_await_time_ms=None,
+    ):
+        match = {}
+        for stage in pipeline or []:
+            [(name, spec)] = stage.items()
+            if name != "$match":
+                raise OperationFailure(f"{name} is not supported in change streams")
+            match = {"$and": [match, spec]}
+        self._match = match
+        self._log = collection._changes
+        self._full_document = full_document
+        self._timeout = (max_await_time_ms or 1000) / 1000
+        self._position = self._log.get_position(resume_after)
+        self._pending = collections.deque()
+        self.resume_token = resume_after
+        self.alive = True
+
+    def _format(self, event):
+        lookup = self._full_document == "updateLookup"
+        if event["operationType"] == "update" and not lookup:
+            event = {k: v for k, v in event.items() if k != "fullDocument"}
+        return bson.decode(bson.encode(event))
+
+    def try_next(self):
+        if not self.alive:
+            raise StopIteration
+        if not self._pending:
+            self._add_events(self._log.get_events(self._position, self._timeout))
+        return self._next_match()
+
+    async def try_next_async(self):
+        if not self.alive:
+            raise StopAsyncIteration
+        if not self._pending:
+            events = await self._log.get_events_async(self._position, self._timeout)
+            self._add_events(events)
+        return self._next_match()
+
+    def _add_events(self, events):
+        if events:
+            self._position = events[-1][0]
+        self._pending.extend(event for _, event in events)
+
+    def _next_match(self):
+        while self._pending:
+            event = self._pending.popleft()
+            self.resume_token = event["_id"]
+            if matches(event, self._match):
+                return self._format(event)
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            change = self.try_next()
+            if change is not None:
+                return change
+
+    def close(self):
+        self.alive = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryCursor:
+    def __init__(self, collection, filter=None, projection=None, sort=None, limit=0):
+        self._collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = normalize_sort(sort)
+        self._limit = limit
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            docs, _ = self._collection._find(self._filter, self._sort, self._limit)
+            self._results = iter([project(doc, self._projection) for doc in docs])
+        return next(self._results)
+
+    def explain(self):
+        docs, plan = self._collection._find(self._filter, self._sort, self._limit)
+        return {
+            "queryPlanner": {"winningPlan": plan["winning_plan"]},
+            "executionStats": {
+                "nReturned": len(docs),
+                "totalKeysExamined": plan["keys_examined"],
+                "totalDocsExamined": plan["docs_examined"],
+            },
+        }
+
+
+class MemoryCollection:
+    def __init__(self, name, lock):
+        self.name = name
+        self._lock = lock
+        self._documents = {}
+        self._indexes = {}
+        self._index_specs = {}
+        self._text_index = None
+        self._changes = ChangeLog(name)
+
+    def _match_text(self, doc, condition):
+        if self._text_index is None:
+            raise OperationFailure("text index required for $text query")
+        return self._text_index.matches(doc, condition)
+
+    def _get_indexes(self):
+        return [*self._indexes.values(), *filter(None, [self._text_index])]
+
+    def _get_sort_index(self, sorting):
+        # indexes are ordered by (field, _id), so they serve that sort directly
+        directions = {direction for _, direction in sorting}
+        if (
+            sorting
+            and len(directions) == 1
+            and [key for key, _ in sorting[1:]] in ([], ["_id"])
+        ):
+            return self._indexes.get(sorting[0][0])
+
+    def _plan(self, query, sorting, limit):
+        # returns the candidate ids, the plan and whether they're already sorted
+        conjuncts = list(get_conjuncts(query))
+        for key, condition in conjuncts:
+            if key == "$text":
+                if self._text_index is None:
+                    raise OperationFailure("text index required for $text query")
+                ids = self._text_index.search(condition)
+                plan = {"stage": "TEXT", "indexName": self._text_index.name}
+                return list(ids), plan, not sorting
+        for key, condition in conjuncts:
+            if key != "_id":
+                continue
+            if not is_operator_dict(condition):
+                return [condition], {"stage": "IDHACK"}, not sorting
+            if set(condition) == {"$in"}:
+                ids = list(dict.fromkeys(condition["$in"]))
+                return ids, {"stage": "IDHACK"}, not sorting
+
+        bounds = {}
+        for key, condition in conjuncts:
+            index = self._indexes.get(key)
+            index_bounds = index and index.get_bounds(condition)
+            if index_bounds:
+                lower, upper = bounds.get(key, (0, len(index.ids)))
+                lower = max(lower, index_bounds[0])
+                bounds[key] = (lower, max(lower, min(upper, index_bounds[1])))
+
+        sort_index = self._get_sort_index(sorting)
+        best = min(
+            bounds, key=lambda key: bounds[key][1] - bounds[key][0], default=None
+        )
+        if sort_index is not None and best != sort_index.field:
+            size = len(self._documents)
+            range_size = bounds[best][1] - bounds[best][0] if best else size
+            # walking the sort index examines about limit * size / range_size
+            # documents before the limit is reached, sorting examines range_size
+            if best is None or (limit and limit * size < range_size**2):
+                best = sort_index.field
+                bounds.setdefault(best, (0, len(sort_index.ids)))
+        if best is None:
+            return iter(self._documents), {"stage": "COLLSCAN"}, not sorting
+
+        index = self._indexes[best]
+        lower, upper = bounds[best]
+        positions = range(lower, upper)
+        if index is sort_index and sorting[0][1] == DESCENDING:
+            positions = reversed(positions)
+        ids = (index.ids[position] for position in positions)
+        ordered = index is sort_index or not sorting
+        return ids, {"stage": "IXSCAN", "indexName": index.name}, ordered
+
+    def _find(self, query, sorting=(), limit=0):
+        with self._lock:
+            ids, winning_plan, ordered = self._plan(query, sorting, limit)
+            docs, keys_examined, docs_examined = [], 0, 0
+            for id in ids:
+                keys_examined += 1
+                doc = self._documents.get(id)
+                if doc is None:
+                    continue
+                docs_examined += 1
+                if matches(doc, query, self._match_text):
+                    docs.append(doc)
+                    if ordered and limit and len(docs) == limit:
+                        break
+
+        if not ordered and sorting:
+            docs = sort_documents(docs, sorting)
+        if limit:
+            docs = docs[:limit]
+        plan = {
+            "winning_plan": winning_plan,
+            "keys_examined": (
+                0 if winning_plan["stage"] == "COLLSCAN" else keys_examined
+            ),
+            "docs_examined": docs_examined,
+        }
+        return docs, plan
+
+    def _index(self, doc):
+        for index in self._get_indexes():
+            index.add(doc)
+
+    def _unindex(self, doc):
+        for index in self._get_indexes():
+            index.remove(doc)
+
+    def _insert(self, document):
+        document.setdefault("_id", ObjectId())
+        # stores what the server would, e.g. datetimes truncated to milliseconds
+        doc = bson.decode(bson.encode(document))
+        with self._lock:
+            if doc["_id"] in self._documents:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} "
+                    f"dup key: {{ _id: {doc['_id']!r} }}",
+                    11000,
+                )
+            self._documents[doc["_id"]] = doc
+            self._index(doc)
+            self._changes.append("insert", doc, fullDocument=doc)
+        return doc["_id"]
+
+    def find(self, filter=None, projection=None, sort=None, limit=0):
+        return MemoryCursor(self, filter, projection, sort, limit)
+
+    def find_one(self, filter=None, projection=None):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        return next(self.find(filter, projection, limit=1), None)
+
+    def count_documents(self, filter, limit=0):
+        docs, _ = self._find(filter, limit=limit)
+        return len(docs)
+
+    def estimated_document_count(self):
+        return len(self._documents)
+
+    def insert_one(self, document):
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True):
+        inserted_ids, write_errors = [], []
+        for i, document in enumerate(documents):
+            try:
+                inserted_ids.append(self._insert(document))
+            except DuplicateKeyError as e:
+                write_errors.append({"index": i, "code": e.code, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError(
+                {
+                    "writeErrors": write_errors,
+                    "writeConcernErrors": [],
+                    "nInserted": len(inserted_ids),
+                    "nUpserted": 0,
+                    "nMatched": 0,
+                    "nModified": 0,
+                    "nRemoved": 0,
+                    "upserted": [],
+                }
+            )
+        return InsertManyResult(inserted_ids, True)
+
+    def _write(self, request, result):
+        # pymongo keeps the arguments of the operations private
+        if isinstance(request, InsertOne):
+            self._insert(request._doc)
+            result["nInserted"] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany)):
+            limit = 1 if isinstance(request, UpdateOne) else 0
+            docs, _, modified = self._update(request._filter, request._doc, limit)
+            result["nMatched"] += len(docs)
+            result["nModified"] += modified
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            limit = 1 if isinstance(request, DeleteOne) else 0
+            result["nRemoved"] += len(self._delete(request._filter, limit))
+        else:
+            raise TypeError(f"{request!r} is not a supported write operation")
+
+    def bulk_write(self, requests, ordered=True):
+        result = {
+            "writeErrors": [],
+            "writeConcernErrors": [],
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+        for i, request in enumerate(requests):
+            try:
+                self._write(request, result)
+            except DuplicateKeyError as e:
+                result["writeErrors"].append(
+                    {"index": i, "code": e.code, "errmsg": str(e)}
+                )
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _update(self, filter, update, limit, sort=None):
+        if not is_operator_dict(update):
+            raise ValueError("update only works with $ operators")
+        update = bson.decode(bson.encode(update))
+
+        with self._lock:
+            docs, _ = self._find(filter, normalize_sort(sort), limit)
+            new_docs, modified = [], 0
+            for doc in docs:
+                new_doc = apply_update(doc, update)
+                if new_doc != doc:
+                    self._unindex(doc)
+                    self._documents[doc["_id"]] = new_doc
+                    self._index(new_doc)
+                    self._changes.append(
+                        "update",
+                        new_doc,
+                        updateDescription=get_update_description(doc, new_doc),
+                        fullDocument=new_doc,
+                    )
+                    modified += 1
+                new_docs.append(new_doc)
+        return docs, new_docs, modified
+
+    def update_one(self, filter, update):
+        docs, _, modified = self._update(filter, update, limit=1)
+        return UpdateResult({"n": len(docs), "nModified": modified, "ok": 1.0}, True)
+
+    def update_many(self, filter, update):
+        docs, _, modified = self._update(filter, update, limit=0)
+        return UpdateResult({"n": len(docs), "nModified": modified, "ok": 1.0}, True)
+
+    def find_one_and_update(
+        self, filter, update, projection=None, sort=None, return_document=False
+    ):
+        docs, new_docs, _ = self._update(filter, update, limit=1, sort=sort)
+        docs = new_docs if return_document else docs
+        return project(docs[0], projection) if docs else None
+
+    def _delete(self, filter, limit, sort=None):
+        with self._lock:
+            docs, _ = self._find(filter, normalize_sort(sort), limit)
+            for doc in docs:
+                self._unindex(doc)
+                del self._documents[doc["_id"]]
+                self._changes.append("delete", doc)
+        return docs
+
+    def delete_one(self, filter):
+        docs = self._delete(filter, limit=1)
+        return DeleteResult({"n": len(docs), "ok": 1.0}, True)
+
+    def delete_many(self, filter):
+        docs = self._delete(filter, limit=0)
+        return DeleteResult({"n": len(docs), "ok": 1.0}, True)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None):
+        docs = self._delete(filter, limit=1, sort=sort)
+        return project(docs[0], projection) if docs else None
+
+    def aggregate(self, pipeline):
+        if pipeline and "$match" in pipeline[0]:
+            docs, _ = self._find(pipeline[0]["$match"])
+            pipeline = pipeline[1:]
+        else:
+            with self._lock:
+                docs = list(self._documents.values())
+        return iter(self._run_pipeline(pipeline, docs))
+
+    def _run_pipeline(self, pipeline, docs):
+        for stage in pipeline:
+            [(name, spec)] = stage.items()
+            if name == "$match":
+                docs = [doc for doc in docs if matches(doc, spec, self._match_text)]
+            elif name == "$sort":
+                docs = sort_documents(docs, normalize_sort(spec))
+            elif name == "$limit":
+                docs = docs[:spec]
+            elif name == "$skip":
+                docs = docs[spec:]
+            elif name == "$project":
+                docs = [project(doc, spec) for doc in docs]
+            elif name == "$group":
+                docs = group(docs, spec)
+            elif name == "$count":
+                docs = [{spec: len(docs)}] if docs else []
+            elif name == "$facet":
+                docs = [
+                    {
+                        facet: self._run_pipeline(subpipeline, docs)
+                        for facet, subpipeline in spec.items()
+                    }
+                ]
+            else:
+                raise OperationFailure(f"Unrecognized pipeline stage name: '{name}'")
+        return [dict(doc) for doc in docs]
+
+    def watch(self, pipeline=None, **kwargs):
+        return MemoryChangeStream(self, pipeline, **kwargs)
+
+    def create_indexes(self, models):
+        return [self.create_index(model.document) for model in models]
+
+    def create_index(self, spec):
+        keys = list(dict(spec["key"]).items())
+        name = spec.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+        with self._lock:
+            text_fields = [field for field, direction in keys if direction == TEXT]
+            if text_fields:
+                index = TextIndex(name, text_fields)
+                self._text_index = index
+            else:
+                index = SortedIndex(name, keys[0][0])
+                self._indexes[index.field] = index
+            for doc in self._documents.values():
+                index.add(doc)
+            self._index_specs[name] = {**spec, "key": keys, "name": name}
+        return name
+
+    def index_information(self):
+        information = {"_id_": {"key": [("_id", ASCENDING)]}}
+        for name, spec in self._index_specs.items():
+            text_fields = [field for field, kind in spec["key"] if kind == TEXT]
+            if text_fields:
+                # reported the way the server stores text indexes
+                information[name] = {
+                    "key": [("_fts", TEXT), ("_ftsx", 1)],
+                    "weights": {field: 1 for field in text_fields},
+                }
+            else:
+                information[name] = {"key": spec["key"]}
+        return information
+
+
+class MemoryDatabase:
+    def __init__(self, name, lock):
+        self.name = name
+        self._lock = lock
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(name, self._lock)
+            return self._collections[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+
+class MemoryGridOut(io.BytesIO):
+    def __init__(self, file, data):
+        super().__init__(data)
+        self._id = file["_id"]
+        self.length = file["length"]
+        self.upload_date = file["uploadDate"]
+        self.filename = file.get("filename")
+        self.metadata = file.get("metadata")
+
+
+class MemoryGridFSBucket:
+    # the GridFS layout, so snapshots keep files like any other collection
+    def __init__(self, db, bucket_name="fs", chunk_size_bytes=GRIDFS_CHUNK_SIZE):
+        self._files = db[f"{bucket_name}.files"]
+        self._chunks = db[f"{bucket_name}.chunks"]
+        self._chunk_size = chunk_size_bytes
+        if "files_id_1_n_1" not in self._chunks.index_information():
+            self._chunks.create_index({"key": [("files_id", ASCENDING), ("n", 1)]})
+
+    def upload_from_stream(
+        self, filename, source, chunk_size_bytes=None, metadata=None
+    ):
+        data = source if isinstance(source, bytes) else source.read()
+        chunk_size = chunk_size_bytes or self._chunk_size
+        file_id = ObjectId()
+        chunks = []
+        for n, start in enumerate(range(0, len(data), chunk_size)):
+            end = start + chunk_size
+            chunks.append({"files_id": file_id, "n": n, "data": data[start:end]})
+        if chunks:
+            self._chunks.insert_many(chunks)
+        file = {
+            "_id": file_id,
+            "length": len(data),
+            "chunkSize": chunk_size,
+            "uploadDate": datetime.datetime.now(datetime.timezone.utc),
+            "filename": filename,
+        }
+        if metadata is not None:
+            file["metadata"] = metadata
+        self._files.insert_one(file)
+        return file_id
+
+    def open_download_stream(self, file_id):
+        file = self._files.find_one(file_id)
+        if file is None:
+            raise NoFile(f"no file in gridfs with _id {file_id!r}")
+        chunks = self._chunks.find({"files_id": file_id}, sort=[("n", ASCENDING)])
+        return MemoryGridOut(file, b"".join(chunk["data"] for chunk in chunks))
+
+    def delete(self, file_id):
+        res = self._files.delete_one({"_id": file_id})
+        self._chunks.delete_many({"files_id": file_id})
+        if not res.deleted_count:
+            raise NoFile(f"no file in gridfs with _id {file_id!r}")
+
+
+class MemoryStore:
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._lock = threading.RLock()
+        self._databases = {}
+        if snapshot_path:
+            self.load_snapshot()
+            atexit.register(self.snapshot)
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(name, self._lock)
+            return self._databases[name]
+
+    def snapshot(self):
+        # written to a temporary file first so a crash never leaves half a snapshot
+        temp_path = f"{self.snapshot_path}.tmp"
+        with self._lock, open(temp_path, "wb") as f:
+            for db in self._databases.values():
+                for collection in db._collections.values():
+                    location = {"db": db.name, "collection": collection.name}
+                    for spec in collection._index_specs.values():
+                        f.write(bson.encode({**location, "index": spec}))
+                    for doc in collection._documents.values():
+                        f.write(bson.encode({**location, "document": doc}))
+        os.replace(temp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                for record in bson.decode_file_iter(f):
+                    collection = self[record["db"]][record["collection"]]
+                    if "index" in record:
+                        collection.create_index(record["index"])
+                    else:
+                        collection._insert(record["document"])
+        except FileNotFoundError:
+            pass
+
+
+def get_store(snapshot_path=None):
+    # clients of the same process share their data, like clients of a server
+    with STORES_LOCK:
+        if snapshot_path not in STORES:
+            STORES[snapshot_path] = MemoryStore(snapshot_path)
+        return STORES[snapshot_path]
+
+
+class MemoryClient:
+    def __init__(self, snapshot_path=None):
+        self._store = get_store(snapshot_path)
+
+    def __getitem__(self, name):
+        return self._store[name]
+
+    def close(self):
+        if self._store.snapshot_path:
+            self._store.snapshot()
+
+
+class AsyncMemoryCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, key_or_list, direction=None):
+        self._cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._cursor.limit(limit)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def explain(self):
+        return self._cursor.explain()
+
+    async def to_list(self, length=None):
+        return list(itertools.islice(self._cursor, length))
+
+
+class AsyncMemoryChangeStream:
+    def __init__(self, stream):
+        self._stream = stream
+
+    @property
+    def alive(self):
+        return self._stream.alive
+
+    @property
+    def resume_token(self):
+        return self._stream.resume_token
+
+    async def try_next(self):
+        return await self._stream.try_next_async()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            change = await self.try_next()
+            if change is not None:
+                return change
+
+    async def close(self):
+        self._stream.close()
+
+
+class AsyncMemoryCollection:
+    # operations never block on I/O, so they just run on the event loop
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return self._collection.find_one(*args, **kwargs)
+
+    async def aggregate(self, pipeline):
+        return AsyncMemoryCursor(self._collection.aggregate(pipeline))
+
+    async def watch(self, *args, **kwargs):
+        return AsyncMemoryChangeStream(self._collection.watch(*args, **kwargs))
+
+
+class AsyncMemoryDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self._db[name])
+
+
+class AsyncMemoryGridOut:
+    def __init__(self, grid_out):
+        self._grid_out = grid_out
+        self._id = grid_out._id
+        self.length = grid_out.length
+
+    async def read(self, size=-1):
+        return self._grid_out.read(size)
+
+    async def seek(self, pos, whence=io.SEEK_SET):
+        return self._grid_out.seek(pos, whence)
+
+    async def close(self):
+        self._grid_out.close()
+
+
+class AsyncMemoryGridFSBucket:
+    def __init__(self, db, bucket_name="fs"):
+        self._bucket = MemoryGridFSBucket(db._db, bucket_name)
+
+    async def upload_from_stream(self, *args, **kwargs):
+        return self._bucket.upload_from_stream(*args, **kwargs)
+
+    async def open_download_stream(self, file_id):
+        return AsyncMemoryGridOut(self._bucket.open_download_stream(file_id))
+
+    async def delete(self, file_id):
+        self._bucket.delete(file_id)
+
+
+class AsyncMemoryClient:
+    def __init__(self, client):
+        self._client = client
+
+    def __getitem__(self, name):
+        return AsyncMemoryDatabase(self._client[name])
+
+    async def close(self):
+        self._client.close()
@@ -0,0 +1,211 @@
+import bisect
+import threading
+import time
+
+import flask
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DOCUMENT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10_000)
+
+REGISTRY = []
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(labels):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def get_label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in values.items():
+            yield from self.collect_sample(zip(self.labelnames, label_values), value)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        label_values = self.get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect_sample(self, labels, value):
+        yield f"{self.name}{format_labels(list(labels))} {value}"
+
+
+class CallbackCounter(Metric):
+    # reads a value something else already counts, e.g. a cache's statistics
+    type = "counter"
+
+    def __init__(self, name, documentation, callback, registry=REGISTRY):
+        super().__init__(name, documentation, registry=registry)
+        self.callback = callback
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield f"{self.name} {self.callback()}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        buckets=LATENCY_BUCKETS,
+        registry=REGISTRY,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        label_values = self.get_label_values(labels)
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts, _, _ = sample = self._values[label_values]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def collect_sample(self, labels, value):
+        labels = list(labels)
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+            cumulative += bucket_count
+            le = format_labels([*labels, ("le", bound)])
+            yield f"{self.name}_bucket{le} {cumulative}"
+        yield f"{self.name}_sum{format_labels(labels)} {total}"
+        yield f"{self.name}_count{format_labels(labels)} {count}"
+
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["method", "route", "status"],
+)
+COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "Duration of MongoDB commands as measured by the driver.",
+    ["command", "status"],
+)
+CHECKOUT_WAIT = Histogram(
+    "mongodb_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool.",
+    ["status"],
+)
+DOCUMENTS_RETURNED = Histogram(
+    "mongodb_documents_returned",
+    "Number of documents returned per query.",
+    ["operation"],
+    buckets=DOCUMENT_BUCKETS,
+)
+
+
+def generate_latest(registry=REGISTRY):
+    return "\n".join(line for metric in registry for line in metric.collect()) + "\n"
+
+
+class CommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        COMMAND_DURATION.observe(
+            event.duration_micros / 1e6, command=event.command_name, status="ok"
+        )
+
+    def failed(self, event):
+        COMMAND_DURATION.observe(
+            event.duration_micros / 1e6, command=event.command_name, status="failed"
+        )
+
+
+class ConnectionPoolListener(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event):
+        CHECKOUT_WAIT.observe(event.duration, status="ok")
+
+    def connection_check_out_failed(self, event):
+        CHECKOUT_WAIT.observe(event.duration, status="failed")
+
+    # the remaining pool events aren't measured
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def get_event_listeners():
+    return [CommandListener(), ConnectionPoolListener()]
+
+
+def setup_metrics(app, *, request=flask.request):
+    # request is the framework's request proxy, so this works for Quart too
+    @app.before_request
+    def start_timer():
+        request.start_time = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start_time = getattr(request, "start_time", None)
+        if start_time is not None:
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start_time,
+                method=request.method,
+                route=request.url_rule.rule if request.url_rule else "unmatched",
+                status=response.status_code,
+            )
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return generate_latest(), 200, {"Content-Type": CONTENT_TYPE}
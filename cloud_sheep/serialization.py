@@ -0,0 +1,57 @@
+import datetime
+import functools
+import json
+import os
+
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = tuple("Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split())
+
+
+@functools.lru_cache(maxsize=1024)
+def format_http_day(day):
+    weekday, month = WEEKDAYS[day.weekday()], MONTHS[day.month - 1]
+    return f"{weekday}, {day.day:02d} {month} {day.year}"
+
+
+def format_http_date(value):
+    # what werkzeug's http_date returns, in a third of the time since the
+    # messages of a listing mostly share their days
+    if not isinstance(value, datetime.datetime):
+        return f"{format_http_day(value)} 00:00:00 GMT"
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return f"{format_http_day(value.date())} {value.time().isoformat('seconds')} GMT"
+
+
+def default(obj):
+    # the same representations Flask's encoder used, plus ObjectIds as strings
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    elif isinstance(obj, (datetime.datetime, datetime.date)):
+        return format_http_date(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_orjson(obj):
+    return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def dumps_stdlib(obj):
+    return json.dumps(obj, default=default, separators=(",", ":")).encode()
+
+
+JSON_BACKENDS = {"orjson": dumps_orjson, "stdlib": dumps_stdlib}
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "orjson" if orjson else "stdlib")
+dumps = JSON_BACKENDS[JSON_BACKEND]
+
+
+def json_response(obj, status=200, *, response_class):
+    return response_class(dumps(obj), status=status, mimetype=JSON_MIMETYPE)
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import datetime
+import hmac
+import logging
+import os
+import random
+import threading
+import time
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+EXPLAIN_SAMPLE_RATE = float(os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 1))
+MAX_SLOW_QUERIES = int(os.environ.get("SLOW_QUERY_LOG_SIZE", 100))
+MAX_PENDING_EXPLAINS = 4
+# the log shows filters and plans, so /admin/slow-queries is only served to
+# requests with "Authorization: Bearer <token>", and not at all without a token
+ADMIN_TOKEN = os.environ.get("SLOW_QUERY_LOG_TOKEN")
+
+
+def normalize_filter(query):
+    # keeps the operators and fields, so queries with the same shape look the same
+    if isinstance(query, dict):
+        return {key: normalize_filter(value) for key, value in query.items()}
+    elif isinstance(query, list):
+        return [normalize_filter(value) for value in query]
+    else:
+        return "?"
+
+
+def summarize_explain(explanation):
+    plan = explanation["queryPlanner"]["winningPlan"]
+    # the slot based engine nests the classic plan under "queryPlan"
+    plan = plan.get("queryPlan", plan)
+    stages, indexes = [], []
+    while plan:
+        stages.append(plan["stage"])
+        if "indexName" in plan:
+            indexes.append(plan["indexName"])
+        input_stages = plan.get("inputStages") or [None]
+        plan = plan.get("inputStage") or input_stages[0]
+
+    stats = explanation.get("executionStats", {})
+    return {
+        "stages": stages,
+        "indexes": indexes,
+        "collection_scan": "COLLSCAN" in stages,
+        "returned": stats.get("nReturned"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+    }
+
+
+def is_authorized(headers, token):
+    if not token:
+        return False
+    scheme, _, credentials = headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        credentials.encode(), token.encode()
+    )
+
+
+class TimedCursor:
+    # counts the time spent getting documents, not the time a client takes
+    # to read the ones streamed to it
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.seconds = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_time = time.perf_counter()
+        try:
+            return next(self.cursor)
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        start_time = time.perf_counter()
+        try:
+            return await self.cursor.__anext__()
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms, sample_rate, size):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.entries = collections.deque(maxlen=size)
+        self._pending_explains = threading.BoundedSemaphore(MAX_PENDING_EXPLAINS)
+
+    def record(self, find_query, seconds):
+        # returns the entry when its plan should be explained
+        duration_ms = seconds * 1000
+        if duration_ms < self.threshold_ms:
+            return None
+
+        entry = {
+            "filter": normalize_filter(find_query["filter"]),
+            "sort": [list(param) for param in find_query["sort"]],
+            "limit": find_query["limit"],
+            "duration_ms": round(duration_ms, 3),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "plan": None,
+        }
+        logger.warning(
+            "Slow query (%.1f ms): filter=%s sort=%s",
+            duration_ms,
+            entry["filter"],
+            entry["sort"],
+        )
+        self.entries.append(entry)
+        if random.random() < self.sample_rate:
+            return entry
+
+    def explain(self, entry, explain):
+        try:
+            entry["plan"] = summarize_explain(explain())
+        except Exception:
+            logger.exception("Couldn't explain a slow query.")
+
+    def observe(self, find_query, seconds, explain):
+        # explain runs the query again, so it's done off the request thread
+        entry = self.record(find_query, seconds)
+        if entry is None or not self._pending_explains.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.explain(entry, explain)
+            finally:
+                self._pending_explains.release()
+
+        threading.Thread(target=run, name="explain", daemon=True).start()
+
+    def observe_async(self, find_query, seconds, explain):
+        entry = self.record(find_query, seconds)
+        if entry is None or not self._pending_explains.acquire(blocking=False):
+            return
+
+        async def run():
+            try:
+                entry["plan"] = summarize_explain(await explain())
+            except Exception:
+                logger.exception("Couldn't explain a slow query.")
+            finally:
+                self._pending_explains.release()
+
+        asyncio.ensure_future(run())
+
+    def get_entries(self, collection_scans=False):
+        entries = list(reversed(self.entries))
+        if collection_scans:
+            return [e for e in entries if (e["plan"] or {}).get("collection_scan")]
+        return entries
+
+
+SLOW_QUERY_LOG = SlowQueryLog(SLOW_QUERY_MS, EXPLAIN_SAMPLE_RATE, MAX_SLOW_QUERIES)
+
+
+def setup_slow_query_log(app, *, request=flask.request):
+    @app.route("/admin/slow-queries")
+    def slow_queries():
+        if not ADMIN_TOKEN:
+            return {"message": "Not Found", "error": "NotFound"}, 404
+        elif not is_authorized(request.headers, ADMIN_TOKEN):
+            headers = {"WWW-Authenticate": "Bearer"}
+            return {"message": "Unauthorized", "error": "Unauthorized"}, 401, headers
+        collection_scans = request.args.get("collection_scans", "").lower()
+        entries = SLOW_QUERY_LOG.get_entries(collection_scans in ["true", "1"])
+        return {
+            "threshold_ms": SLOW_QUERY_LOG.threshold_ms,
+            "sample_rate": SLOW_QUERY_LOG.sample_rate,
+            "queries": entries,
+        }
@@ -0,0 +1,195 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from bson.objectid import ObjectId
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import TooManyRequests
+
+from . import app, db
+from .admission import (
+    BULK_WRITES,
+    RATE_LIMITER,
+    ConcurrencyLimit,
+    RateLimiter,
+    TokenBucket,
+    estimate_cost,
+    get_body_length,
+    get_forwarded_address,
+    is_enabled,
+)
+from .asgi import app as async_app
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setenv("ADMISSION_CONTROL", "true")
+    monkeypatch.setattr(RATE_LIMITER, "limits", {"read": (1, 2), "scan": (1, 5)})
+    RATE_LIMITER.buckets.clear()
+    yield RATE_LIMITER.limits
+    RATE_LIMITER.buckets.clear()
+
+
+def test_token_bucket_refills_over_time():
+    bucket = TokenBucket(rate=2, burst=4, now=0)
+
+    assert bucket.take(3, now=0) == 0
+    assert bucket.take(3, now=0) == 1
+    assert bucket.take(3, now=1) == 0
+    # costs above the burst only need a full bucket
+    assert bucket.take(10, now=3) == 0
+
+
+def test_rate_limiter_keeps_clients_apart():
+    limiter = RateLimiter({"read": (1, 1)}, max_clients=2)
+
+    limiter.admit("a", "read", 1)
+    limiter.admit("b", "read", 1)
+    with pytest.raises(TooManyRequests) as error:
+        limiter.admit("a", "read", 1)
+    assert error.value.retry_after == 1
+    limiter.admit("a", "write", 100)  # classes without a limit are free
+
+    limiter.admit("c", "read", 1)
+    assert list(limiter.buckets) == [("a", "read"), ("c", "read")]
+
+
+def test_concurrency_limit():
+    limit = ConcurrencyLimit(1, "bulk_write")
+
+    with limit:
+        with pytest.raises(TooManyRequests):
+            with limit:
+                pass
+    with limit:
+        pass
+
+
+@pytest.mark.parametrize(
+    "endpoint,method,view_args,args,content_length,expected",
+    [
+        ("get_message", "GET", {"id": "1"}, {}, None, ("read", 1)),
+        ("get_message", "DELETE", {"id": "1"}, {}, None, ("write", 1)),
+        ("get_message", "POST", {}, {}, 200 * 1024, ("write", 4)),
+        ("import_messages", "POST", {}, {}, None, ("bulk_write", 1)),
+        ("bulk_messages", "POST", {}, {}, 100 * 1024, ("bulk_write", 2)),
+        ("get_message", "GET", {}, {"limit": "20"}, None, ("read", 1)),
+        ("get_message", "GET", {}, {}, None, ("read", 10)),
+        (
+            "get_message",
+            "GET",
+            {},
+            {"created_at": "gt:2020", "limit": "500"},
+            None,
+            ("read", 5),
+        ),
+        ("get_message", "GET", {}, {"title": "rg:^ab"}, None, ("read", 10)),
+        (
+            "get_message",
+            "GET",
+            {},
+            {"title": "rg:ab", "limit": "100"},
+            None,
+            ("scan", 20),
+        ),
+        (
+            "get_message",
+            "GET",
+            {},
+            {"title": "ne:ab", "count": "true"},
+            None,
+            ("scan", 10),
+        ),
+        ("get_message", "DELETE", {}, {"text": "rg:.*"}, None, ("bulk_write", 20)),
+        ("get_message", "PUT", {}, {"q": "sheep"}, None, ("bulk_write", 1)),
+        ("get_message", "GET", {}, {"ids": ",".join("a" * 250)}, None, ("read", 3)),
+        ("get_messages_by_id", "POST", {}, {}, 28 * 1000, ("read", 10)),
+    ],
+)
+def test_estimate_cost(endpoint, method, view_args, args, content_length, expected):
+    cost = estimate_cost(
+        db, endpoint, method, view_args, MultiDict(args), content_length
+    )
+    assert cost == expected
+
+
+def test_expensive_requests_are_refused(client, limits):
+    assert client.get("/api/messages?title=rg:sheep").status_code == 200
+    res = client.get("/api/messages?title=rg:sheep")
+
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "5"
+    assert res.json["error"] == "TooManyRequests"
+    # cheap requests have their own budget
+    res = client.get("/api/messages?created_at=gt:2020&limit=10")
+    assert res.status_code == 200
+    assert client.get("/metrics").status_code == 200
+
+
+def test_bulk_writes_are_refused_when_too_many_run(client, monkeypatch):
+    monkeypatch.setenv("ADMISSION_CONTROL", "true")
+    full = ConcurrencyLimit(0, "bulk_write")
+    monkeypatch.setattr(BULK_WRITES, "_semaphore", full._semaphore)
+
+    res = client.delete("/api/messages?title=rg:^nothing$")
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "1"
+
+
+def test_async_expensive_requests_are_refused(limits):
+    client = async_app.test_client()
+    asyncio.run(client.get("/api/messages?title=rg:sheep"))
+    res = asyncio.run(client.get("/api/messages?title=rg:sheep"))
+
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "5"
+
+
+def test_admission_control_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("ADMISSION_CONTROL")
+    assert not is_enabled()
+
+
+@pytest.mark.parametrize(
+    "forwarded_for,trusted_proxies,expected",
+    [
+        ("1.1.1.1", 1, "1.1.1.1"),
+        ("6.6.6.6, 1.1.1.1", 1, "1.1.1.1"),
+        ("6.6.6.6, 1.1.1.1, 10.0.0.1", 2, "1.1.1.1"),
+        ("1.1.1.1", 2, None),
+        ("", 1, None),
+    ],
+)
+def test_get_forwarded_address(forwarded_for, trusted_proxies, expected):
+    headers = {"X-Forwarded-For": forwarded_for}
+    assert get_forwarded_address(headers, trusted_proxies) == expected
+
+
+def test_compressed_bodies_are_priced_by_their_decompressed_size(client, limits):
+    limits["write"] = (1, 6)
+    body = gzip.compress(json.dumps({"text": "t"}).encode())
+    headers = {"Content-Encoding": "gzip"}
+    with app.test_request_context(data=body, headers=headers) as context:
+        assert get_body_length(context.request) == len(body) * 5
+
+    # 64KB compressed costs 5 units, not 1
+    body = gzip.compress(json.dumps({"text": "t"}).encode()).ljust(64 * 1024)
+    responses = [
+        client.post(
+            "/api/messages",
+            data=body,
+            headers=headers,
+            content_type="application/json",
+        )
+        for _ in range(2)
+    ]
+
+    assert [res.status_code for res in responses] == [201, 429]
+    db.message.delete_one({"_id": ObjectId(responses[0].json["inserted_ids"][0])})
@@ -1,3 +1,4 @@
+import json
 import random
 import re
 from datetime import datetime
@@ -6,8 +7,9 @@ import pytest
 from bson.objectid import ObjectId
 
 from . import LATEST_VERSION, app
-from .entities.message import create_message
+from .entities.message import create_message, create_message_update
 from .mongodb import DatabaseClient
+from .views import message_bulk
 
 
 @pytest.fixture
@@ -36,7 +38,7 @@ class TestMessageRoute:
 
     @classmethod
     def teardown_class(cls):
-        cls.db.conn.close()
+        cls.db.close()
 
     def test_get_message_using_id(self, client):
         message = create_message(text="test get message")
@@ -55,6 +57,46 @@ class TestMessageRoute:
             message["created_at"].strftime(timeformat), res.json["created_at"]
         )
 
+    def test_get_message_using_id_and_fields(self, client):
+        message = create_message(text="test get message", title="title")
+        message_id = self.message.insert_one(message).inserted_id
+
+        res = client.get(f"/api/messages/{message_id}?fields=title")
+
+        assert self.message.delete_one({"_id": message_id}).acknowledged
+        assert res.status_code == 200
+        assert set(res.json) == {"_id", "title", "last_modified"}
+
+    def test_get_message_using_id_conditionally(self, client):
+        message = create_message(text="test get message")
+        message_id = self.message.insert_one(message).inserted_id
+
+        res = client.get(f"/api/messages/{message_id}")
+        etag, last_modified = res.headers["ETag"], res.headers["Last-Modified"]
+        not_modified_res = client.get(
+            f"/api/messages/{message_id}", headers={"If-None-Match": etag}
+        )
+        not_modified_since_res = client.get(
+            f"/api/messages/{message_id}",
+            headers={"If-Modified-Since": last_modified},
+        )
+        self.message.update_one(
+            {"_id": message_id},
+            {"$set": create_message_update(text="new text")},
+        )
+        modified_res = client.get(
+            f"/api/messages/{message_id}", headers={"If-None-Match": etag}
+        )
+
+        assert self.message.delete_one({"_id": message_id}).acknowledged
+        assert res.status_code == 200
+        assert not_modified_res.status_code == 304
+        assert not_modified_res.headers["ETag"] == etag
+        assert not_modified_since_res.status_code == 304
+        assert modified_res.status_code == 200
+        assert modified_res.json["text"] == "new text"
+        assert modified_res.headers["ETag"] != etag
+
     def test_get_message_using_nonexistent_id(self, client):
         # guarantees id doesn't already exist
         message = create_message(text="text")
@@ -98,6 +140,248 @@ class TestMessageRoute:
         for id in inserted_ids:
             assert self.message.delete_one({"_id": id}).acknowledged
 
+    def test_get_message_using_cursor(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(5)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        url = f"/api/messages?title=rg:{random_string}&sort=created_at&limit=2"
+        pages = []
+        res = client.get(url)
+        while True:
+            assert res.status_code == 200
+            pages.append([m["_id"] for m in res.json["messages"]])
+            if "next" not in res.json:
+                break
+            res = client.get(f"{url}&after={res.json['next']}")
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert sum(pages, []) == [str(id) for id in inserted_ids]
+
+    def test_get_message_using_descending_cursor_over_missing_values(self, client):
+        random_string = get_random_string(10)
+        messages = [
+            *[create_message(title=title, text=random_string) for title in "abc"],
+            *[create_message(text=random_string) for _ in range(3)],
+        ]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        url = f"/api/messages?text=rg:^{random_string}&sort=-title&limit=2"
+        titles = []
+        res = client.get(url)
+        while True:
+            assert res.status_code == 200
+            titles.extend(m.get("title") for m in res.json["messages"])
+            if "next" not in res.json:
+                break
+            res = client.get(f"{url}&after={res.json['next']}")
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert titles == ["c", "b", "a", None, None, None]
+
+    def test_get_message_using_params_and_excluded_fields(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(2)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        res = client.get(
+            f"/api/messages?title=rg:{random_string}&-fields=text,created_at"
+        )
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        for message in res.json["messages"]:
+            assert set(message) == {"_id", "title", "last_modified"}
+
+    def test_get_message_using_facets(self, client):
+        random_string = get_random_string(10)
+        messages = [
+            create_message(title=random_string + "a", text="text"),
+            create_message(title=random_string + "a", text="text"),
+            create_message(title=random_string + "b", text="text"),
+        ]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        prefix_length = len(random_string) + 1
+        res = client.get(
+            f"/api/messages?title=rg:^{random_string}&limit=2"
+            f"&facets=title:{prefix_length}&facets=created_at"
+        )
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        assert len(res.json["messages"]) == 2
+        assert "next" in res.json
+        assert res.json["facets"]["title"] == [
+            {"value": random_string + "a", "count": 2},
+            {"value": random_string + "b", "count": 1},
+        ]
+        assert sum(b["count"] for b in res.json["facets"]["created_at"]) == 3
+
+    def test_get_message_using_facets_and_cursor(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(3)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        url = f"/api/messages?title=rg:^{random_string}&limit=2&facets=title"
+        res = client.get(url)
+        next_res = client.get(f"{url}&after={res.json['next']}")
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert len(next_res.json["messages"]) == 1
+        for page in [res, next_res]:
+            assert page.json["facets"]["title"] == [
+                {"value": random_string[0], "count": 3}
+            ]
+
+    def test_get_messages_by_case_insensitive_title_prefix(self, client):
+        random_string = get_random_string(10)
+        messages = [
+            create_message(title=random_string.upper() + " A", text="text"),
+            create_message(title=random_string + " b", text="text"),
+            create_message(title="x" + random_string, text="text"),
+            # stored before title_lower existed and not backfilled yet
+            {"title": random_string.upper() + " C", "text": "text"},
+        ]
+        # the embedded backend backfills when the app's client is created
+        client.head("/api/messages")
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        res = client.get(f"/api/messages?title=rg:^{random_string}&title=op:i")
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        titles = sorted(m["title"] for m in res.json["messages"])
+        assert titles == [
+            random_string.upper() + " A",
+            random_string.upper() + " C",
+            random_string + " b",
+        ]
+        assert all("title_lower" not in m for m in res.json["messages"])
+
+    def test_get_messages_by_id(self, client):
+        messages = [create_message(title=f"mget {i}", text="text") for i in range(3)]
+        ids = self.message.insert_many(messages).inserted_ids
+        missing_id = ObjectId()
+        requested_ids = [str(id) for id in [ids[2], missing_id, ids[0], ids[2]]]
+
+        res = client.get(f"/api/messages?ids={','.join(requested_ids)}&fields=title")
+        post_res = client.post(
+            "/api/messages/_mget?-fields=text", json={"ids": requested_ids}
+        )
+
+        for id in ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        assert res.json["messages"] == [
+            {"_id": str(ids[2]), "title": "mget 2"},
+            {"_id": str(ids[0]), "title": "mget 0"},
+        ]
+        assert res.json["missing"] == [str(missing_id)]
+        assert post_res.status_code == 200
+        assert [m["_id"] for m in post_res.json["messages"]] == [
+            str(ids[2]),
+            str(ids[0]),
+        ]
+        assert all("text" not in m for m in post_res.json["messages"])
+        assert post_res.json["missing"] == [str(missing_id)]
+
+    @pytest.mark.parametrize(
+        "body,error",
+        [
+            ({"ids": ["invalid", "other"]}, "Invalid ids: 'invalid', 'other'"),
+            ({"ids": "1"}, "The ids should be a list of strings."),
+            ({"ids": []}, "Between 1 and 1000 ids should be given."),
+        ],
+    )
+    def test_get_messages_by_invalid_ids(self, client, body, error):
+        res = client.post("/api/messages/_mget", json=body)
+
+        assert res.status_code == 400
+        assert res.json["message"] == error
+        assert res.json["error"] == "InvalidValue"
+
+    def test_get_messages_by_id_and_params(self, client):
+        res = client.get(f"/api/messages?ids={ObjectId()}&title=rg:^x")
+
+        assert res.status_code == 400
+        assert res.json["error"] == "InvalidQuery"
+
+    def test_count_messages(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(3)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        url = f"/api/messages?title=rg:{random_string}&sort=title&limit=1"
+        res = client.get(f"{url}&count=true")
+        capped_res = client.get(f"{url}&count=true&max_count=2")
+        exact_res = client.get(f"{url}&count=true&max_count=3")
+        head_res = client.head(url)
+        total_res = client.head("/api/messages")
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        assert res.json == {"count": 3, "capped": False}
+        assert res.headers["X-Total-Count"] == "3"
+        assert capped_res.json == {"count": 2, "capped": True}
+        assert capped_res.headers["X-Count-Capped"] == "true"
+        assert exact_res.json == {"count": 3, "capped": False}
+        assert "X-Count-Capped" not in exact_res.headers
+        assert head_res.status_code == 200
+        assert head_res.mimetype == "application/json"
+        assert head_res.headers["X-Total-Count"] == "3"
+        assert head_res.data == b""
+        assert int(total_res.headers["X-Total-Count"]) >= 3
+
+    def test_get_message_using_invalid_cursor(self, client):
+        res = client.get("/api/messages?created_at=gt:2020&after=invalid")
+
+        assert res.status_code == 400
+        assert res.json["message"] == "'invalid' is not a valid cursor."
+        assert res.json["error"] == "InvalidValue"
+
+    def test_get_message_as_ndjson(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(3)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        res = client.get(
+            f"/api/messages?title=rg:{random_string}&sort=created_at&limit=2",
+            headers={"Accept": "application/x-ndjson"},
+        )
+        lines = [json.loads(line) for line in res.data.splitlines()]
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        assert res.mimetype == "application/x-ndjson"
+        assert [m["_id"] for m in lines[:2]] == [str(id) for id in inserted_ids[:2]]
+        assert list(lines[2]) == ["next"]
+
+    def test_get_message_as_json_stream(self, client):
+        random_string = get_random_string(10)
+        messages = [create_message(title=random_string, text="t") for _ in range(3)]
+        inserted_ids = self.message.insert_many(messages).inserted_ids
+
+        res = client.get(
+            f"/api/messages?title=rg:{random_string}&sort=created_at&stream=true"
+        )
+        body = res.json
+
+        for id in inserted_ids:
+            assert self.message.delete_one({"_id": id}).acknowledged
+        assert res.status_code == 200
+        assert [m["_id"] for m in body["messages"]] == list(map(str, inserted_ids))
+        assert "next" not in body
+
     def test_get_message_using_invalid_params(self, client):
         random_string = get_random_string(10)
         res = client.put(
@@ -143,6 +427,122 @@ class TestMessageRoute:
 
         assert res.status_code == 201
 
+    def test_import_messages(self, client):
+        random_string = get_random_string(10)
+        lines = [
+            json.dumps({"text": "text 1", "title": random_string}),
+            "",
+            "not json",
+            json.dumps({"text": "text 2", "title": random_string}),
+            json.dumps({"text": False}),
+            json.dumps({"text": "text 3", "title": random_string}),
+        ]
+
+        res = client.post(
+            "/api/v1/messages/_import?chunk_size=2",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+
+        res_delete = self.message.delete_many({"title": random_string})
+        assert res.status_code == 201
+        assert res.json["inserted_count"] == res_delete.deleted_count == 3
+        assert res.json["error_count"] == 2
+        assert [(e["line"], e["error"]) for e in res.json["errors"]] == [
+            (3, "InvalidMessage"),
+            (5, "InvalidMessage"),
+        ]
+
+    @pytest.mark.parametrize("ordered", ["true", "false"])
+    def test_bulk_messages(self, client, ordered):
+        random_string = get_random_string(10)
+        ids = self.message.insert_many(
+            [create_message(text="text", title=random_string) for _ in range(2)]
+        ).inserted_ids
+        operations = [
+            {"op": "insert", "message": {"text": "new", "title": random_string}},
+            {"op": "update", "_id": str(ids[0]), "message": {"text": "updated"}},
+            {"op": "update", "_id": str(ids[0]), "message": {"text": False}},
+            {"op": "delete", "_id": str(ids[1])},
+            {"op": "delete", "_id": str(ObjectId())},
+        ]
+
+        res = client.post(f"/api/messages/_bulk?ordered={ordered}", json=operations)
+
+        messages = list(self.message.find({"title": random_string}))
+        self.message.delete_many({"title": random_string})
+        assert res.status_code == 200
+        statuses = [result["status"] for result in res.json["results"]]
+        assert res.json["results"][2]["error"] == "InvalidMessage"
+        assert res.json["results"][0]["_id"] in [str(m["_id"]) for m in messages]
+        if ordered == "true":
+            assert statuses == [201, 200, 400]
+            assert len(messages) == 3
+        else:
+            assert statuses == [201, 200, 400, 200, 404]
+            assert res.json["results"][4]["error"] == "NotFound"
+            assert len(messages) == 2
+        assert res.json["inserted_count"] == res.json["modified_count"] == 1
+        assert res.json["error_count"] == statuses.count(400) + statuses.count(404)
+        assert [m["text"] for m in messages if m["_id"] == ids[0]] == ["updated"]
+
+    def test_bulk_messages_as_ndjson(self, client):
+        random_string = get_random_string(10)
+        message = {"text": "text", "title": random_string}
+        lines = [
+            json.dumps({"op": "insert", "message": message}),
+            "",
+            "not json",
+            json.dumps({"op": "insert", "message": message}),
+        ]
+
+        res = client.post(
+            "/api/messages/_bulk?ordered=false",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+
+        res_delete = self.message.delete_many({"title": random_string})
+        assert res.status_code == 200
+        assert [r["status"] for r in res.json["results"]] == [201, 400, 201]
+        assert res.json["inserted_count"] == res_delete.deleted_count == 2
+
+    def test_bulk_messages_as_too_long_ndjson(self, client, monkeypatch):
+        monkeypatch.setattr(message_bulk, "MAX_BULK_OPERATIONS", 2)
+        random_string = get_random_string(10)
+        line = json.dumps(
+            {"op": "insert", "message": {"text": "text", "title": random_string}}
+        )
+
+        res_blank = client.post(
+            "/api/messages/_bulk",
+            data="\n".join([line, "", " ", line, ""]),
+            content_type="application/x-ndjson",
+        )
+        res = client.post(
+            "/api/messages/_bulk",
+            data="\n".join([line] * 3),
+            content_type="application/x-ndjson",
+        )
+
+        res_delete = self.message.delete_many({"title": random_string})
+        assert res_blank.status_code == 200
+        assert res.status_code == 400
+        assert res.json["error"] == "InvalidValue"
+        assert res_delete.deleted_count == 2
+
+    def test_bulk_messages_with_invalid_body(self, client):
+        res = client.post("/api/messages/_bulk", json={"op": "insert"})
+
+        assert res.status_code == 400
+        assert res.json["error"] == "InvalidValue"
+
+    def test_import_messages_with_invalid_chunk_size(self, client):
+        res = client.post("/api/v1/messages/_import?chunk_size=0", data="")
+
+        assert res.status_code == 400
+        assert res.json["error"] == "InvalidValue"
+
     def test_put_message_using_id(self, client):
         old_message = {"text": "test put text", "title": "test put title"}
         id = self.message.insert_one(old_message).inserted_id
@@ -0,0 +1,209 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from . import LATEST_VERSION, mongodb, text_files
+from .asgi import app, db
+from .views import message_stream
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def test_api_route_versioning(client):
+    res = asyncio.run(client.get("/api"))
+    assert res.status_code == 204
+    res = asyncio.run(client.get(f"/api/{LATEST_VERSION}"))
+    assert res.status_code == 204
+
+
+def test_get_message_using_invalid_id(client):
+    id = "invalid id"
+    res = asyncio.run(client.get(f"/api/messages/{id}"))
+    body = asyncio.run(res.get_json())
+
+    assert res.status_code == 400
+    assert body["error"] == "InvalidId"
+
+
+def test_post_and_get_message(client):
+    message = {"text": "test async message", "title": "test async title"}
+
+    async def post_and_get():
+        res = await client.post("/api/messages", json=message)
+        id = (await res.get_json())["inserted_ids"][0]
+        get_res = await client.get(f"/api/messages/{id}?fields=text")
+        delete_res = await client.delete(f"/api/messages/{id}")
+        return res, get_res, delete_res
+
+    res, get_res, delete_res = asyncio.run(post_and_get())
+
+    assert res.status_code == 201
+    assert get_res.status_code == 200
+    assert asyncio.run(get_res.get_json())["text"] == message["text"]
+    assert asyncio.run(delete_res.get_json())["deleted_count"] == 1
+
+
+def test_metrics_route(client):
+    async def get_metrics():
+        await client.get("/api")
+        res = await client.get("/metrics")
+        return res, await res.get_data(raw=False)
+
+    res, metrics = asyncio.run(get_metrics())
+
+    assert res.status_code == 200
+    assert 'method="GET",route="/api",status="204"' in metrics
+
+
+def test_compressed_post_and_get(client):
+    message = {"text": "compressed async message " * 100, "title": "async"}
+
+    async def post_and_get():
+        res = await client.post(
+            "/api/messages",
+            data=gzip.compress(json.dumps(message).encode()),
+            headers={"Content-Encoding": "gzip", "Content-Type": "application/json"},
+        )
+        id = (await res.get_json())["inserted_ids"][0]
+        get_res = await client.get(
+            f"/api/messages/{id}", headers={"Accept-Encoding": "gzip"}
+        )
+        await client.delete(f"/api/messages/{id}")
+        return res, get_res, await get_res.get_data()
+
+    res, get_res, data = asyncio.run(post_and_get())
+
+    assert res.status_code == 201
+    assert get_res.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(data))["text"] == message["text"]
+
+
+def test_get_offloaded_text_range(client, monkeypatch):
+    monkeypatch.setattr(text_files, "OFFLOAD_SIZE", 16 * 1024)
+    text = "large async text " * 2000
+
+    async def post_and_get():
+        res = await client.post("/api/messages", json={"text": text})
+        id = (await res.get_json())["inserted_ids"][0]
+        text_res = await client.get(
+            f"/api/messages/{id}/text", headers={"Range": "bytes=6-15"}
+        )
+        data = await text_res.get_data()
+        await client.delete(f"/api/messages/{id}")
+        return text_res, data
+
+    res, data = asyncio.run(post_and_get())
+
+    assert res.status_code == 206
+    assert data == text.encode()[6:16]
+
+
+def test_count_messages(client):
+    async def count():
+        message = {"text": "t", "title": "count"}
+        res = await client.post("/api/messages", json=message)
+        id = (await res.get_json())["inserted_ids"][0]
+        count_res = await client.get(
+            "/api/messages?title=rg:^count$&count=true&max_count=1"
+        )
+        head_res = await client.head("/api/messages?title=rg:^count$")
+        await client.delete(f"/api/messages/{id}")
+        return await count_res.get_json(), head_res
+
+    body, head_res = asyncio.run(count())
+
+    assert body == {"count": 1, "capped": False}
+    assert head_res.headers["X-Total-Count"] == "1"
+    assert head_res.mimetype == "application/json"
+
+
+def test_get_messages_by_id(client):
+    async def get_by_id():
+        res = await client.post("/api/messages", json={"text": "t", "title": "mget"})
+        id = (await res.get_json())["inserted_ids"][0]
+        get_res = await client.get(f"/api/messages?ids={id}&fields=title")
+        post_res = await client.post("/api/messages/_mget", json={"ids": [id]})
+        await client.delete(f"/api/messages/{id}")
+        return id, await get_res.get_json(), await post_res.get_json()
+
+    id, get_body, post_body = asyncio.run(get_by_id())
+
+    assert get_body == {"messages": [{"_id": id, "title": "mget"}], "missing": []}
+    assert [m["_id"] for m in post_body["messages"]] == [id]
+
+
+async def read_events(connection, count):
+    events = []
+    while len(events) < count:
+        chunk = await connection.receive()
+        if chunk and chunk != message_stream.HEARTBEAT:
+            lines = chunk.decode().split("\n")[:3]
+            events.append([line.split(": ", 1)[1] for line in lines])
+    return events
+
+
+def test_stream_messages(client, monkeypatch):
+    monkeypatch.setattr(message_stream, "HEARTBEAT_MS", 10)
+    url = "/api/messages/stream?title=rg:^stream$"
+    messages = [{"text": "t", "title": "other"}, {"text": "t", "title": "stream"}]
+
+    async def stream():
+        async with client.request(url) as connection:
+            await connection.send_complete()
+            res = await client.post("/api/messages", json=messages)
+            other_id, id = (await res.get_json())["inserted_ids"]
+            await client.put(f"/api/messages/{id}", json={"text": "new text"})
+            events = await read_events(connection, 2)
+            await connection.close()
+        headers = connection.headers
+
+        await client.delete(f"/api/messages/{id}")
+        last_event_id = {"Last-Event-ID": events[0][0]}
+        async with client.request(url, headers=last_event_id) as connection:
+            await connection.send_complete()
+            events += await read_events(connection, 2)
+            await connection.close()
+        await client.delete(f"/api/messages/{other_id}")
+        return headers, id, events
+
+    headers, id, [insert, update, resumed_update, delete] = asyncio.run(stream())
+
+    assert headers["Content-Type"].startswith("text/event-stream")
+    assert [insert[1], update[1]] == ["insert", "update"]
+    assert json.loads(update[2])["message"]["text"] == "new text"
+    assert "title_lower" not in json.loads(update[2])["message"]
+    assert resumed_update == update
+    assert delete[1] == "delete"
+    assert json.loads(delete[2]) == {"_id": id}
+
+
+def test_stream_messages_from_a_lost_position(client):
+    headers = {"Last-Event-ID": "FFFFFFFFFFFFFFFF"}
+    res = asyncio.run(client.get("/api/messages/stream", headers=headers))
+
+    assert res.status_code == 410
+    assert asyncio.run(res.get_json())["error"] == "Gone"
+
+
+def test_unbounded_regex_is_checked_from_the_first_request(client, monkeypatch):
+    monkeypatch.setattr(mongodb, "REGEX_SCAN_MAX_DOCUMENTS", 0)
+
+    async def get():
+        res = await client.post("/api/messages", json={"text": "t", "title": "abc"})
+        id = (await res.get_json())["inserted_ids"][0]
+        # like a worker that hasn't counted the messages yet
+        monkeypatch.setattr(db, "_collection_size", None)
+        monkeypatch.setattr(db, "_collection_size_time", None)
+        res = await client.get("/api/messages?title=rg:abc")
+        await client.delete(f"/api/messages/{id}")
+        return res.status_code, await res.get_json()
+
+    status, body = asyncio.run(get())
+
+    assert status == 400
+    assert body["error"] == "InvalidQuery"
@@ -0,0 +1,111 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from . import app, db
+from .batching import MESSAGE_INSERTS, AsyncInsertBatcher, InsertBatcher
+
+
+class RecordingCollection:
+    def __init__(self, collection):
+        self.collection = collection
+        self.batches = []
+
+    def insert_many(self, documents, ordered=True):
+        self.batches.append(len(documents))
+        return self.collection.insert_many(documents, ordered=ordered)
+
+
+class AsyncRecordingCollection(RecordingCollection):
+    async def insert_many(self, documents, ordered=True):
+        return super().insert_many(documents, ordered)
+
+
+def insert_concurrently(batcher, collection, documents):
+    with ThreadPoolExecutor(len(documents)) as executor:
+        futures = [
+            executor.submit(batcher.insert, collection, document)
+            for document in documents
+        ]
+        return [f.exception() or f.result() for f in futures]
+
+
+def test_inserts_are_written_together():
+    collection = RecordingCollection(db.message)
+    batcher = InsertBatcher(window_ms=1000, max_size=3)
+    documents = [{"title": f"batched {i}"} for i in range(3)]
+
+    ids = insert_concurrently(batcher, collection, documents)
+
+    assert collection.batches == [3]
+    assert ids == [document["_id"] for document in documents]
+    assert db.message.delete_many({"_id": {"$in": ids}}).deleted_count == 3
+
+
+def test_a_single_insert_waits_for_the_window_only():
+    collection = RecordingCollection(db.message)
+    batcher = InsertBatcher(window_ms=10, max_size=100)
+
+    id = batcher.insert(collection, {"title": "alone"})
+
+    assert collection.batches == [1]
+    assert db.message.delete_one({"_id": id}).deleted_count == 1
+
+
+def test_each_insert_gets_its_own_error():
+    id = db.message.insert_one({"title": "existing"}).inserted_id
+    batcher = InsertBatcher(window_ms=1000, max_size=2)
+
+    results = insert_concurrently(
+        batcher, db.message, [{"_id": id, "title": "duplicate"}, {"title": "new"}]
+    )
+
+    assert isinstance(results[0], DuplicateKeyError)
+    assert isinstance(results[1], ObjectId)
+    db.message.delete_many({"_id": {"$in": [id, results[1]]}})
+
+
+def test_async_inserts_are_written_together():
+    collection = AsyncRecordingCollection(db.message)
+    batcher = AsyncInsertBatcher(window_ms=1000, max_size=3)
+    documents = [{"title": f"async batched {i}"} for i in range(3)]
+
+    async def run():
+        inserts = [batcher.insert(collection, d) for d in documents]
+        return await asyncio.gather(*inserts)
+
+    ids = asyncio.run(run())
+
+    assert collection.batches == [3]
+    assert ids == [document["_id"] for document in documents]
+    db.message.delete_many({"_id": {"$in": ids}})
+
+
+@pytest.mark.parametrize(
+    "window_ms,multithread,batched",
+    [(0, True, False), (5, True, True), (5, False, False)],
+)
+def test_post_message(monkeypatch, window_ms, multithread, batched):
+    monkeypatch.setattr(MESSAGE_INSERTS, "window", window_ms / 1000)
+    batched_inserts = []
+    insert = MESSAGE_INSERTS.insert
+    monkeypatch.setattr(
+        MESSAGE_INSERTS,
+        "insert",
+        lambda *args: batched_inserts.append(args) or insert(*args),
+    )
+
+    with app.test_client() as client:
+        res = client.post(
+            "/api/messages",
+            json={"title": "title", "text": "text"},
+            environ_overrides={"wsgi.multithread": multithread},
+        )
+
+    assert res.status_code == 201
+    assert len(batched_inserts) == batched
+    [id] = res.json["inserted_ids"]
+    assert db.message.delete_one({"_id": ObjectId(id)}).deleted_count == 1
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from .coalescing import (
+    AsyncSingleFlight,
+    SharedSingleFlight,
+    SingleFlight,
+    get_query_key,
+)
+
+
+def run_concurrently(flights, key, fn, count=2):
+    # the first call blocks in fn until the others are waiting for it
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def blocking_fn():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+        return fn()
+
+    with ThreadPoolExecutor(count) as executor:
+        first = executor.submit(flights[0].do, key, blocking_fn)
+        started.wait(5)
+        others = [
+            executor.submit(flights[i % len(flights)].do, key, blocking_fn)
+            for i in range(1, count)
+        ]
+        # gives the others time to join the flight
+        time.sleep(0.05)
+        release.set()
+        futures = [first, *others]
+        return [f.exception() or f.result() for f in futures], len(calls)
+
+
+def test_get_query_key():
+    find_query = {"filter": {"created_at": {"$gt": datetime(2020, 1, 1)}}}
+    other_query = {"filter": {"created_at": {"$gt": datetime(2021, 1, 1)}}}
+
+    assert get_query_key(find_query) == get_query_key(dict(find_query))
+    assert get_query_key(find_query) != get_query_key(other_query)
+
+
+def test_single_flight_shares_the_result():
+    results, calls = run_concurrently([SingleFlight()], "key", lambda: [1], count=3)
+
+    assert results == [[1], [1], [1]]
+    assert calls == 1
+
+
+def test_single_flight_shares_the_error():
+    def fail():
+        raise ValueError("query failed")
+
+    results, calls = run_concurrently([SingleFlight()], "key", fail)
+
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert calls == 1
+
+
+def test_single_flight_keeps_nothing():
+    flight = SingleFlight()
+
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+
+
+def test_shared_single_flight_shares_the_result_across_workers(tmp_path):
+    workers = [SharedSingleFlight(str(tmp_path)) for _ in range(2)]
+    result = [{"_id": ObjectId(), "created_at": datetime(2020, 1, 1)}]
+
+    results, calls = run_concurrently(workers, "key", lambda: result)
+
+    assert results == [result, result]
+    assert calls == 1
+    # once it's done, the next query runs again
+    assert workers[1].do("key", lambda: []) == []
+
+
+def test_shared_single_flight_uses_only_new_results(tmp_path):
+    worker = SharedSingleFlight(str(tmp_path))
+    worker.do("key", lambda: ["old"])
+
+    assert worker.do("key", lambda: ["new"]) == ["new"]
+    assert os.listdir(tmp_path) == []
+
+
+def test_shared_single_flight_doesnt_wait_for_other_keys(tmp_path):
+    workers = [SharedSingleFlight(str(tmp_path)) for _ in range(2)]
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_fn():
+        started.set()
+        release.wait(5)
+        return ["key"]
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(workers[0].do, "key", blocking_fn)
+        started.wait(5)
+        start = time.monotonic()
+        result = workers[1].do("other key", lambda: ["other key"])
+        elapsed = time.monotonic() - start
+        release.set()
+
+    assert result == ["other key"] and future.result() == ["key"]
+    assert elapsed < 1
+
+
+def test_async_single_flight_shares_the_result():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return [1]
+
+    async def run():
+        return await asyncio.gather(*[flight.do("key", fn) for _ in range(3)])
+
+    assert asyncio.run(run()) == [[1], [1], [1]]
+    assert len(calls) == 1
+    assert asyncio.run(flight.do("key", fn)) == [1]
+    assert len(calls) == 2
@@ -0,0 +1,169 @@
+import gzip
+import io
+import json
+import zlib
+
+import pytest
+
+from . import app
+from .compression import (
+    DecompressingStream,
+    compress,
+    compress_chunks,
+    decompress,
+    negotiate_encoding,
+)
+from .entities.message import create_message
+from .mongodb import DatabaseClient
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def messages():
+    db = DatabaseClient()
+    messages = [
+        create_message(title="compressed", text=f"message {i} " * 100)
+        for i in range(20)
+    ]
+    ids = db.message.insert_many(messages).inserted_ids
+    yield ids
+    db.message.delete_many({"_id": {"$in": ids}})
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("gzip", "gzip"),
+        ("gzip;q=0.5, identity", "gzip"),
+        ("gzip;q=0", None),
+        ("compress", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding) == expected
+
+
+def test_compress_chunks():
+    chunks = [b"abc" * 1000, b"", b"def" * 1000]
+    data = b"".join(compress_chunks(iter(chunks), "gzip"))
+    assert gzip.decompress(data) == b"".join(chunks)
+
+
+def test_decompress():
+    data = b"message " * 1000
+    assert decompress(compress(data, "gzip"), "gzip") == data
+    assert decompress(zlib.compress(data), "deflate") == data
+
+
+def test_decompressing_stream_is_limited():
+    data = compress(b"a" * 10_000, "gzip")
+    stream = DecompressingStream(io.BytesIO(data), "gzip", max_size=1000)
+    with pytest.raises(Exception) as e:
+        stream.readall()
+    assert e.value.code == 413
+
+
+def test_get_messages_compressed(client, messages):
+    res = client.get(
+        "/api/messages?title=rg:^compressed$", headers={"Accept-Encoding": "gzip"}
+    )
+
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["Vary"] == "Accept-Encoding"
+    body = json.loads(gzip.decompress(res.data))
+    assert len(body["messages"]) == 20
+
+
+def test_get_messages_uncompressed(client, messages):
+    res = client.get("/api/messages?title=rg:^compressed$")
+
+    assert "Content-Encoding" not in res.headers
+    assert res.headers["Vary"] == "Accept-Encoding"
+    assert len(res.json["messages"]) == 20
+
+
+def test_small_response_isnt_compressed(client, messages):
+    res = client.get(
+        f"/api/messages/{messages[0]}?fields=title",
+        headers={"Accept-Encoding": "gzip"},
+    )
+
+    assert "Content-Encoding" not in res.headers
+    assert res.json["title"] == "compressed"
+
+
+def test_streamed_messages_compressed(client, messages):
+    res = client.get(
+        "/api/messages?title=rg:^compressed$",
+        headers={"Accept-Encoding": "gzip", "Accept": "application/x-ndjson"},
+    )
+
+    assert res.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(res.data).splitlines()
+    assert len(lines) == 20
+
+
+def test_compressed_message_has_weak_etag(client, messages):
+    url = f"/api/messages/{messages[0]}"
+    res = client.get(url, headers={"Accept-Encoding": "gzip"})
+    etag = res.headers["ETag"]
+
+    assert etag.startswith("W/")
+    not_modified_res = client.get(
+        url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert not_modified_res.status_code == 304
+
+
+def test_post_compressed_message(client):
+    body = json.dumps({"title": "compressed post", "text": "text " * 1000})
+
+    res = client.post(
+        "/api/messages",
+        data=gzip.compress(body.encode()),
+        headers={"Content-Encoding": "gzip", "Content-Type": "application/json"},
+    )
+
+    assert res.status_code == 201
+    id = res.json["inserted_ids"][0]
+    assert client.get(f"/api/messages/{id}").json["title"] == "compressed post"
+    assert client.delete(f"/api/messages/{id}").json["deleted_count"] == 1
+
+
+def test_import_compressed_messages(client):
+    lines = "".join(
+        json.dumps({"title": "compressed import", "text": str(i)}) + "\n"
+        for i in range(10)
+    )
+
+    res = client.post(
+        "/api/messages/_import",
+        data=gzip.compress(lines.encode()),
+        headers={"Content-Encoding": "gzip"},
+    )
+
+    assert res.status_code == 201
+    assert res.json["inserted_count"] == 10
+    client.delete("/api/messages?title=rg:^compressed import$")
+
+
+@pytest.mark.parametrize(
+    "encoding,data,status",
+    [("gzip", b"not gzip", 400), ("compress", b"{}", 415)],
+)
+def test_post_invalid_compressed_body(client, encoding, data, status):
+    res = client.post(
+        "/api/messages",
+        data=data,
+        headers={"Content-Encoding": encoding, "Content-Type": "application/json"},
+    )
+
+    assert res.status_code == status
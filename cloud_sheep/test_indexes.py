@@ -0,0 +1,124 @@
+import pytest
+from pymongo import ASCENDING, TEXT
+
+from . import indexes
+from .indexes import (
+    backfill_normalized_fields,
+    diff_indexes,
+    get_index_key,
+    get_index_models,
+)
+from .memorydb import MemoryStore
+
+
+def get_index_information(models):
+    return {
+        model.document["name"]: {"key": list(model.document["key"].items())}
+        for model in models
+    }
+
+
+def test_get_index_models_cover_sortable_and_search_params():
+    keys = [get_index_key(model.document) for model in get_index_models()]
+
+    assert (("created_at", ASCENDING), ("_id", ASCENDING)) in keys
+    assert (("last_modified", ASCENDING), ("_id", ASCENDING)) in keys
+    assert (("title", ASCENDING), ("_id", ASCENDING)) in keys
+    assert (TEXT, ("text", "title")) in keys
+
+
+@pytest.mark.parametrize(
+    "index,expected",
+    [
+        ({"key": [("a", ASCENDING)]}, (("a", ASCENDING),)),
+        (
+            {
+                "key": [("_fts", TEXT), ("_ftsx", 1)],
+                "weights": {"title": 1, "text": 1},
+            },
+            (TEXT, ("text", "title")),
+        ),
+        ({"key": {"title": TEXT, "text": TEXT}}, (TEXT, ("text", "title"))),
+    ],
+)
+def test_get_index_key(index, expected):
+    assert get_index_key(index) == expected
+
+
+def test_diff_indexes_with_synced_indexes():
+    models = get_index_models()
+    index_information = {
+        "_id_": {"key": [("_id", ASCENDING)]},
+        **get_index_information(models),
+    }
+
+    assert diff_indexes(index_information, models) == ([], [], [])
+
+
+def test_diff_indexes_with_missing_indexes():
+    models = get_index_models()
+
+    missing, drifted, unmanaged = diff_indexes({}, models)
+
+    assert missing == models
+    assert drifted == unmanaged == []
+
+
+def test_diff_indexes_with_drifted_and_unmanaged_indexes():
+    models = get_index_models()
+    index_information = get_index_information(models)
+    index_information["created_at_keyset"] = {"key": [("created_at", ASCENDING)]}
+    index_information["custom"] = {"key": [("other", ASCENDING)]}
+
+    missing, drifted, unmanaged = diff_indexes(index_information, models)
+
+    assert missing == []
+    assert drifted == ["created_at_keyset"]
+    assert unmanaged == ["custom"]
+
+
+def test_diff_indexes_with_another_text_index():
+    models = get_index_models()
+    index_information = {
+        "text_text": {
+            "key": [("_fts", TEXT), ("_ftsx", 1)],
+            "weights": {"text": 1},
+        }
+    }
+
+    missing, drifted, unmanaged = diff_indexes(index_information, models)
+
+    assert [model.document["name"] for model in missing] == [
+        model.document["name"]
+        for model in models
+        if model.document["name"] != "text_search"
+    ]
+    assert drifted == ["text_text"]
+    assert unmanaged == []
+
+
+def test_backfill_normalized_fields(monkeypatch):
+    monkeypatch.setattr(indexes, "BACKFILL_BATCH_SIZE", 2)
+    collection = MemoryStore()["db"]["message"]
+    collection.insert_many(
+        [
+            {"title": "Abc"},
+            {"title": "DEF"},
+            {"title": "Ghi"},
+            {"title": "Jkl", "title_lower": "jkl"},
+            {"title": None},
+            {"title": 1},
+            {"text": "no title"},
+        ]
+    )
+
+    assert backfill_normalized_fields(collection) == 3
+    assert [m.get("title_lower") for m in collection.find({}, sort="_id")] == [
+        "abc",
+        "def",
+        "ghi",
+        "jkl",
+        None,
+        None,
+        None,
+    ]
@@ -0,0 +1,337 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    TEXT,
+    DeleteOne,
+    IndexModel,
+    InsertOne,
+    UpdateMany,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from .memorydb import (
+    AsyncMemoryCollection,
+    MemoryClient,
+    MemoryGridFSBucket,
+    MemoryStore,
+    matches,
+)
+
+
+@pytest.fixture
+def collection():
+    collection = MemoryStore()["db"]["message"]
+    collection.create_indexes(
+        [
+            IndexModel([("created_at", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("title", TEXT), ("text", TEXT)]),
+        ]
+    )
+    collection.insert_many(
+        [
+            {
+                "title": "Café",
+                "text": "first message",
+                "created_at": datetime(2020, 1, 1),
+            },
+            {
+                "title": "b",
+                "text": "second message",
+                "created_at": datetime(2020, 6, 1),
+            },
+            {"title": "c", "text": "third one", "created_at": datetime(2021, 1, 1)},
+            {"title": "d", "text": "no date"},
+        ]
+    )
+    return collection
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ({"a": 1}, True),
+        ({"a": {"$gt": 0, "$lt": 2}}, True),
+        ({"a": {"$gt": "0"}}, False),
+        ({"a": {"$ne": None}}, True),
+        ({"b": {"$ne": None}}, False),
+        ({"b": None}, True),
+        ({"c": "abc"}, False),
+        ({"c": {"$regex": "^A", "$options": "i"}}, True),
+        ({"d": 2}, True),
+        ({"$or": [{"a": 2}, {"d": 3}]}, True),
+        ({"$and": [{"a": 1}, {"d": 4}]}, False),
+        ({"e.f": {"$in": [1, 2]}}, True),
+        ({"e.g": {"$exists": False}}, True),
+        ({"c": {"$type": "string"}}, True),
+        ({"d": {"$type": ["string", "int"]}}, True),
+        ({"b": {"$type": "null"}}, False),
+    ],
+)
+def test_matches(query, expected):
+    doc = {"a": 1, "c": "Abc", "d": [2, 3], "e": {"f": 1}}
+    assert matches(doc, query) == expected
+
+
+def test_find_uses_sorted_index_for_ranges(collection):
+    cursor = collection.find(
+        {"$and": [{"created_at": {"$gt": datetime(2020, 3, 1)}}]},
+        sort=[("created_at", DESCENDING), ("_id", DESCENDING)],
+    )
+
+    plan = cursor.explain()
+    assert plan["queryPlanner"]["winningPlan"]["stage"] == "IXSCAN"
+    assert plan["executionStats"]["totalDocsExamined"] == 2
+    assert [m["title"] for m in cursor] == ["c", "b"]
+
+
+def test_find_stops_at_limit_when_index_serves_the_sort(collection):
+    cursor = collection.find({}, sort=[("created_at", ASCENDING)], limit=2)
+
+    assert cursor.explain()["executionStats"]["totalDocsExamined"] == 2
+    # missing values sort first
+    assert [m["title"] for m in cursor] == ["d", "Café"]
+
+
+def test_find_with_projection(collection):
+    message = collection.find_one({"title": "b"}, {"text": False})
+
+    assert set(message) == {"_id", "title", "created_at"}
+    assert set(collection.find_one({"title": "b"}, ["text"])) == {"_id", "text"}
+
+
+@pytest.mark.parametrize(
+    "search,expected",
+    [
+        ("message", ["Café", "b"]),
+        ("cafe", ["Café"]),
+        ("first -message", []),
+        ('"third one"', ["c"]),
+        ("nothing", []),
+    ],
+)
+def test_find_with_text_search(collection, search, expected):
+    cursor = collection.find({"$text": {"$search": search}}, sort=[("title", 1)])
+    assert [m["title"] for m in cursor] == expected
+
+
+def test_find_with_diacritic_sensitive_text_search(collection):
+    query = {"$text": {"$search": "cafe", "$diacriticSensitive": True}}
+    assert list(collection.find(query)) == []
+
+
+def test_update_keeps_indexes_in_sync(collection):
+    res = collection.update_many(
+        {"title": {"$regex": "^[bc]$"}},
+        {"$set": {"created_at": datetime(2019, 1, 1), "text": "updated"}},
+    )
+
+    assert (res.matched_count, res.modified_count) == (2, 2)
+    cursor = collection.find({"created_at": {"$lt": datetime(2020, 1, 1)}})
+    assert sorted(m["title"] for m in cursor) == ["b", "c"]
+    query = {"$text": {"$search": "updated"}}
+    assert sorted(m["title"] for m in collection.find(query)) == ["b", "c"]
+
+
+def test_delete_keeps_indexes_in_sync(collection):
+    assert collection.delete_many({"title": {"$ne": "d"}}).deleted_count == 3
+
+    assert list(collection.find({"created_at": {"$gt": datetime(2000, 1, 1)}})) == []
+    assert list(collection.find({"$text": {"$search": "message"}})) == []
+    assert collection.estimated_document_count() == 1
+
+
+def test_insert_with_duplicate_id(collection):
+    id = ObjectId()
+    collection.insert_one({"_id": id})
+
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({"_id": id})
+    with pytest.raises(BulkWriteError) as e:
+        collection.insert_many([{"_id": id}, {"title": "e"}], ordered=False)
+    assert e.value.details["nInserted"] == 1
+    assert e.value.details["writeErrors"][0]["index"] == 0
+
+
+@pytest.mark.parametrize("ordered,inserted", [(True, 0), (False, 1)])
+def test_bulk_write(collection, ordered, inserted):
+    res = collection.bulk_write(
+        [
+            InsertOne({"title": "e"}),
+            UpdateMany({"title": {"$in": ["b", "c"]}}, {"$set": {"text": "new"}}),
+            DeleteOne({"title": "Café"}),
+        ]
+    )
+
+    assert (res.inserted_count, res.modified_count, res.deleted_count) == (1, 2, 1)
+    assert sorted(m["title"] for m in collection.find()) == ["b", "c", "d", "e"]
+
+    id = collection.find_one({"title": "e"})["_id"]
+    with pytest.raises(BulkWriteError) as e:
+        collection.bulk_write(
+            [InsertOne({"_id": id}), InsertOne({"title": "f"})], ordered=ordered
+        )
+    assert e.value.details["nInserted"] == inserted
+    assert e.value.details["writeErrors"][0]["index"] == 0
+
+
+def test_aggregate_with_facets(collection):
+    [result] = collection.aggregate(
+        [
+            {"$match": {"created_at": {"$ne": None}}},
+            {
+                "$facet": {
+                    "year": [
+                        {
+                            "$group": {
+                                "_id": {
+                                    "$dateToString": {
+                                        "format": "%Y",
+                                        "date": "$created_at",
+                                    }
+                                },
+                                "count": {"$sum": 1},
+                            }
+                        },
+                        {"$sort": {"_id": ASCENDING}},
+                    ],
+                    "messages": [{"$limit": 1}, {"$project": {"title": True}}],
+                }
+            },
+        ]
+    )
+
+    assert result["year"] == [
+        {"_id": "2020", "count": 2},
+        {"_id": "2021", "count": 1},
+    ]
+    assert list(result["messages"][0]) == ["_id", "title"]
+
+
+def test_clients_share_the_process_store():
+    first, second = MemoryClient(), MemoryClient()
+    id = first["db"]["shared"].insert_one({"a": 1}).inserted_id
+
+    assert second["db"]["shared"].find_one(id) == {"_id": id, "a": 1}
+    second["db"]["shared"].delete_one({"_id": id})
+
+
+def test_snapshot_round_trip(collection, tmp_path):
+    path = str(tmp_path / "snapshot.bson")
+    store = MemoryStore(path)
+    store["db"]["message"].create_index({"key": [("created_at", ASCENDING)]})
+    store["db"]["message"].insert_many(collection.find({}, {"_id": False}))
+    store.snapshot()
+
+    restored = MemoryStore(path)["db"]["message"]
+    assert restored.estimated_document_count() == 4
+    assert "created_at_1" in restored.index_information()
+    query = {"created_at": {"$gte": datetime(2021, 1, 1)}}
+    assert [m["title"] for m in restored.find(query)] == ["c"]
+
+
+def test_gridfs_bucket():
+    bucket = MemoryGridFSBucket(MemoryStore()["db"], chunk_size_bytes=4)
+    file_id = bucket.upload_from_stream("file", b"0123456789")
+
+    grid_out = bucket.open_download_stream(file_id)
+    assert grid_out.length == 10
+    grid_out.seek(3)
+    assert grid_out.read(5) == b"34567"
+
+    bucket.delete(file_id)
+    with pytest.raises(NoFile):
+        bucket.open_download_stream(file_id)
+
+
+def test_change_stream(collection):
+    pipeline = [{"$match": {"fullDocument.title": {"$ne": "skipped"}}}]
+    stream = collection.watch(
+        pipeline, full_document="updateLookup", max_await_time_ms=10
+    )
+    assert stream.try_next() is None
+
+    id = collection.insert_one({"title": "new"}).inserted_id
+    collection.insert_one({"title": "skipped"})
+    collection.update_one({"_id": id}, {"$set": {"text": "text"}})
+    collection.delete_one({"_id": id})
+
+    changes = [stream.try_next() for _ in range(3)]
+    assert [c["operationType"] for c in changes] == ["insert", "update", "delete"]
+    assert changes[1]["fullDocument"] == {"_id": id, "title": "new", "text": "text"}
+    assert changes[1]["updateDescription"]["updatedFields"] == {"text": "text"}
+    assert changes[2]["documentKey"] == {"_id": id}
+    assert stream.resume_token == changes[2]["_id"]
+
+    resumed = collection.watch(resume_after=changes[0]["_id"], max_await_time_ms=10)
+    assert resumed.try_next()["operationType"] == "insert"
+    assert resumed.try_next()["operationType"] == "update"
+    assert "fullDocument" not in resumed.try_next()
+
+
+def test_change_stream_history_lost(collection):
+    stream = collection.watch()
+    collection.insert_one({"title": "new"})
+    token = next(stream)["_id"]
+    collection.insert_one({"title": "newer"})
+    collection.insert_one({"title": "newest"})
+    # the change right after the token is gone, like an oplog rolling over
+    events = collection._changes.events
+    last = events.pop()
+    events.clear()
+    events.append(last)
+
+    with pytest.raises(OperationFailure) as error:
+        collection.watch(resume_after=token)
+    assert error.value.code == 286
+    with pytest.raises(OperationFailure):
+        collection.watch(resume_after={"_data": "not a token"})
+
+
+def test_async_change_stream(collection):
+    async def watch():
+        stream = await AsyncMemoryCollection(collection).watch(max_await_time_ms=10)
+        assert await stream.try_next() is None
+        collection.insert_one({"title": "new"})
+        change = await stream.__anext__()
+        await stream.close()
+        return change, stream.alive
+
+    change, alive = asyncio.run(watch())
+    assert change["fullDocument"]["title"] == "new"
+    assert not alive
+
+
+def test_async_change_stream_waits_on_the_event_loop(collection):
+    def insert_from_a_thread():
+        thread = threading.Thread(
+            target=collection.insert_one, args=({"title": "from a thread"},)
+        )
+        thread.start()
+
+    async def watch():
+        async_collection = AsyncMemoryCollection(collection)
+        stream = await async_collection.watch(max_await_time_ms=5000)
+        loop, thread_counts = asyncio.get_running_loop(), [threading.active_count()]
+        loop.call_later(0.02, lambda: thread_counts.append(threading.active_count()))
+        loop.call_later(0.05, insert_from_a_thread)
+        started = time.monotonic()
+        change = await stream.try_next()
+        elapsed = time.monotonic() - started
+        # a client going away stops the wait
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(stream.try_next(), 0.01)
+        return change, elapsed, thread_counts
+
+    change, elapsed, thread_counts = asyncio.run(watch())
+    assert change["fullDocument"]["title"] == "from a thread"
+    assert elapsed < 1
+    assert thread_counts[0] == thread_counts[1]
+    assert not collection._changes.async_waiters
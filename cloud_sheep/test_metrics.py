@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+from . import app
+from .metrics import CommandListener, Counter, Histogram, generate_latest
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+def test_histogram_exposition():
+    registry = []
+    histogram = Histogram(
+        "latency_seconds", "Latency.", ["route"], buckets=(0.1, 1), registry=registry
+    )
+    histogram.observe(0.05, route="/a")
+    histogram.observe(0.5, route="/a")
+    histogram.observe(5, route="/a")
+
+    assert generate_latest(registry).splitlines() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_counter_escapes_label_values():
+    registry = []
+    counter = Counter("errors_total", "Errors.", ["message"], registry=registry)
+    counter.inc(message='a "quoted"\nvalue')
+
+    assert 'errors_total{message="a \\"quoted\\"\\nvalue"} 1' in generate_latest(
+        registry
+    )
+
+
+def test_command_listener_observes_durations():
+    CommandListener().succeeded(
+        SimpleNamespace(duration_micros=1500, command_name="distinct")
+    )
+
+    assert (
+        'mongodb_command_duration_seconds_count{command="distinct",status="ok"}'
+        in generate_latest()
+    )
+
+
+def test_metrics_route(client):
+    client.get("/api")
+    client.get("/api/messages?created_at=gt:2000&limit=1")
+
+    res = client.get("/metrics")
+
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    metrics = res.get_data(as_text=True)
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/api",status="204"}'
+        in metrics
+    )
+    assert 'mongodb_documents_returned_count{operation="find"}' in metrics
+    assert "query_plan_cache_misses_total" in metrics
@@ -2,6 +2,7 @@ from datetime import datetime
 
 import pymongo
 import pytest
+from bson.objectid import ObjectId
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import BadRequestKeyError
 
@@ -11,7 +12,16 @@ from .mongodb import (
     InvalidOperator,
     InvalidQuery,
     InvalidValue,
+    compile_query_shape,
     convert_to_date,
+    encode_cursor,
+    get_client_options,
+    get_default_compressors,
+    get_db_config,
+    get_db_host,
+    get_prefix_bound,
+    get_regex_prefix,
+    normalize_query_dict,
 )
 
 
@@ -29,7 +39,7 @@ class TestDatabaseClient:
 
     @classmethod
     def teardown_class(cls):
-        cls.client.conn.close()
+        cls.client.close()
 
     @pytest.mark.parametrize(
         "param,exprs,expected",
@@ -166,6 +176,86 @@ class TestDatabaseClient:
             with pytest.raises(error):
                 self.client.create_query_from_dict(MultiDict(ctx.request.args))
 
+    @pytest.mark.parametrize(
+        "url_query,expected",
+        [
+            (
+                "/api/messages?title=rg:^abc",
+                [{"title": {"$gte": "abc", "$lt": "abd"}}],
+            ),
+            (
+                "/api/messages?title=rg:^ab.*c",
+                [
+                    {"title": {"$gte": "ab", "$lt": "ac"}},
+                    {"title": {"$regex": "^ab.*c"}},
+                ],
+            ),
+            (
+                "/api/messages?title=rg:^Ab&title=op:i",
+                [
+                    {
+                        "$or": [
+                            {"title_lower": {"$gte": "ab", "$lt": "ac"}},
+                            {"title_lower": None},
+                        ]
+                    },
+                    {"title": {"$regex": "^Ab", "$options": "i"}},
+                ],
+            ),
+            (
+                "/api/messages?title=rg:^a|b&created_at=gt:2020",
+                [
+                    {"created_at": {"$gt": datetime(year=2020, month=1, day=1)}},
+                    {"title": {"$regex": "^a|b"}},
+                ],
+            ),
+        ],
+    )
+    def test_create_query_from_dict_bounds_regex_prefixes(
+        self, app, url_query, expected
+    ):
+        with app.test_request_context(url_query) as ctx:
+            query = self.client.create_query_from_dict(MultiDict(ctx.request.args))
+        assert query == {"$and": expected}
+
+    def test_create_query_from_dict_rejects_unbounded_regex(self, app, monkeypatch):
+        monkeypatch.setattr(self.client, "is_large_collection", lambda: True)
+        with app.test_request_context("/api/messages?title=rg:abc") as ctx:
+            with pytest.raises(InvalidQuery):
+                self.client.create_query_from_dict(MultiDict(ctx.request.args))
+        with app.test_request_context("/api/messages?title=rg:^abc") as ctx:
+            assert self.client.create_query_from_dict(MultiDict(ctx.request.args))
+        url = "/api/messages?title=rg:^abc&title=op:i"
+        with app.test_request_context(url) as ctx:
+            assert self.client.create_query_from_dict(MultiDict(ctx.request.args))
+
+    def test_create_change_stream_pipeline(self):
+        pipeline = self.client.create_change_stream_pipeline(
+            MultiDict({"title": "rg:b", "created_at": "gt:2020"})
+        )
+        assert pipeline == [
+            {
+                "$match": {
+                    "$or": [
+                        {"operationType": "delete"},
+                        {
+                            "$and": [
+                                {
+                                    "fullDocument.created_at": {
+                                        "$gt": datetime(year=2020, month=1, day=1)
+                                    }
+                                },
+                                {"fullDocument.title": {"$regex": "b"}},
+                            ]
+                        },
+                    ]
+                }
+            }
+        ]
+        assert self.client.create_change_stream_pipeline(MultiDict()) == []
+        with pytest.raises(InvalidQuery):
+            self.client.create_change_stream_pipeline(MultiDict({"q": "text"}))
+
     @pytest.mark.parametrize(
         "url_query,expected",
         [
@@ -234,7 +324,17 @@ class TestDatabaseClient:
                 self.client.create_text_query(MultiDict(ctx.request.args))
 
     @pytest.mark.only
-    @pytest.mark.parametrize("update,expected", [({"a": "b"}, {"$set": {"a": "b"}})])
+    @pytest.mark.parametrize(
+        "update,expected",
+        [
+            ({"a": "b"}, {"$set": {"a": "b"}}),
+            ({"text": "b"}, {"$set": {"text": "b"}, "$unset": {"text_file": ""}}),
+            (
+                {"text": "b", "text_file": {"_id": 1, "length": 10}},
+                {"$set": {"text": "b", "text_file": {"_id": 1, "length": 10}}},
+            ),
+        ],
+    )
     def test_create_update_query_with_valid_input(self, app, update, expected):
         assert self.client.create_update_query(update) == expected
 
@@ -259,6 +359,252 @@ class TestDatabaseClient:
         with pytest.raises(InvalidValue):
             self.client.get_sort_param(param)
 
+    @pytest.mark.parametrize(
+        "sorting_params,expected",
+        [
+            (
+                [("created_at", pymongo.DESCENDING)],
+                [("created_at", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+            ),
+            (
+                [("_id", pymongo.ASCENDING), ("title", pymongo.DESCENDING)],
+                [("_id", pymongo.ASCENDING), ("title", pymongo.DESCENDING)],
+            ),
+        ],
+    )
+    def test_get_keyset_sort(self, sorting_params, expected):
+        assert self.client.get_keyset_sort(sorting_params) == expected
+
+    @pytest.mark.parametrize(
+        "sorting_params,values,expected",
+        [
+            (
+                [("created_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                [datetime(year=2020, month=1, day=1), 1],
+                [
+                    {"created_at": {"$gt": datetime(year=2020, month=1, day=1)}},
+                    {
+                        "created_at": datetime(year=2020, month=1, day=1),
+                        "_id": {"$gt": 1},
+                    },
+                ],
+            ),
+            (
+                [("title", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+                ["title", 1],
+                [
+                    {"$or": [{"title": {"$lt": "title"}}, {"title": None}]},
+                    {
+                        "title": "title",
+                        "$or": [{"_id": {"$lt": 1}}, {"_id": None}],
+                    },
+                ],
+            ),
+            (
+                [("title", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                [None, 1],
+                [{"title": {"$ne": None}}, {"title": None, "_id": {"$gt": 1}}],
+            ),
+            (
+                [("title", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+                [None, 1],
+                [{"title": None, "$or": [{"_id": {"$lt": 1}}, {"_id": None}]}],
+            ),
+        ],
+    )
+    def test_create_keyset_query_with_valid_input(
+        self, sorting_params, values, expected
+    ):
+        query = {"$and": []}
+        cursor = encode_cursor(values)
+        assert self.client.create_keyset_query(query, sorting_params, cursor) == {
+            "$and": [query, {"$or": expected}]
+        }
+
+    @pytest.mark.parametrize(
+        "cursor", ["not a cursor", encode_cursor({"a": 1}), encode_cursor([1, 2, 3])]
+    )
+    def test_create_keyset_query_with_invalid_input(self, cursor):
+        sorting_params = [("last_modified", pymongo.ASCENDING), ("_id", 1)]
+        with pytest.raises(InvalidValue):
+            self.client.create_keyset_query({}, sorting_params, cursor)
+
+    @pytest.mark.parametrize(
+        "fields,excluded_fields,required_fields,expected",
+        [
+            ([], [], [], {"title_lower": False}),
+            (
+                ["title,text"],
+                [],
+                [],
+                {"title": True, "text": True, "text_file": True},
+            ),
+            (
+                ["title"],
+                [],
+                ["created_at", "_id"],
+                {"title": True, "created_at": True, "_id": True},
+            ),
+            (
+                [],
+                ["text", "_id"],
+                [],
+                {
+                    "text": False,
+                    "_id": False,
+                    "text_file": False,
+                    "title_lower": False,
+                },
+            ),
+            (
+                [],
+                ["text", "_id"],
+                ["_id"],
+                {"text": False, "text_file": False, "title_lower": False},
+            ),
+        ],
+    )
+    def test_get_projection_param_valid_params(
+        self, fields, excluded_fields, required_fields, expected
+    ):
+        projection = self.client.get_projection_param(
+            fields, excluded_fields, required_fields
+        )
+        assert projection == expected
+
+    @pytest.mark.parametrize(
+        "fields,excluded_fields,error",
+        [
+            (["title"], ["text"], InvalidQuery),
+            (["q"], [], InvalidParam),
+            ([], ["title,"], InvalidParam),
+        ],
+    )
+    def test_get_projection_param_invalid_params(
+        self, fields, excluded_fields, error
+    ):
+        with pytest.raises(error):
+            self.client.get_projection_param(fields, excluded_fields)
+
+    @pytest.mark.parametrize(
+        "expr,expected",
+        [
+            (
+                "created_at",
+                (
+                    "created_at",
+                    {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+                ),
+            ),
+            (
+                "last_modified:year",
+                (
+                    "last_modified",
+                    {"$dateToString": {"format": "%Y", "date": "$last_modified"}},
+                ),
+            ),
+            ("title", ("title", {"$substrCP": ["$title", 0, 1]})),
+            ("title:3", ("title", {"$substrCP": ["$title", 0, 3]})),
+        ],
+    )
+    def test_get_facet_param_valid_params(self, expr, expected):
+        name, pipeline = self.client.get_facet_param(expr)
+        assert (name, pipeline[0]["$group"]["_id"]) == expected
+
+    @pytest.mark.parametrize(
+        "expr,error",
+        [
+            ("q", InvalidParam),
+            ("created_at:week", InvalidValue),
+            ("title:0", InvalidValue),
+            ("title:a", InvalidValue),
+        ],
+    )
+    def test_get_facet_param_invalid_params(self, expr, error):
+        with pytest.raises(error):
+            self.client.get_facet_param(expr)
+
+    def test_create_facet_pipeline(self):
+        find_query = {
+            "filter": {"title": "title"},
+            "projection": {"title": True},
+            "sort": [("created_at", -1), ("_id", -1)],
+            "limit": 10,
+        }
+        facet = self.client.get_facet_param("created_at")
+
+        assert self.client.create_facet_pipeline(find_query, [facet]) == [
+            {"$match": {"title": "title"}},
+            {
+                "$facet": {
+                    "created_at": facet[1],
+                    "messages": [
+                        {"$sort": {"created_at": -1, "_id": -1}},
+                        {"$limit": 10},
+                        {"$project": {"title": True}},
+                    ],
+                }
+            },
+        ]
+
+    def test_create_facet_query(self):
+        cursor = encode_cursor(["title", 1])
+        facet_query = self.client.create_facet_query(
+            MultiDict({"title": "rg:a", "sort": "-title", "after": cursor})
+        )
+        keyset = facet_query.pop("keyset")
+
+        assert facet_query == self.client.create_find_query(
+            MultiDict({"title": "rg:a", "sort": "-title"})
+        )
+        assert keyset == self.client.create_keyset_condition(
+            facet_query["sort"], cursor
+        )
+        pipeline = self.client.create_facet_pipeline(
+            {**facet_query, "keyset": keyset}, []
+        )
+        assert pipeline[0] == {"$match": facet_query["filter"]}
+        assert pipeline[1]["$facet"]["messages"][0] == {"$match": keyset}
+
+    @pytest.mark.parametrize(
+        "url_query,expected",
+        [
+            ({"limit": "5", "sort": "title"}, {"filter": None, "limit": 0}),
+            ({"max_count": "10"}, {"filter": None, "limit": 10}),
+            (
+                {"title": "rg:a", "fields": "title", "max_count": "10"},
+                {"filter": {"$and": [{"title": {"$regex": "a"}}]}, "limit": 10},
+            ),
+        ],
+    )
+    def test_create_count_query(self, url_query, expected):
+        query = self.client.create_count_query(MultiDict(url_query))
+        assert query == expected
+
+    def test_get_ids_param(self):
+        ids = [str(ObjectId()), str(ObjectId())]
+        expected = [ObjectId(ids[1]), ObjectId(ids[0])]
+        assert self.client.get_ids_param([ids[1], ids[0], ids[1]]) == expected
+
+    @pytest.mark.parametrize(
+        "ids", [None, "id", [1], [], ["z" * 24], [str(ObjectId())] * 1001]
+    )
+    def test_get_ids_param_invalid_params(self, ids):
+        with pytest.raises(InvalidValue):
+            self.client.get_ids_param(ids)
+
+    def test_create_multi_get_query(self):
+        ids = [ObjectId()]
+        query = self.client.create_multi_get_query(
+            ids, MultiDict({"fields": "title"})
+        )
+        assert query == {
+            "filter": {"_id": {"$in": ids}},
+            "projection": {"title": True, "_id": True},
+        }
+        with pytest.raises(InvalidQuery):
+            self.client.create_multi_get_query(ids, MultiDict({"sort": "title"}))
+
     @pytest.mark.parametrize("param,expected", [("3", 3), (None, 0)])
     def test_get_limit_param_valid_params(self, param, expected):
         assert self.client.get_limit_param(param) == expected
@@ -269,6 +615,103 @@ class TestDatabaseClient:
             self.client.get_limit_param(param)
 
 
+def test_get_db_config_from_environment(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost")
+    monkeypatch.setenv("MONGODB_MAX_POOL_SIZE", "10")
+
+    config = get_db_config()
+
+    assert get_db_host(config) == "mongodb://localhost"
+    assert get_client_options(config) == {"maxPoolSize": 10}
+
+
+def test_default_compressors():
+    # zlib is always available, and the fastest compressors come first
+    assert get_default_compressors()[-1] == "zlib"
+
+
+def test_database_client_is_created_lazily_per_process(monkeypatch):
+    clients = []
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost")
+    monkeypatch.setattr(
+        DatabaseClient,
+        "create_client",
+        lambda self, config: clients.append(get_db_host(config)),
+    )
+    db = DatabaseClient()
+    assert clients == []
+
+    db.conn
+    db.conn
+    assert clients == ["mongodb://localhost"]
+
+    # simulates a fork
+    db._pid = None
+    db.conn
+    assert len(clients) == 2
+
+
+@pytest.mark.parametrize(
+    "query_dict",
+    [
+        MultiDict(
+            [("title", "rg:a"), ("created_at", "lt:2021"), ("created_at", "gt:2020")]
+        ),
+        MultiDict(
+            [("created_at", "gt:2020"), ("created_at", "lt:2021"), ("title", "rg:a")]
+        ),
+    ],
+)
+def test_normalize_query_dict(query_dict):
+    assert normalize_query_dict(query_dict) == (
+        (("created_at", ("gt", "lt")), ("title", ("rg",))),
+        (("2020", "2021"), ("a",)),
+    )
+
+
+def test_compile_query_shape_is_cached():
+    shape = (("created_at", ("gt", "xx")), ("title", ("rg",)))
+    compile_query_shape(shape)
+    hits = compile_query_shape.cache_info().hits
+
+    created_at, title = compile_query_shape(shape)
+
+    assert compile_query_shape.cache_info().hits == hits + 1
+    assert created_at[2] == (("gt", "$gt"), ("xx", None))
+    assert title[2] == (("rg", "$regex"),)
+
+
+@pytest.mark.parametrize(
+    "pattern,expected",
+    [
+        ("^abc", ("abc", True)),
+        (r"^a\.b", ("a.b", True)),
+        ("^abc?", ("ab", False)),
+        ("^ab+c", ("ab", False)),
+        (r"^ab\d", ("ab", False)),
+        ("^ab(c)", ("ab", False)),
+        ("abc", ("", False)),
+        ("^ab|cd", ("", False)),
+    ],
+)
+def test_get_regex_prefix(pattern, expected):
+    assert get_regex_prefix(pattern) == expected
+
+
+@pytest.mark.parametrize(
+    "prefix,expected",
+    [
+        ("abc", "abd"),
+        ("a\ud7ff", "a\ue000"),
+        ("a\U0010ffff", "b"),
+        ("\U0010ffff", None),
+    ],
+)
+def test_get_prefix_bound(prefix, expected):
+    assert get_prefix_bound(prefix) == expected
+
+
 @pytest.mark.parametrize(
     "date,expected",
     [
@@ -0,0 +1,58 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+from werkzeug.http import http_date
+
+from .serialization import JSON_BACKENDS, format_http_date, orjson
+
+BACKENDS = [
+    pytest.param(
+        name,
+        marks=pytest.mark.skipif(
+            name == "orjson" and orjson is None, reason="orjson isn't installed"
+        ),
+    )
+    for name in JSON_BACKENDS
+]
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        datetime(2020, 1, 5, 3, 4, 5, 999999),
+        datetime(2020, 1, 5, 23, 4, 5, tzinfo=timezone(timedelta(hours=-3))),
+        datetime(2026, 10, 18),
+    ],
+)
+def test_format_http_date(value):
+    assert format_http_date(value) == http_date(value)
+
+
+def test_format_http_date_with_date():
+    assert format_http_date(date(1999, 12, 31)) == "Fri, 31 Dec 1999 00:00:00 GMT"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_dumps(backend):
+    id = ObjectId()
+    message = {
+        "_id": id,
+        "title": "título",
+        "created_at": datetime(2020, 1, 1, 12),
+        "tags": [1, 2.5, None, True],
+    }
+
+    assert json.loads(JSON_BACKENDS[backend](message)) == {
+        "_id": str(id),
+        "title": "título",
+        "created_at": "Wed, 01 Jan 2020 12:00:00 GMT",
+        "tags": [1, 2.5, None, True],
+    }
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_dumps_unknown_type(backend):
+    with pytest.raises(TypeError):
+        JSON_BACKENDS[backend]({"a": object()})
@@ -0,0 +1,168 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from . import app, slow_queries
+from .slow_queries import (
+    SLOW_QUERY_LOG,
+    SlowQueryLog,
+    TimedCursor,
+    normalize_filter,
+    summarize_explain,
+)
+from .views.message import MessageView
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+def test_normalize_filter():
+    query = {
+        "$and": [
+            {"$text": {"$search": "sheep", "$caseSensitive": False}},
+            {"created_at": {"$gt": 1, "$lt": 2}},
+        ]
+    }
+
+    assert normalize_filter(query) == {
+        "$and": [
+            {"$text": {"$search": "?", "$caseSensitive": "?"}},
+            {"created_at": {"$gt": "?", "$lt": "?"}},
+        ]
+    }
+
+
+@pytest.mark.parametrize(
+    "winning_plan",
+    [
+        {
+            "stage": "LIMIT",
+            "inputStage": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexName": "title_keyset"},
+            },
+        },
+        {
+            "queryPlan": {
+                "stage": "FETCH",
+                "inputStages": [{"stage": "IXSCAN", "indexName": "title_keyset"}],
+            },
+            "slotBasedPlan": {},
+        },
+    ],
+)
+def test_summarize_explain(winning_plan):
+    summary = summarize_explain(
+        {
+            "queryPlanner": {"winningPlan": winning_plan},
+            "executionStats": {
+                "nReturned": 1,
+                "totalDocsExamined": 2,
+                "totalKeysExamined": 3,
+            },
+        }
+    )
+
+    assert summary["stages"][-1] == "IXSCAN"
+    assert summary["indexes"] == ["title_keyset"]
+    assert not summary["collection_scan"]
+    assert (summary["docs_examined"], summary["keys_examined"]) == (2, 3)
+
+
+def test_record_only_keeps_slow_queries():
+    log = SlowQueryLog(threshold_ms=10, sample_rate=0, size=1)
+    find_query = {"filter": {"title": "a"}, "sort": [("_id", 1)], "limit": 0}
+
+    assert log.record(find_query, 0.001) is None
+    assert log.record(find_query, 0.02) is None
+    assert log.record(find_query, 0.03) is None
+
+    assert [e["duration_ms"] for e in log.get_entries()] == [30]
+
+
+def test_timed_cursor_only_counts_the_cursor():
+    def slow_cursor():
+        time.sleep(0.01)
+        yield 1
+
+    cursor = TimedCursor(slow_cursor())
+    for _ in cursor:
+        time.sleep(0.05)
+
+    assert 0.01 <= cursor.seconds < 0.05
+
+
+def test_coalesced_queries_are_logged_once(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def find(**find_query):
+        started.set()
+        release.wait(5)
+        return []
+
+    observed = []
+    monkeypatch.setattr(SLOW_QUERY_LOG, "observe", lambda *args: observed.append(1))
+    view = MessageView(SimpleNamespace(message=SimpleNamespace(find=find)))
+    find_query = {"filter": {"title": "coalesced"}, "sort": [], "limit": 0}
+
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(view.find_messages, find_query)
+        started.wait(5)
+        second = executor.submit(view.find_messages, find_query)
+        time.sleep(0.05)
+        release.set()
+
+    assert first.result() == second.result() == []
+    assert observed == [1]
+
+
+@pytest.mark.parametrize(
+    "token,headers,status",
+    [
+        (None, {"Authorization": "Bearer "}, 404),
+        ("secret", {}, 401),
+        ("secret", {"Authorization": "Bearer other"}, 401),
+        ("secret", {"Authorization": "Basic secret"}, 401),
+        ("secret", {"Authorization": "Bearer secret"}, 200),
+    ],
+)
+def test_slow_queries_need_the_token(client, monkeypatch, token, headers, status):
+    monkeypatch.setattr(slow_queries, "ADMIN_TOKEN", token)
+
+    res = client.get("/admin/slow-queries", headers=headers)
+
+    assert res.status_code == status
+    if status == 401:
+        assert res.headers["WWW-Authenticate"] == "Bearer"
+
+
+def test_get_slow_queries(client, monkeypatch):
+    monkeypatch.setattr(slow_queries, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(SLOW_QUERY_LOG, "threshold_ms", 0)
+    monkeypatch.setattr(SLOW_QUERY_LOG, "sample_rate", 1)
+    SLOW_QUERY_LOG.entries.clear()
+
+    # an unanchored regex can't use the title index
+    client.get("/api/messages?title=rg:sheep&sort=text&limit=5")
+    # the plan is explained in the background
+    for _ in range(100):
+        if SLOW_QUERY_LOG.entries[-1]["plan"] is not None:
+            break
+        time.sleep(0.01)
+    res = client.get(
+        "/admin/slow-queries?collection_scans=true",
+        headers={"Authorization": "Bearer secret"},
+    )
+    SLOW_QUERY_LOG.entries.clear()
+
+    assert res.status_code == 200
+    [query] = res.json["queries"]
+    assert query["filter"] == {"$and": [{"title": {"$regex": "?"}}]}
+    assert query["sort"] == [["text", 1], ["_id", 1]]
+    assert query["plan"]["collection_scan"]
@@ -0,0 +1,209 @@
+import json
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+from . import app, text_files
+from .mongodb import DatabaseClient
+from .text_files import BUCKET_NAME, PREVIEW_LENGTH, get_byte_range, split_text
+
+OFFLOAD_SIZE = 16 * 1024
+LARGE_TEXT = "é" + "large text " * (OFFLOAD_SIZE // 10)
+
+
+@pytest.fixture(autouse=True)
+def offload(monkeypatch):
+    monkeypatch.setattr(text_files, "OFFLOAD_SIZE", OFFLOAD_SIZE)
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def db():
+    db = DatabaseClient()
+    yield db
+    db.close()
+
+
+def get_file_count(db):
+    return db._db[f"{BUCKET_NAME}.files"].count_documents({})
+
+
+def post_message(client, text, title="offloaded"):
+    res = client.post("/api/messages", json={"text": text, "title": title})
+    assert res.status_code == 201
+    return res.json["inserted_ids"][0]
+
+
+def test_split_text():
+    assert split_text({"text": "small"}) == ({"text": "small"}, None)
+    assert split_text({"title": "no text"}) == ({"title": "no text"}, None)
+
+    fields, data = split_text({"title": "title", "text": LARGE_TEXT})
+    assert fields == {"title": "title", "text": LARGE_TEXT[:PREVIEW_LENGTH]}
+    assert data == LARGE_TEXT.encode()
+
+
+def test_large_texts_stay_inline_and_searchable_by_default(client, monkeypatch):
+    monkeypatch.setattr(text_files, "OFFLOAD_SIZE", 0)
+    assert split_text({"text": LARGE_TEXT}) == ({"text": LARGE_TEXT}, None)
+
+    id = post_message(client, LARGE_TEXT + " haystack", title="inline")
+    res = client.get("/api/messages?text=rg:haystack&fields=title")
+    client.delete(f"/api/messages/{id}")
+
+    assert [m["_id"] for m in res.json["messages"]] == [id]
+
+
+@pytest.mark.parametrize(
+    "headers,expected",
+    [
+        ({}, None),
+        ({"Range": "bytes=0-9"}, (0, 10)),
+        ({"Range": "bytes=90-"}, (90, 100)),
+        ({"Range": "bytes=-10"}, (90, 100)),
+        ({"Range": "bytes=90-200"}, (90, 100)),
+        ({"Range": "bytes=0-1,5-6"}, None),
+        ({"Range": "lines=0-1"}, None),
+        ({"Range": "bytes=0-9", "If-Range": '"etag"'}, (0, 10)),
+        ({"Range": "bytes=0-9", "If-Range": '"other"'}, None),
+    ],
+)
+def test_get_byte_range(headers, expected):
+    assert get_byte_range(Headers(headers), 100, "etag") == expected
+
+
+def test_get_byte_range_not_satisfiable():
+    with pytest.raises(RequestedRangeNotSatisfiable):
+        get_byte_range(Headers({"Range": "bytes=100-"}), 100, "etag")
+
+
+def test_large_text_is_offloaded(client, db):
+    id = post_message(client, LARGE_TEXT)
+
+    message = db.message.find_one(ObjectId(id))
+    assert message["text"] == LARGE_TEXT[:PREVIEW_LENGTH]
+    assert message["text_file"]["length"] == len(LARGE_TEXT.encode())
+    res = client.get(f"/api/messages/{id}?fields=text")
+    assert set(res.json) == {"_id", "text", "text_file", "last_modified"}
+
+    res = client.get(f"/api/messages/{id}/text")
+    assert res.status_code == 200
+    assert res.headers["Accept-Ranges"] == "bytes"
+    assert res.get_data(as_text=True) == LARGE_TEXT
+
+    client.delete(f"/api/messages/{id}")
+
+
+def test_get_text_range(client):
+    id = post_message(client, LARGE_TEXT)
+
+    res = client.get(f"/api/messages/{id}/text", headers={"Range": "bytes=2-11"})
+    assert res.status_code == 206
+    assert res.data == LARGE_TEXT.encode()[2:12]
+    length = len(LARGE_TEXT.encode())
+    assert res.headers["Content-Range"] == f"bytes 2-11/{length}"
+    assert res.headers["Content-Length"] == "10"
+
+    range_header = f"bytes={length}-"
+    res = client.get(f"/api/messages/{id}/text", headers={"Range": range_header})
+    assert res.status_code == 416
+
+    client.delete(f"/api/messages/{id}")
+
+
+def test_get_inline_text_range(client):
+    id = post_message(client, "small text")
+
+    res = client.get(f"/api/messages/{id}/text", headers={"Range": "bytes=-4"})
+    assert res.status_code == 206
+    assert res.data == b"text"
+    assert client.get(f"/api/messages/{id}/text").data == b"small text"
+
+    client.delete(f"/api/messages/{id}")
+
+
+def test_replaced_and_deleted_texts_release_their_files(client, db):
+    file_count = get_file_count(db)
+    id = post_message(client, LARGE_TEXT)
+    assert get_file_count(db) == file_count + 1
+
+    client.put(f"/api/messages/{id}", json={"text": LARGE_TEXT + "!"})
+    assert get_file_count(db) == file_count + 1
+    assert client.get(f"/api/messages/{id}/text").data.endswith(b"!")
+
+    client.put(f"/api/messages/{id}", json={"text": "inline"})
+    assert get_file_count(db) == file_count
+    assert "text_file" not in db.message.find_one(ObjectId(id))
+
+    client.put(f"/api/messages/{id}", json={"text": LARGE_TEXT})
+    client.delete(f"/api/messages/{id}")
+    assert get_file_count(db) == file_count
+
+
+def test_messages_updated_together_share_a_file(client, db):
+    file_count = get_file_count(db)
+    ids = [post_message(client, "small", title="shared text") for _ in range(2)]
+
+    client.put("/api/messages?title=rg:^shared text$", json={"text": LARGE_TEXT})
+    assert get_file_count(db) == file_count + 1
+
+    client.delete(f"/api/messages/{ids[0]}")
+    assert get_file_count(db) == file_count + 1
+    assert client.get(f"/api/messages/{ids[1]}/text").data == LARGE_TEXT.encode()
+    client.delete(f"/api/messages/{ids[1]}")
+    assert get_file_count(db) == file_count
+
+
+def test_bulk_operations_release_replaced_files(client, db):
+    file_count = get_file_count(db)
+    ids = [post_message(client, LARGE_TEXT) for _ in range(2)]
+
+    res = client.post(
+        "/api/messages/_bulk",
+        json=[
+            {"op": "update", "_id": ids[0], "message": {"text": "inline"}},
+            {"op": "delete", "_id": ids[1]},
+            {"op": "insert", "message": {"text": LARGE_TEXT}},
+        ],
+    )
+
+    assert res.status_code == 200
+    assert get_file_count(db) == file_count + 1
+    client.delete(f"/api/messages/{ids[0]}")
+    client.delete(f"/api/messages/{res.json['results'][2]['_id']}")
+    assert get_file_count(db) == file_count
+
+
+def test_failed_updates_release_their_files(client, db):
+    file_count = get_file_count(db)
+
+    assert client.put("/api/messages", json={"text": LARGE_TEXT}).status_code == 400
+    res = client.put("/api/messages/zzz", json={"text": LARGE_TEXT})
+    assert res.status_code == 400
+    assert get_file_count(db) == file_count
+
+
+def test_failed_imports_release_their_files(client, db, monkeypatch):
+    def insert_many(documents, ordered=True):
+        raise AutoReconnect("connection lost")
+
+    # the text files are still written, only the messages fail
+    monkeypatch.setattr(db.message, "insert_many", insert_many)
+    file_count = get_file_count(db)
+
+    res = client.post(
+        "/api/messages/_import",
+        data=json.dumps({"text": LARGE_TEXT}),
+        content_type="application/x-ndjson",
+    )
+
+    assert res.status_code == 500
+    assert get_file_count(db) == file_count
@@ -0,0 +1,161 @@
+import os
+
+import gridfs
+from gridfs.errors import NoFile
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_range_header
+
+from .memorydb import (
+    AsyncMemoryDatabase,
+    AsyncMemoryGridFSBucket,
+    MemoryDatabase,
+    MemoryGridFSBucket,
+)
+
+BUCKET_NAME = "message_text"
+# texts above this many bytes are stored in GridFS, with a preview inline. Text
+# filters only see the preview of those, so it's off (0) unless configured
+OFFLOAD_SIZE = int(os.environ.get("TEXT_OFFLOAD_SIZE", 0))
+PREVIEW_LENGTH = int(os.environ.get("TEXT_PREVIEW_LENGTH", 500))
+READ_SIZE = 64 * 1024
+
+
+def get_bucket(db):
+    if isinstance(db, MemoryDatabase):
+        return MemoryGridFSBucket(db, BUCKET_NAME)
+    return gridfs.GridFSBucket(db, BUCKET_NAME)
+
+
+def get_async_bucket(db):
+    if isinstance(db, AsyncMemoryDatabase):
+        return AsyncMemoryGridFSBucket(db, BUCKET_NAME)
+    return gridfs.AsyncGridFSBucket(db, BUCKET_NAME)
+
+
+def split_text(fields):
+    # returns the fields to store and the text to offload, if any
+    text = fields.get("text")
+    if text is None:
+        return fields, None
+    data = text.encode()
+    if not OFFLOAD_SIZE or len(data) <= OFFLOAD_SIZE:
+        return fields, None
+    return {**fields, "text": text[:PREVIEW_LENGTH]}, data
+
+
+def create_text_file(file_id, data):
+    return {"_id": file_id, "length": len(data)}
+
+
+def offload_text(bucket, fields):
+    fields, data = split_text(fields)
+    if data is not None:
+        file_id = bucket.upload_from_stream("text", data)
+        fields["text_file"] = create_text_file(file_id, data)
+    return fields
+
+
+async def offload_text_async(bucket, fields):
+    fields, data = split_text(fields)
+    if data is not None:
+        file_id = await bucket.upload_from_stream("text", data)
+        fields["text_file"] = create_text_file(file_id, data)
+    return fields
+
+
+def get_file_ids_query(query):
+    return {"$and": [query, {"text_file": {"$exists": True}}]}
+
+
+def get_file_ids(messages):
+    return [message["text_file"]["_id"] for message in messages]
+
+
+def get_new_file_ids(fields):
+    # a file nothing ends up referencing (no message matched) is released too
+    return [fields["text_file"]["_id"]] if "text_file" in fields else []
+
+
+def find_text_file_ids(collection, query):
+    return get_file_ids(collection.find(get_file_ids_query(query), ["text_file"]))
+
+
+async def find_text_file_ids_async(collection, query):
+    cursor = collection.find(get_file_ids_query(query), ["text_file"])
+    return get_file_ids(await cursor.to_list(None))
+
+
+def release_text_files(collection, bucket, file_ids):
+    # messages updated together share a file, so only unreferenced ones go
+    for file_id in set(file_ids):
+        if collection.find_one({"text_file._id": file_id}, ["_id"]) is None:
+            try:
+                bucket.delete(file_id)
+            except NoFile:
+                pass
+
+
+async def release_text_files_async(collection, bucket, file_ids):
+    for file_id in set(file_ids):
+        if await collection.find_one({"text_file._id": file_id}, ["_id"]) is None:
+            try:
+                await bucket.delete(file_id)
+            except NoFile:
+                pass
+
+
+def get_text_length(message):
+    if "text_file" in message:
+        return message["text_file"]["length"]
+    return len(message["text"].encode())
+
+
+def get_byte_range(headers, length, etag):
+    # None means the whole text; several ranges are answered that way too
+    range_header = headers.get("Range")
+    if range_header is None:
+        return None
+    if_range = headers.get("If-Range")
+    if if_range is not None and if_range.strip() != f'"{etag}"':
+        return None
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != "bytes" or len(parsed.ranges) != 1:
+        return None
+
+    byte_range = parsed.range_for_length(length)
+    if byte_range is None:
+        raise RequestedRangeNotSatisfiable(length=length)
+    return byte_range
+
+
+def set_range_headers(response, length, byte_range):
+    start, end = byte_range or (0, length)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Length"] = str(end - start)
+    if byte_range is not None:
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{end - 1}/{length}"
+    return response
+
+
+def read_text_file(grid_out, start, length):
+    grid_out.seek(start)
+    while length > 0:
+        data = grid_out.read(min(READ_SIZE, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
+
+
+async def read_text_file_async(grid_out, start, length):
+    try:
+        await grid_out.seek(start)
+        while length > 0:
+            data = await grid_out.read(min(READ_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        await grid_out.close()
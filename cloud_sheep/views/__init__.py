@@ -1,4 +1,8 @@
 from .message import MessageView
+from .message_bulk import MessageBulkView
+from .message_import import MessageImportView
+from .message_mget import MessageMultiGetView
+from .message_text import MessageTextView
 
 views = {}
 
@@ -7,6 +11,10 @@ def setup_views(*, db):
     global views
     views = {
         "message_view": MessageView.as_view("get_message", db),
+        "message_import_view": MessageImportView.as_view("import_messages", db),
+        "message_text_view": MessageTextView.as_view("get_message_text", db),
+        "message_mget_view": MessageMultiGetView.as_view("get_messages_by_id", db),
+        "message_bulk_view": MessageBulkView.as_view("bulk_messages", db),
     }
 
 
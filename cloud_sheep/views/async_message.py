@@ -0,0 +1,375 @@
+import time
+from functools import wraps
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+from quart import Response, abort, request
+from quart.views import MethodView
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
+
+from ..admission import limit_bulk_writes_async
+from ..batching import ASYNC_MESSAGE_INSERTS
+from ..coalescing import ASYNC_QUERY_FLIGHTS, get_query_key
+from ..entities.message import create_message, create_message_update
+from ..metrics import DOCUMENTS_RETURNED
+from ..serialization import JSON_MIMETYPE, dumps, json_response
+from ..slow_queries import SLOW_QUERY_LOG, TimedCursor
+from ..text_files import (
+    find_text_file_ids_async,
+    get_byte_range,
+    get_new_file_ids,
+    get_text_length,
+    offload_text_async,
+    read_text_file_async,
+    release_text_files_async,
+    set_range_headers,
+)
+from .message import (
+    NDJSON_MIMETYPE,
+    create_count_result,
+    format_facet_result,
+    format_multi_get_result,
+    get_ids_from_url,
+    get_list_mimetype,
+    get_message_etag,
+    make_json_response,
+    set_count_headers,
+    set_message_version,
+)
+from .message_mget import get_ids_from_body
+from .message_stream import (
+    EVENT_STREAM_HEADERS,
+    EVENT_STREAM_MIMETYPE,
+    HEARTBEAT,
+    create_watch_options,
+    format_change,
+    get_resume_token,
+    raise_for_history_lost,
+)
+from .message_text import TEXT_FIELDS, TEXT_MIMETYPE
+
+
+def handle_message(view):
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        return make_json_response(await view(*args, **kwargs), Response)
+
+    return wrapper
+
+
+def get_conditional_environ():
+    # is_resource_modified only reads these keys of a WSGI environ
+    return {
+        "REQUEST_METHOD": request.method,
+        "HTTP_IF_NONE_MATCH": request.headers.get("If-None-Match", ""),
+        "HTTP_IF_MODIFIED_SINCE": request.headers.get("If-Modified-Since", ""),
+    }
+
+
+async def generate_ndjson(messages, get_next_cursor):
+    message, count = None, 0
+    async for message in messages:
+        count += 1
+        yield dumps(message) + b"\n"
+
+    next_cursor = get_next_cursor(message, count)
+    if next_cursor is not None:
+        yield dumps({"next": next_cursor}) + b"\n"
+
+
+async def generate_json(messages, get_next_cursor):
+    message, count = None, 0
+    yield b'{"messages":['
+    async for message in messages:
+        count += 1
+        yield (b"," if count > 1 else b"") + dumps(message)
+    yield b"]"
+
+    next_cursor = get_next_cursor(message, count)
+    if next_cursor is not None:
+        yield b',"next":' + dumps(next_cursor)
+    yield b"}"
+
+
+async def get_messages_by_id_async(db, ids, url_query):
+    ids = db.get_ids_param(ids)
+    multi_get_query = db.create_multi_get_query(ids, url_query)
+    messages = await db.message.find(**multi_get_query).to_list(None)
+    return format_multi_get_result(ids, messages)
+
+
+class AsyncMessageView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    async def dispatch_request(self, *args, **kwargs):
+        await self.db.load_collection_size()
+        return await super().dispatch_request(*args, **kwargs)
+
+    @handle_message
+    async def get(self, id=None):
+        url_query = MultiDict(request.args)
+        if id is None:
+            return await self.get_many(url_query)
+        else:
+            return await self.get_one(id, url_query)
+
+    async def get_one(self, id, url_query):
+        # last_modified is always returned since it versions the message
+        projection = self.db.get_projection_param(
+            url_query.poplist("fields"),
+            url_query.poplist("-fields"),
+            ["last_modified"],
+        )
+        if request.if_none_match or request.if_modified_since:
+            # checks the version without fetching the (possibly large) message
+            version = await self.db.message.find_one(ObjectId(id), ["last_modified"])
+            if not version:
+                abort(404)
+            response = set_message_version(
+                Response("", status=304), id, version, projection
+            )
+            if not is_resource_modified(
+                get_conditional_environ(),
+                response.get_etag()[0],
+                last_modified=response.last_modified,
+            ):
+                return response
+
+        message = await self.db.message.find_one(ObjectId(id), projection)
+        if not message:
+            abort(404)
+        return set_message_version(
+            json_response(message, response_class=Response), id, message, projection
+        )
+
+    async def head(self, id=None):
+        if id is not None:
+            return await self.get(id)
+        count_query = self.db.create_count_query(MultiDict(request.args))
+        result = await self.count(count_query)
+        return set_count_headers(Response("", mimetype=JSON_MIMETYPE), result)
+
+    async def get_many(self, url_query):
+        if "ids" in url_query:
+            ids = get_ids_from_url(url_query)
+            return await get_messages_by_id_async(self.db, ids, url_query)
+        stream_param = self.db.get_bool_param(
+            "stream", url_query.pop("stream", default=None)
+        )
+        if self.db.get_bool_param("count", url_query.pop("count", default=None)):
+            result = await self.count(self.db.create_count_query(url_query))
+            response = json_response(result, response_class=Response)
+            return set_count_headers(response, result)
+        facets = [self.db.get_facet_param(e) for e in url_query.poplist("facets")]
+        if facets:
+            facet_query = self.db.create_facet_query(url_query)
+            return await self.get_facets(facet_query, facets)
+        find_query = self.db.create_find_query(url_query)
+
+        def get_next_cursor(last_message, count):
+            DOCUMENTS_RETURNED.observe(count, operation="find")
+            return self.db.create_next_cursor(find_query, last_message, count)
+
+        mimetype = get_list_mimetype(request.accept_mimetypes)
+        if mimetype == NDJSON_MIMETYPE:
+            generate = generate_ndjson
+        elif stream_param:
+            generate = generate_json
+        else:
+            messages = await self.find_messages(find_query)
+            last_message = messages[-1] if messages else None
+            next_cursor = get_next_cursor(last_message, len(messages))
+            if next_cursor is not None:
+                return {"messages": messages, "next": next_cursor}
+            return {"messages": messages}
+
+        messages = TimedCursor(self.db.message.find(**find_query))
+
+        def get_timed_next_cursor(last_message, count):
+            self.observe_query(find_query, messages.seconds)
+            return get_next_cursor(last_message, count)
+
+        return Response(generate(messages, get_timed_next_cursor), mimetype=mimetype)
+
+    async def find_messages(self, find_query):
+        async def find():
+            start_time = time.perf_counter()
+            messages = await self.db.message.find(**find_query).to_list(None)
+            self.observe_query(find_query, time.perf_counter() - start_time)
+            return messages
+
+        return await ASYNC_QUERY_FLIGHTS.do(get_query_key(find_query), find)
+
+    def observe_query(self, find_query, seconds):
+        SLOW_QUERY_LOG.observe_async(
+            find_query, seconds, lambda: self.explain(find_query)
+        )
+
+    async def count(self, count_query):
+        if count_query["filter"] is None:
+            count = await self.db.message.estimated_document_count()
+        elif count_query["limit"]:
+            count = await self.db.message.count_documents(
+                count_query["filter"], limit=count_query["limit"] + 1
+            )
+        else:
+            count = await self.db.message.count_documents(count_query["filter"])
+        return create_count_result(count, count_query["limit"])
+
+    async def explain(self, find_query):
+        return await self.db.message.find(
+            find_query["filter"], sort=find_query["sort"], limit=find_query["limit"]
+        ).explain()
+
+    async def get_facets(self, find_query, facets):
+        pipeline = self.db.create_facet_pipeline(find_query, facets)
+        [result] = await (await self.db.message.aggregate(pipeline)).to_list(None)
+        return format_facet_result(self.db, find_query, result)
+
+    async def post(self):
+        bucket = self.db.text_bucket
+        body = await request.get_json()
+        if isinstance(body, list):
+            messages = [
+                await offload_text_async(bucket, create_message(**m)) for m in body
+            ]
+            res = await self.db.message.insert_many(messages)
+            assert res.acknowledged
+            inserted_ids = res.inserted_ids
+        else:
+            message = await offload_text_async(bucket, create_message(**body))
+            inserted_ids = [await self.insert_one(message)]
+
+        return {"inserted_ids": list(map(str, inserted_ids))}, 201
+
+    async def insert_one(self, message):
+        if ASYNC_MESSAGE_INSERTS.enabled:
+            return await ASYNC_MESSAGE_INSERTS.insert(self.db.message, message)
+        res = await self.db.message.insert_one(message)
+        assert res.acknowledged
+        return res.inserted_id
+
+    def get_write_query(self, id):
+        if id is None:
+            return self.db.create_query_from_dict(MultiDict(request.args))
+        return {"_id": ObjectId(id)}
+
+    @limit_bulk_writes_async
+    async def put(self, id=None):
+        bucket = self.db.text_bucket
+        query = self.get_write_query(id)
+        update = await offload_text_async(
+            bucket, create_message_update(**await request.get_json())
+        )
+        file_ids = get_new_file_ids(update)
+        try:
+            if "text" in update:
+                replaced = await find_text_file_ids_async(self.db.message, query)
+                file_ids.extend(replaced)
+
+            update_query = self.db.create_update_query(update)
+            if id is None:
+                res = await self.db.message.update_many(query, update_query)
+            else:
+                res = await self.db.message.update_one(query, update_query)
+        finally:
+            await release_text_files_async(self.db.message, bucket, file_ids)
+        assert id is None or res.matched_count == 1
+
+        assert res.acknowledged
+        return {"modified_count": res.modified_count}, 201
+
+    @limit_bulk_writes_async
+    async def delete(self, id=None):
+        bucket = self.db.text_bucket
+        query = self.get_write_query(id)
+        file_ids = await find_text_file_ids_async(self.db.message, query)
+
+        if id is None:
+            res = await self.db.message.delete_many(query)
+        else:
+            res = await self.db.message.delete_one(query)
+        await release_text_files_async(self.db.message, bucket, file_ids)
+
+        assert res.acknowledged
+        return {"deleted_count": res.deleted_count}, 200
+
+
+class AsyncMessageTextView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    async def get(self, id):
+        message = await self.db.message.find_one(ObjectId(id), TEXT_FIELDS)
+        if not message:
+            abort(404)
+
+        etag = get_message_etag(id, message, "text")
+        length = get_text_length(message)
+        byte_range = get_byte_range(request.headers, length, etag)
+        start, end = byte_range or (0, length)
+        if "text_file" in message:
+            file_id = message["text_file"]["_id"]
+            grid_out = await self.db.text_bucket.open_download_stream(file_id)
+            response = Response(
+                read_text_file_async(grid_out, start, end - start),
+                mimetype=TEXT_MIMETYPE,
+            )
+        else:
+            text = message["text"].encode()[start:end]
+            response = Response(text, mimetype=TEXT_MIMETYPE)
+
+        response.set_etag(etag)
+        response.last_modified = message.get("last_modified")
+        return set_range_headers(response, length, byte_range)
+
+
+class AsyncMessageMultiGetView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    @handle_message
+    async def post(self):
+        ids = get_ids_from_body(await request.get_json(silent=True))
+        return await get_messages_by_id_async(self.db, ids, MultiDict(request.args))
+
+
+async def generate_events_async(stream):
+    try:
+        while stream.alive:
+            change = await stream.try_next()
+            yield HEARTBEAT if change is None else format_change(change)
+    finally:
+        await stream.close()
+
+
+class AsyncMessageStreamView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    async def get(self):
+        url_query = MultiDict(request.args)
+        resume_token = get_resume_token(request.headers, url_query)
+        pipeline = self.db.create_change_stream_pipeline(url_query)
+        try:
+            stream = await self.db.message.watch(
+                pipeline, **create_watch_options(resume_token)
+            )
+        except OperationFailure as error:
+            raise_for_history_lost(error)
+            raise
+
+        response = Response(
+            generate_events_async(stream),
+            mimetype=EVENT_STREAM_MIMETYPE,
+            headers=EVENT_STREAM_HEADERS,
+        )
+        # the stream never ends by itself
+        response.timeout = None
+        return response
@@ -1,29 +1,138 @@
+import hashlib
+import time
 from functools import wraps
 
 from bson.objectid import ObjectId
-from flask import abort, request
+from flask import Response, abort, request, stream_with_context
 from flask.views import MethodView
 from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
 
+from ..admission import limit_bulk_writes
+from ..batching import MESSAGE_INSERTS
+from ..coalescing import QUERY_FLIGHTS, get_query_key
 from ..entities.message import create_message, create_message_update
+from ..metrics import DOCUMENTS_RETURNED
+from ..serialization import JSON_MIMETYPE, dumps, json_response
+from ..slow_queries import SLOW_QUERY_LOG, TimedCursor
+from ..text_files import (
+    find_text_file_ids,
+    get_new_file_ids,
+    offload_text,
+    release_text_files,
+)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
 
-def handle_message(view):
-    def serialize_id(message):
-        message["_id"] = str(message["_id"])
-        return message
 
+def get_list_mimetype(accept_mimetypes):
+    return accept_mimetypes.best_match(
+        ["application/json", NDJSON_MIMETYPE], default="application/json"
+    )
+
+
+def format_facet_result(db, find_query, result):
+    messages = result.pop("messages")
+    DOCUMENTS_RETURNED.observe(len(messages), operation="aggregate")
+    res = {
+        "messages": messages,
+        "facets": {
+            name: [{"value": b["_id"], "count": b["count"]} for b in buckets]
+            for name, buckets in result.items()
+        },
+    }
+    last_message = messages[-1] if messages else None
+    next_cursor = db.create_next_cursor(find_query, last_message, len(messages))
+    if next_cursor is not None:
+        res["next"] = next_cursor
+    return res
+
+
+def get_ids_from_url(url_query):
+    params = url_query.poplist("ids")
+    return [id.strip() for param in params for id in param.split(",")]
+
+
+def format_multi_get_result(ids, messages):
+    DOCUMENTS_RETURNED.observe(len(messages), operation="find")
+    messages_by_id = {message["_id"]: message for message in messages}
+    return {
+        "messages": [messages_by_id[id] for id in ids if id in messages_by_id],
+        "missing": [str(id) for id in ids if id not in messages_by_id],
+    }
+
+
+def get_messages_by_id(db, ids, url_query):
+    # a single $in query instead of a find_one per message
+    ids = db.get_ids_param(ids)
+    multi_get_query = db.create_multi_get_query(ids, url_query)
+    messages = list(db.message.find(**multi_get_query))
+    return format_multi_get_result(ids, messages)
+
+
+def get_message_etag(id, message, projection):
+    version = repr((id, message.get("last_modified"), projection)).encode()
+    return hashlib.sha1(version).hexdigest()
+
+
+def set_message_version(response, id, message, projection):
+    response.set_etag(get_message_etag(id, message, projection))
+    response.last_modified = message.get("last_modified")
+    return response
+
+
+def create_count_result(count, max_count):
+    # counted up to max_count + 1, so an exact count of max_count isn't capped
+    capped = bool(max_count) and count > max_count
+    return {"count": min(count, max_count) if capped else count, "capped": capped}
+
+
+def set_count_headers(response, result):
+    response.headers["X-Total-Count"] = str(result["count"])
+    if result["capped"]:
+        response.headers["X-Count-Capped"] = "true"
+    return response
+
+
+def make_json_response(res, response_class=Response):
+    # the encoder handles ObjectIds, so the documents are never rewritten
+    body, status = res if isinstance(res, tuple) else (res, 200)
+    if isinstance(body, dict):
+        return json_response(body, status, response_class=response_class)
+    return res
+
+
+def handle_message(view):
     @wraps(view)
     def wrapper(*args, **kwargs):
-        res = view(*args, **kwargs)
-        if res.get("messages"):
-            return {"messages": list(map(serialize_id, res["messages"]))}
-        else:
-            return serialize_id(res)
+        return make_json_response(view(*args, **kwargs))
 
     return wrapper
 
 
+def generate_ndjson(messages, get_next_cursor):
+    message, count = None, 0
+    for count, message in enumerate(messages, 1):
+        yield dumps(message) + b"\n"
+
+    next_cursor = get_next_cursor(message, count)
+    if next_cursor is not None:
+        yield dumps({"next": next_cursor}) + b"\n"
+
+
+def generate_json(messages, get_next_cursor):
+    message, count = None, 0
+    yield b'{"messages":['
+    for count, message in enumerate(messages, 1):
+        yield (b"," if count > 1 else b"") + dumps(message)
+    yield b"]"
+
+    next_cursor = get_next_cursor(message, count)
+    if next_cursor is not None:
+        yield b',"next":' + dumps(next_cursor)
+    yield b"}"
+
+
 class MessageView(MethodView):
     def __init__(self, db):
         super().__init__()
@@ -31,66 +140,192 @@ class MessageView(MethodView):
 
     @handle_message
     def get(self, id=None):
+        url_query = MultiDict(request.args)
         if id is None:
-            url_query = MultiDict(request.args)
-            limit_param = self.db.get_limit_param(
-                url_query.pop("limit", default=None)
-            )
-            sorting_params = [
-                self.db.get_sort_param(param)
-                for param in url_query.poplist("sort") or ["last_modified"]
-            ]
-            query = self.db.create_query_from_dict(url_query)
-            messages = (
-                self.db.message.find(query).sort(sorting_params).limit(limit_param)
-            )
-            if not messages:
+            return self.get_many(url_query)
+        else:
+            return self.get_one(id, url_query)
+
+    def get_one(self, id, url_query):
+        # last_modified is always returned since it versions the message
+        projection = self.db.get_projection_param(
+            url_query.poplist("fields"),
+            url_query.poplist("-fields"),
+            ["last_modified"],
+        )
+        if request.if_none_match or request.if_modified_since:
+            # checks the version without fetching the (possibly large) message
+            version = self.db.message.find_one(ObjectId(id), ["last_modified"])
+            if not version:
                 abort(404)
+            response = set_message_version(
+                Response(status=304), id, version, projection
+            )
+            if not is_resource_modified(
+                request.environ,
+                response.get_etag()[0],
+                last_modified=response.last_modified,
+            ):
+                return response
+
+        message = self.db.message.find_one(ObjectId(id), projection)
+        if not message:
+            abort(404)
+        return set_message_version(
+            json_response(message, response_class=Response), id, message, projection
+        )
+
+    def head(self, id=None):
+        if id is not None:
+            return self.get(id)
+        count_query = self.db.create_count_query(MultiDict(request.args))
+        result = self.count(count_query)
+        return set_count_headers(Response(mimetype=JSON_MIMETYPE), result)
+
+    def get_many(self, url_query):
+        if "ids" in url_query:
+            ids = get_ids_from_url(url_query)
+            return get_messages_by_id(self.db, ids, url_query)
+        stream_param = self.db.get_bool_param(
+            "stream", url_query.pop("stream", default=None)
+        )
+        if self.db.get_bool_param("count", url_query.pop("count", default=None)):
+            result = self.count(self.db.create_count_query(url_query))
+            response = json_response(result, response_class=Response)
+            return set_count_headers(response, result)
+        facets = [self.db.get_facet_param(e) for e in url_query.poplist("facets")]
+        if facets:
+            facet_query = self.db.create_facet_query(url_query)
+            return self.get_facets(facet_query, facets)
+        find_query = self.db.create_find_query(url_query)
+
+        def get_next_cursor(last_message, count):
+            DOCUMENTS_RETURNED.observe(count, operation="find")
+            return self.db.create_next_cursor(find_query, last_message, count)
+
+        mimetype = get_list_mimetype(request.accept_mimetypes)
+        if mimetype == NDJSON_MIMETYPE:
+            generate = generate_ndjson
+        elif stream_param:
+            generate = generate_json
+        else:
+            messages = self.find_messages(find_query)
+            last_message = messages[-1] if messages else None
+            next_cursor = get_next_cursor(last_message, len(messages))
+            if next_cursor is not None:
+                return {"messages": messages, "next": next_cursor}
             return {"messages": messages}
+
+        messages = TimedCursor(self.db.message.find(**find_query))
+
+        def get_timed_next_cursor(last_message, count):
+            self.observe_query(find_query, messages.seconds)
+            return get_next_cursor(last_message, count)
+
+        return Response(
+            stream_with_context(generate(messages, get_timed_next_cursor)),
+            mimetype=mimetype,
+        )
+
+    def find_messages(self, find_query):
+        # identical listings running at the same time share one query, which
+        # is logged once
+        def find():
+            start_time = time.perf_counter()
+            messages = list(self.db.message.find(**find_query))
+            self.observe_query(find_query, time.perf_counter() - start_time)
+            return messages
+
+        return QUERY_FLIGHTS.do(get_query_key(find_query), find)
+
+    def observe_query(self, find_query, seconds):
+        SLOW_QUERY_LOG.observe(find_query, seconds, lambda: self.explain(find_query))
+
+    def count(self, count_query):
+        # without a filter the collection's metadata has the count
+        if count_query["filter"] is None:
+            count = self.db.message.estimated_document_count()
+        elif count_query["limit"]:
+            count = self.db.message.count_documents(
+                count_query["filter"], limit=count_query["limit"] + 1
+            )
         else:
-            message = self.db.message.find_one(ObjectId(id))
-            if not message:
-                abort(404)
-            return message
+            count = self.db.message.count_documents(count_query["filter"])
+        return create_count_result(count, count_query["limit"])
+
+    def explain(self, find_query):
+        return self.db.message.find(
+            find_query["filter"], sort=find_query["sort"], limit=find_query["limit"]
+        ).explain()
+
+    def get_facets(self, find_query, facets):
+        pipeline = self.db.create_facet_pipeline(find_query, facets)
+        [result] = self.db.message.aggregate(pipeline)
+        return format_facet_result(self.db, find_query, result)
 
     def post(self):
+        bucket = self.db.text_bucket
         if type(request.json) == list:
             messages = [create_message(**m) for m in request.json]
+            messages = [offload_text(bucket, m) for m in messages]
             res = self.db.message.insert_many(messages)
+            assert res.acknowledged
             inserted_ids = res.inserted_ids
         else:
-            message = create_message(**request.json)
-            res = self.db.message.insert_one(message)
-            inserted_ids = [res.inserted_id]
+            message = offload_text(bucket, create_message(**request.json))
+            inserted_ids = [self.insert_one(message)]
 
-        assert res.acknowledged
         return {"inserted_ids": list(map(str, inserted_ids))}, 201
 
-    def put(self, id=None):
-        update = create_message_update(**request.json)
+    def insert_one(self, message):
+        # concurrent single inserts can be written together with insert_many
+        if MESSAGE_INSERTS.is_enabled_for(request.environ):
+            return MESSAGE_INSERTS.insert(self.db.message, message)
+        res = self.db.message.insert_one(message)
+        assert res.acknowledged
+        return res.inserted_id
+
+    def get_write_query(self, id):
         if id is None:
-            url_query = MultiDict(request.args)
-            res = self.db.message.update_many(
-                self.db.create_query_from_dict(url_query),
-                self.db.create_update_query(update),
-            )
-        else:
-            res = self.db.message.update_one(
-                {"_id": ObjectId(id)}, self.db.create_update_query(update)
-            )
-            assert res.matched_count == 1
+            return self.db.create_query_from_dict(MultiDict(request.args))
+        return {"_id": ObjectId(id)}
+
+    @limit_bulk_writes
+    def put(self, id=None):
+        bucket = self.db.text_bucket
+        # everything is validated before a text is uploaded
+        query = self.get_write_query(id)
+        update = offload_text(bucket, create_message_update(**request.json))
+        # the files of replaced texts are released once nothing references them,
+        # like a new one the update didn't get to use
+        file_ids = get_new_file_ids(update)
+        try:
+            if "text" in update:
+                file_ids.extend(find_text_file_ids(self.db.message, query))
+
+            update_query = self.db.create_update_query(update)
+            if id is None:
+                res = self.db.message.update_many(query, update_query)
+            else:
+                res = self.db.message.update_one(query, update_query)
+        finally:
+            release_text_files(self.db.message, bucket, file_ids)
+        assert id is None or res.matched_count == 1
 
         assert res.acknowledged
         return {"modified_count": res.modified_count}, 201
 
+    @limit_bulk_writes
     def delete(self, id=None):
+        bucket = self.db.text_bucket
+        query = self.get_write_query(id)
+        file_ids = find_text_file_ids(self.db.message, query)
+
         if id is None:
-            url_query = MultiDict(request.args)
-            res = self.db.message.delete_many(
-                self.db.create_query_from_dict(url_query)
-            )
+            res = self.db.message.delete_many(query)
         else:
-            res = self.db.message.delete_one({"_id": ObjectId(id)})
+            res = self.db.message.delete_one(query)
+        release_text_files(self.db.message, bucket, file_ids)
 
         assert res.acknowledged
         return {"deleted_count": res.deleted_count}, 200
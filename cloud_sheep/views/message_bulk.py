@@ -0,0 +1,198 @@
+from itertools import islice
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import json, request
+from flask.views import MethodView
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..admission import limit_bulk_writes
+from ..entities.message import InvalidMessage, create_message, create_message_update
+from ..mongodb import InvalidValue
+from ..text_files import (
+    get_file_ids,
+    get_new_file_ids,
+    offload_text,
+    release_text_files,
+)
+from .message import NDJSON_MIMETYPE, handle_message
+
+BULK_OPERATIONS = ["insert", "update", "delete"]
+MAX_BULK_OPERATIONS = 10_000
+EMPTY_BULK_WRITE_RESULT = {"nInserted": 0, "nModified": 0, "nRemoved": 0}
+
+
+def parse_operation(operation):
+    # validated like the messages of the single message endpoints
+    if isinstance(operation, bytes):
+        try:
+            operation = json.loads(operation)
+        except ValueError:
+            raise InvalidMessage("Operation is not valid JSON.")
+
+    try:
+        assert isinstance(operation, dict)
+        op = operation.get("op")
+        assert op in BULK_OPERATIONS
+        fields = operation.get("message", {})
+        assert isinstance(fields, dict)
+        assert op == "insert" or isinstance(operation.get("_id"), str)
+    except AssertionError:
+        raise InvalidMessage("Operation is not valid.")
+
+    if op == "insert":
+        # the id is set up front, like the driver does
+        return op, ObjectId(), create_message(**fields)
+    elif op == "update":
+        return op, ObjectId(operation["_id"]), create_message_update(**fields)
+    else:
+        return op, ObjectId(operation["_id"]), None
+
+
+def create_error_result(status, error, message):
+    return {"status": status, "error": error, "message": message}
+
+
+def get_runnable_indexes(results, ordered):
+    # an ordered bulk runs nothing after its first failed operation
+    indexes = []
+    for index, result in enumerate(results):
+        if result is None:
+            indexes.append(index)
+        elif ordered:
+            break
+    return indexes
+
+
+def get_replaced_file_ids(operations, existing):
+    ids = [
+        id
+        for op, id, fields in operations
+        if op == "delete" or (op == "update" and "text" in fields)
+    ]
+    return get_file_ids(existing[id] for id in ids if "text_file" in existing[id])
+
+
+def truncate_results(results):
+    # the operations that weren't run aren't reported
+    for index, result in enumerate(results):
+        if result is None:
+            return results[:index]
+        if result["status"] >= 400:
+            return results[: index + 1]
+    return results
+
+
+class MessageBulkView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    @handle_message
+    @limit_bulk_writes
+    def post(self):
+        # like insert_many, operations are ordered unless said otherwise
+        ordered_param = request.args.get("ordered", "true")
+        ordered = self.db.get_bool_param("ordered", ordered_param)
+        if request.mimetype == NDJSON_MIMETYPE:
+            # the body is read no further than the first operation too many
+            lines = (line for line in request.stream if line.strip())
+            operations = list(islice(lines, MAX_BULK_OPERATIONS + 1))
+        else:
+            operations = request.get_json()
+            if not isinstance(operations, list):
+                raise InvalidValue("The operations should be a list.")
+        if len(operations) > MAX_BULK_OPERATIONS:
+            raise InvalidValue(
+                f"At most {MAX_BULK_OPERATIONS} operations can be sent at once."
+            )
+
+        results, parsed = [None] * len(operations), {}
+        for index, operation in enumerate(operations):
+            try:
+                parsed[index] = parse_operation(operation)
+            except (InvalidMessage, InvalidId) as error:
+                results[index] = create_error_result(
+                    400, type(error).__name__, error.args[0]
+                )
+
+        indexes = get_runnable_indexes(results, ordered)
+        existing = self.find_existing([parsed[index] for index in indexes])
+        for index in indexes:
+            op, id, _ = parsed[index]
+            if op != "insert" and id not in existing:
+                results[index] = create_error_result(
+                    404, "NotFound", "Message not found."
+                )
+
+        indexes = get_runnable_indexes(results, ordered)
+        write_result = self.write(parsed, indexes, existing, ordered, results)
+        if ordered:
+            results = truncate_results(results)
+
+        return {
+            "results": results,
+            "inserted_count": write_result["nInserted"],
+            "modified_count": write_result["nModified"],
+            "deleted_count": write_result["nRemoved"],
+            "error_count": sum(result["status"] >= 400 for result in results),
+        }, 200
+
+    def find_existing(self, operations):
+        # one query tells which messages exist and which text files they use
+        ids = [id for op, id, _ in operations if op != "insert"]
+        if not ids:
+            return {}
+        messages = self.db.message.find({"_id": {"$in": ids}}, ["text_file"])
+        return {message["_id"]: message for message in messages}
+
+    def create_requests(self, operations, file_ids):
+        # the ids of uploaded texts are added to file_ids as they're uploaded
+        bucket = self.db.text_bucket
+        requests = []
+        for op, id, fields in operations:
+            if op == "insert":
+                message = offload_text(bucket, fields)
+                file_ids.extend(get_new_file_ids(message))
+                requests.append(InsertOne({"_id": id, **message}))
+            elif op == "update":
+                update = offload_text(bucket, fields)
+                file_ids.extend(get_new_file_ids(update))
+                update_query = self.db.create_update_query(update)
+                requests.append(UpdateOne({"_id": id}, update_query))
+            else:
+                requests.append(DeleteOne({"_id": id}))
+        return requests
+
+    def write(self, parsed, indexes, existing, ordered, results):
+        # sets the result of every operation that was run
+        if not indexes:
+            return EMPTY_BULK_WRITE_RESULT
+        operations = [parsed[index] for index in indexes]
+        # the files of replaced texts are released once nothing references them,
+        # like the new ones of operations that failed
+        file_ids = get_replaced_file_ids(operations, existing)
+        try:
+            requests = self.create_requests(operations, file_ids)
+            write_result = self.db.message.bulk_write(requests, ordered=ordered)
+            write_result, write_errors = write_result.bulk_api_result, {}
+        except BulkWriteError as error:
+            write_result = error.details
+            write_errors = {e["index"]: e for e in error.details["writeErrors"]}
+        finally:
+            release_text_files(self.db.message, self.db.text_bucket, file_ids)
+
+        last_run = min(write_errors) if ordered and write_errors else len(indexes)
+        for i, (index, (op, id, _)) in enumerate(zip(indexes, operations)):
+            if i in write_errors:
+                results[index] = create_error_result(
+                    400, "WriteError", write_errors[i]["errmsg"]
+                )
+            elif i > last_run:
+                break
+            elif op == "insert":
+                results[index] = {"status": 201, "_id": id}
+            else:
+                results[index] = {"status": 200}
+        return write_result
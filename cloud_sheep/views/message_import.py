@@ -0,0 +1,87 @@
+from flask import json, request
+from flask.views import MethodView
+from pymongo.errors import BulkWriteError
+
+from ..entities.message import InvalidMessage, create_message
+from ..text_files import get_new_file_ids, offload_text, release_text_files
+
+MAX_REPORTED_ERRORS = 1000
+
+
+def parse_message_line(line):
+    try:
+        message = json.loads(line)
+    except ValueError:
+        raise InvalidMessage("Message is not valid JSON.")
+
+    if not isinstance(message, dict):
+        raise InvalidMessage("Message is not valid.")
+    return create_message(**message)
+
+
+def add_error(report, line_number, error, message):
+    report["error_count"] += 1
+    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+        report["errors"].append(
+            {"line": line_number, "message": message, "error": error}
+        )
+
+
+class MessageImportView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    def post(self):
+        chunk_size = self.db.get_chunk_size_param(request.args.get("chunk_size"))
+        report = {"inserted_count": 0, "error_count": 0, "errors": []}
+
+        chunk = []
+        for line_number, line in enumerate(request.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                chunk.append((line_number, parse_message_line(line)))
+            except InvalidMessage as error:
+                add_error(report, line_number, type(error).__name__, error.args[0])
+
+            if len(chunk) == chunk_size:
+                self.insert_chunk(chunk, report)
+                chunk = []
+        if chunk:
+            self.insert_chunk(chunk, report)
+
+        return report, 201
+
+    def insert_chunk(self, chunk, report):
+        line_numbers, messages = zip(*chunk)
+        bucket = self.db.text_bucket
+        # the files of the messages that weren't inserted aren't referenced,
+        # whatever stopped them
+        file_ids = []
+        try:
+            res = self.db.message.insert_many(
+                self.offload_texts(messages, file_ids), ordered=False
+            )
+            report["inserted_count"] += len(res.inserted_ids)
+        except BulkWriteError as error:
+            report["inserted_count"] += error.details["nInserted"]
+            for write_error in error.details["writeErrors"]:
+                add_error(
+                    report,
+                    line_numbers[write_error["index"]],
+                    "WriteError",
+                    write_error["errmsg"],
+                )
+        finally:
+            release_text_files(self.db.message, bucket, file_ids)
+
+    def offload_texts(self, messages, file_ids):
+        # the ids of uploaded texts are added to file_ids as they're uploaded
+        bucket = self.db.text_bucket
+        offloaded = []
+        for message in messages:
+            message = offload_text(bucket, message)
+            file_ids.extend(get_new_file_ids(message))
+            offloaded.append(message)
+        return offloaded
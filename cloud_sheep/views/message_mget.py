@@ -0,0 +1,20 @@
+from flask import request
+from flask.views import MethodView
+from werkzeug.datastructures import MultiDict
+
+from .message import get_messages_by_id, handle_message
+
+
+def get_ids_from_body(body):
+    return body.get("ids") if isinstance(body, dict) else None
+
+
+class MessageMultiGetView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    @handle_message
+    def post(self):
+        ids = get_ids_from_body(request.get_json(silent=True))
+        return get_messages_by_id(self.db, ids, MultiDict(request.args))
@@ -0,0 +1,51 @@
+import os
+
+from werkzeug.exceptions import Gone
+
+from ..indexes import NORMALIZED_FIELDS
+from ..serialization import dumps
+
+EVENT_STREAM_MIMETYPE = "text/event-stream"
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# an idle stream sends a comment this often, so proxies keep it open
+HEARTBEAT_MS = int(os.environ.get("STREAM_HEARTBEAT_MS", 15_000))
+HEARTBEAT = b": heartbeat\n\n"
+HISTORY_LOST_CODES = [260, 280, 286]
+HIDDEN_FIELDS = [name for name, _ in NORMALIZED_FIELDS.values()]
+
+
+def get_resume_token(headers, url_query):
+    # EventSource sends the id of the last event it got when it reconnects
+    token = url_query.pop("resume_after", default=None)
+    token = headers.get("Last-Event-ID", token)
+    return {"_data": token} if token else None
+
+
+def create_watch_options(resume_token):
+    return {
+        "full_document": "updateLookup",
+        "resume_after": resume_token,
+        "max_await_time_ms": HEARTBEAT_MS,
+    }
+
+
+def raise_for_history_lost(error):
+    if error.code in HISTORY_LOST_CODES:
+        raise Gone(
+            "The stream can't be resumed from there anymore, "
+            "messages should be fetched again."
+        )
+
+
+def format_change(change):
+    data = {"_id": change["documentKey"]["_id"]}
+    message = change.get("fullDocument")
+    if message is not None:
+        data["message"] = {
+            key: value for key, value in message.items() if key not in HIDDEN_FIELDS
+        }
+    return b"id: %s\nevent: %s\ndata: %s\n\n" % (
+        change["_id"]["_data"].encode(),
+        change["operationType"].encode(),
+        dumps(data),
+    )
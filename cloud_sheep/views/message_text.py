@@ -0,0 +1,44 @@
+from bson.objectid import ObjectId
+from flask import Response, abort, request
+from flask.views import MethodView
+
+from ..text_files import (
+    get_byte_range,
+    get_text_length,
+    read_text_file,
+    set_range_headers,
+)
+from .message import get_message_etag
+
+TEXT_MIMETYPE = "text/plain"
+TEXT_FIELDS = ["text", "text_file", "last_modified"]
+
+
+class MessageTextView(MethodView):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    def get(self, id):
+        message = self.db.message.find_one(ObjectId(id), TEXT_FIELDS)
+        if not message:
+            abort(404)
+
+        etag = get_message_etag(id, message, "text")
+        length = get_text_length(message)
+        byte_range = get_byte_range(request.headers, length, etag)
+        start, end = byte_range or (0, length)
+        if "text_file" in message:
+            file_id = message["text_file"]["_id"]
+            grid_out = self.db.text_bucket.open_download_stream(file_id)
+            response = Response(
+                read_text_file(grid_out, start, end - start), mimetype=TEXT_MIMETYPE
+            )
+            response.call_on_close(grid_out.close)
+        else:
+            text = message["text"].encode()[start:end]
+            response = Response(text, mimetype=TEXT_MIMETYPE)
+
+        response.set_etag(etag)
+        response.last_modified = message.get("last_modified")
+        return set_range_headers(response, length, byte_range)